@@ -11,6 +11,7 @@ from flask_migrate import Migrate
 
 from portal.factories.app import create_app
 from portal.extensions import db
+from portal.models.app_text import warm_content_cache
 from portal.models.i18n import smartling_upload, smartling_download
 from portal.models.fhir import add_static_concepts
 from portal.models.intervention import add_static_interventions
@@ -126,6 +127,18 @@ def export_site():
     SitePersistence().export()
 
 
+@app.cli.command()
+def warm_cache():
+    """Fetch remote (Liferay) content into the content cache
+
+    Run after deployment or a cache flush, so the first pages and emails
+    rendered don't each wait on the remote content server.
+
+    """
+    count = warm_content_cache()
+    click.echo("Cached content of {} URLs".format(count))
+
+
 @click.option('--email', '-e', help='Email of user to purge.')
 @click.option(
     '--actor', '-a',
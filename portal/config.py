@@ -47,17 +47,32 @@ class BaseConfig(object):
     DEFAULT_MAIL_SENDER = 'dontreply@truenth-demo.cirg.washington.edu'
     DOGPILE_CACHE_BACKEND = 'dogpile.cache.redis'
     DOGPILE_CACHE_REGIONS = [('hourly', 3600)]
+    QB_TIMELINE_CACHE = False  # cache user QB timelines in dogpile
+    ORG_CLOSURE_TABLE = False  # query org hierarchy via organization_closure
     SEND_FILE_MAX_AGE_DEFAULT = 60 * 60  # 1 hour, in seconds
 
     LOG_FOLDER = os.environ.get('LOG_FOLDER', None)
     LOG_LEVEL = 'DEBUG'
 
     MAIL_USERNAME = 'portal@truenth-demo.cirg.washington.edu'
+    MAIL_BATCH_SIZE = 100  # communications sent per SMTP connection
+    MAIL_MAX_ATTEMPTS = 5  # failed sends before a message is dead lettered
+    MAIL_RATE_LIMIT = 10  # messages per second, across workers, 0 disables
+    MAIL_RATE_BURST = 50
+    MAIL_RECIPIENT_RATE_LIMIT = 1.0 / (10 * 60)  # per second, 0 disables
+    MAIL_RECIPIENT_BURST = 5
+    MAIL_RETRY_DELAY = 5 * 60  # seconds before the first retry, then doubled
     MAIL_DEFAULT_SENDER = (
         '"TrueNTH" <noreply@truenth-demo.cirg.washington.edu>')
     CONTACT_SENDTO_EMAIL = MAIL_USERNAME
+    CONTENT_CACHE_FRESH = 5 * 60  # seconds content is fresh, 0 disables
+    CONTENT_CACHE_TTL = 7 * 24 * 60 * 60  # seconds stale content is kept
     ERROR_SENDTO_EMAIL = MAIL_USERNAME
+    EXPORT_JOB_RETENTION = 7 * 24 * 60 * 60  # seconds finished exports kept
     OAUTH2_PROVIDER_TOKEN_EXPIRES_IN = 4 * 60 * 60  # units: seconds
+    OAUTH_TOKEN_CACHE_TTL = 5 * 60  # seconds to cache tokens, 0 disables
+    # seconds to keep expired tokens holding a refresh token
+    OAUTH_EXPIRED_TOKEN_RETENTION = 30 * 24 * 60 * 60
     SS_TIMEOUT = 60 * 60  # seconds for session cookie, reset on ping
     PERMANENT_SESSION_LIFETIME = SS_TIMEOUT
     PIWIK_DOMAINS = ""
@@ -138,3 +153,7 @@ class TestConfig(BaseConfig):
 
     WTF_CSRF_ENABLED = False
     FILE_UPLOAD_DIR = 'test_uploads'
+    OAUTH_TOKEN_CACHE_TTL = 0  # tests reuse token values over db resets
+    CONTENT_CACHE_FRESH = 0  # tests expect fake responses for fake URLs
+    MAIL_RATE_LIMIT = 0  # tests share recipients, over runs
+    MAIL_RECIPIENT_RATE_LIMIT = 0
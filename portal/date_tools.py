@@ -74,17 +74,23 @@ class FHIR_datetime(object):
 class RelativeDelta(relativedelta):
     """utility class to simplify storing relative deltas in SQL strings"""
 
-    def __init__(self, paramstring):
+    def __init__(self, paramstring=None, **kwargs):
         """Expects a JSON string of parameters
 
         :param paramstring: like '{\"months\": 3, \"days\": -14}' is parsed
             using JSON and passed to dateutl.relativedelta.  All parameters
             supported by relativedelta should work.
+        :param kwargs: in lieu of paramstring, relativedelta keyword
+            arguments - used by relativedelta arithmetic such as
+            multiplication, which generates new instances of this class.
 
         :returns instance for use in date math such as:
             tomorrow = `utcnow() + RelativeDelta('{"days":1}')`
 
         """
+        if paramstring is None:
+            super(RelativeDelta, self).__init__(**kwargs)
+            return
         try:
             d = json.loads(paramstring)
         except ValueError:
@@ -25,6 +25,7 @@ from ..views.auth import auth, capture_next_view_function
 from ..views.coredata import coredata_api
 from ..views.clinical import clinical_api
 from ..views.demographics import demographics_api
+from ..views.export import export_api
 from ..views.extend_flask_user import reset_password_view_function
 from ..views.fhir import fhir_api
 from ..views.filters import filters_blueprint
@@ -49,6 +50,7 @@ DEFAULT_BLUEPRINTS = (
     clinical_api,
     csrf_blueprint,
     demographics_api,
+    export_api,
     fhir_api,
     filters_blueprint,
     group_api,
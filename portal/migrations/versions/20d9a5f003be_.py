@@ -0,0 +1,47 @@
+from alembic import op
+import sqlalchemy as sa
+
+
+"""Add questionnaire_responses.questionnaire_name
+
+Revision ID: 20d9a5f003be
+Revises: 6421bf44f03f
+Create Date: 2017-10-02 11:24:53.902117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '20d9a5f003be'
+down_revision = '6421bf44f03f'
+
+
+def upgrade():
+    op.add_column(
+        'questionnaire_responses',
+        sa.Column('questionnaire_name', sa.Text(), nullable=True))
+
+    # Backfill from the document's questionnaire reference, keeping
+    # only the trailing path segment as the model does
+    op.execute(
+        "UPDATE questionnaire_responses SET questionnaire_name = "
+        "  regexp_replace("
+        "    document->'questionnaire'->>'reference', '^.*/', '') "
+        "  WHERE document->'questionnaire'->>'reference' IS NOT NULL")
+
+    op.create_index(
+        op.f('ix_questionnaire_responses_questionnaire_name'),
+        'questionnaire_responses', ['questionnaire_name'], unique=False)
+    op.create_index(
+        'ix_questionnaire_responses_subject_questionnaire',
+        'questionnaire_responses', ['subject_id', 'questionnaire_name'],
+        unique=False)
+
+
+def downgrade():
+    op.drop_index(
+        'ix_questionnaire_responses_subject_questionnaire',
+        table_name='questionnaire_responses')
+    op.drop_index(
+        op.f('ix_questionnaire_responses_questionnaire_name'),
+        table_name='questionnaire_responses')
+    op.drop_column('questionnaire_responses', 'questionnaire_name')
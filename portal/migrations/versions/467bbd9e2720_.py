@@ -0,0 +1,53 @@
+from alembic import op
+import sqlalchemy as sa
+
+
+"""Add organization_closure table
+
+Revision ID: 467bbd9e2720
+Revises: 68c153cf6a02
+Create Date: 2017-09-26 10:12:41.504318
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '467bbd9e2720'
+down_revision = '68c153cf6a02'
+
+
+def upgrade():
+    op.create_table(
+        'organization_closure',
+        sa.Column('ancestor_id', sa.Integer(), nullable=False),
+        sa.Column('descendant_id', sa.Integer(), nullable=False),
+        sa.Column('depth', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['ancestor_id'], ['organizations.id'],
+                                ondelete='cascade'),
+        sa.ForeignKeyConstraint(['descendant_id'], ['organizations.id'],
+                                ondelete='cascade'),
+        sa.PrimaryKeyConstraint('ancestor_id', 'descendant_id')
+    )
+    op.create_index(
+        op.f('ix_organization_closure_descendant_id'),
+        'organization_closure', ['descendant_id'], unique=False)
+
+    # Populate from the existing hierarchy, excluding 'none of the above'
+    # just as the OrgTree does
+    op.execute(
+        "INSERT INTO organization_closure "
+        "  (ancestor_id, descendant_id, depth) "
+        "WITH RECURSIVE tree(id, path) AS ("
+        "  SELECT id, ARRAY[id] FROM organizations "
+        "    WHERE id != 0 AND \"partOf_id\" IS NULL "
+        "  UNION ALL "
+        "  SELECT o.id, tree.path || o.id FROM organizations o "
+        "    JOIN tree ON o.\"partOf_id\" = tree.id) "
+        "SELECT path[i], id, array_length(path, 1) - i "
+        "  FROM tree, generate_subscripts(path, 1) AS i")
+
+
+def downgrade():
+    op.drop_index(
+        op.f('ix_organization_closure_descendant_id'),
+        table_name='organization_closure')
+    op.drop_table('organization_closure')
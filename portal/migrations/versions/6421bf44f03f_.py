@@ -0,0 +1,24 @@
+from alembic import op
+import sqlalchemy as sa
+
+
+"""Add scheduled_jobs.progress
+
+Revision ID: 6421bf44f03f
+Revises: 467bbd9e2720
+Create Date: 2017-09-28 14:02:17.415268
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6421bf44f03f'
+down_revision = '467bbd9e2720'
+
+
+def upgrade():
+    op.add_column(
+        'scheduled_jobs', sa.Column('progress', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('scheduled_jobs', 'progress')
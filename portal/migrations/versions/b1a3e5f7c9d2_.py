@@ -0,0 +1,26 @@
+from alembic import op
+
+
+"""Index grants and tokens on expires
+
+Revision ID: b1a3e5f7c9d2
+Revises: ea7f8c814cd5
+Create Date: 2017-10-09 10:12:41.517283
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b1a3e5f7c9d2'
+down_revision = 'ea7f8c814cd5'
+
+
+def upgrade():
+    op.create_index(
+        op.f('ix_grants_expires'), 'grants', ['expires'], unique=False)
+    op.create_index(
+        op.f('ix_tokens_expires'), 'tokens', ['expires'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_tokens_expires'), table_name='tokens')
+    op.drop_index(op.f('ix_grants_expires'), table_name='grants')
@@ -0,0 +1,37 @@
+from alembic import op
+import sqlalchemy as sa
+
+
+"""Add priority and retry state to communications
+
+Revision ID: c4e8a2d6f1b3
+Revises: b1a3e5f7c9d2
+Create Date: 2017-10-10 14:32:08.164022
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a2d6f1b3'
+down_revision = 'b1a3e5f7c9d2'
+
+
+def upgrade():
+    op.add_column('communications', sa.Column(
+        'priority', sa.Integer(), server_default='10', nullable=False))
+    op.add_column('communications', sa.Column(
+        'attempts', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('communications', sa.Column(
+        'next_attempt_at', sa.DateTime(), nullable=True))
+    op.add_column('communications', sa.Column(
+        'last_error', sa.Text(), nullable=True))
+    op.create_index(
+        'ix_communications_dispatch', 'communications',
+        ['status', 'priority', 'next_attempt_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_communications_dispatch', table_name='communications')
+    op.drop_column('communications', 'last_error')
+    op.drop_column('communications', 'next_attempt_at')
+    op.drop_column('communications', 'attempts')
+    op.drop_column('communications', 'priority')
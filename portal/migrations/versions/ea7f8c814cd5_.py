@@ -0,0 +1,41 @@
+from alembic import op
+import sqlalchemy as sa
+
+
+"""Add export_jobs table
+
+Revision ID: ea7f8c814cd5
+Revises: 20d9a5f003be
+Create Date: 2017-10-04 09:47:31.208344
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'ea7f8c814cd5'
+down_revision = '20d9a5f003be'
+
+
+def upgrade():
+    op.create_table(
+        'export_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('export_type', sa.Text(), nullable=False),
+        sa.Column('format', sa.Text(), nullable=False),
+        sa.Column('params', sa.JSON(), nullable=True),
+        sa.Column('status', sa.Text(), nullable=False),
+        sa.Column('progress', sa.Integer(), nullable=False),
+        sa.Column('message', sa.Text(), nullable=True),
+        sa.Column('task_id', sa.Text(), nullable=True),
+        sa.Column('uuid', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('completed_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('export_jobs')
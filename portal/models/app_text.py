@@ -10,14 +10,23 @@ SitePersistence mechanism, and looked up in a template using the
 from abc import ABCMeta, abstractmethod
 from flask import current_app
 from flask_babel import gettext
+from hashlib import sha1
+import json
+import redis
 import requests
 from requests.exceptions import MissingSchema, ConnectionError
+import time
 import timeit
 from string import Formatter
 from urllib import urlencode
 from urlparse import parse_qsl, urlparse
 
 from ..database import db
+from ..redis_client import redis_client
+
+CONTENT_CACHE_PREFIX = 'content:'
+CONTENT_REFRESH_PREFIX = 'content-refresh:'
+CONTENT_REFRESH_LOCK_TTL = 60  # seconds a scheduled refresh blocks others
 
 
 def time_request(url):
@@ -36,6 +45,177 @@ def time_request(url):
     return response
 
 
+class CachedResponse(object):
+    """The parts of a `requests.Response` the resource classes use
+
+    Serializable to and from the content cache, and holding the time
+    the content was fetched, to judge when it's stale.
+
+    """
+    def __init__(self, url, status_code, reason, text, fetched_at=None):
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+        self.fetched_at = fetched_at or time.time()
+        self._json = None
+
+    @classmethod
+    def from_response(cls, url, response):
+        return cls(url=url, status_code=response.status_code,
+                   reason=response.reason, text=response.text)
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**json.loads(data))
+
+    def as_json(self):
+        return json.dumps({
+            'url': self.url, 'status_code': self.status_code,
+            'reason': self.reason, 'text': self.text,
+            'fetched_at': self.fetched_at})
+
+    def json(self):
+        """Returns parsed JSON body; raises ValueError if not JSON"""
+        if self._json is None:
+            self._json = json.loads(self.text)
+        return self._json
+
+    @property
+    def age(self):
+        return time.time() - self.fetched_at
+
+
+def _content_cache_key(url, prefix=CONTENT_CACHE_PREFIX):
+    """Returns the redis key for content requested from `url`
+
+    Keyed by URL alone: the app_text links are generic, and the version
+    they resolve to is only known from the response, so it can't be part
+    of the lookup.  Content published as a new version replaces the entry
+    once it's refreshed, and anything derived from the content (such as
+    the `_template_variables` memo) is keyed by the content itself, so
+    never outlives the version it came from.
+
+    """
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return prefix + sha1(url).hexdigest()
+
+
+def store_content(response):
+    """Write CachedResponse to the content cache, if successful
+
+    Entries outlive their freshness, for `CONTENT_CACHE_TTL` seconds,
+    to be served while a refresh is underway.
+
+    """
+    if response.status_code != 200:
+        return
+    try:
+        redis_client().setex(
+            _content_cache_key(response.url),
+            current_app.config['CONTENT_CACHE_TTL'], response.as_json())
+    except redis.RedisError as e:
+        current_app.logger.error("failed to cache content: {}".format(e))
+
+
+def fetch_content(url):
+    """Fetch url, writing the result to the content cache
+
+    Used for cache misses, background refreshes and warming the cache.
+
+    :returns: CachedResponse
+    :raises: as does `requests.get()` for invalid or unreachable URLs
+
+    """
+    response = CachedResponse.from_response(url, time_request(url))
+    if current_app.config.get('CONTENT_CACHE_FRESH'):
+        store_content(response)
+    return response
+
+
+def cached_content(url):
+    """Return content of url, from the content cache when available
+
+    Content served by Liferay changes rarely, but fetching it costs a
+    remote round trip.  Cached content younger than `CONTENT_CACHE_FRESH`
+    seconds is returned as is.  Older (stale) content is also returned
+    without waiting, with a refresh scheduled in the background, so
+    callers only ever wait on the remote server for content never
+    fetched before (or evicted).
+
+    :returns: CachedResponse
+    :raises: as does `requests.get()` for invalid or unreachable URLs
+
+    """
+    fresh = current_app.config.get('CONTENT_CACHE_FRESH')
+    if not fresh or not isinstance(url, basestring):
+        return CachedResponse.from_response(url, time_request(url))
+    try:
+        data = redis_client().get(_content_cache_key(url))
+    except redis.RedisError as e:
+        current_app.logger.warn(
+            "unable to check content cache: {}".format(e))
+        data = None
+    if not data:
+        return fetch_content(url)
+
+    response = CachedResponse.from_json(data)
+    if response.age > fresh:
+        schedule_content_refresh(url)
+    return response
+
+
+def schedule_content_refresh(url):
+    """Queue background refresh of url, unless one is already queued"""
+    try:
+        scheduled = redis_client().set(
+            _content_cache_key(url, prefix=CONTENT_REFRESH_PREFIX), 1,
+            ex=CONTENT_REFRESH_LOCK_TTL, nx=True)
+    except redis.RedisError as e:
+        current_app.logger.error(
+            "failed to schedule content refresh: {}".format(e))
+        return
+    if scheduled:
+        from ..factories.celery import create_celery  # avoid cyclic import
+        celery = create_celery(current_app)
+        celery.send_task('portal.tasks.refresh_content', args=(url,))
+
+
+def refresh_content(url):
+    """Fetch url into the content cache, ending its scheduled refresh"""
+    try:
+        fetch_content(url)
+    finally:
+        redis_client().delete(
+            _content_cache_key(url, prefix=CONTENT_REFRESH_PREFIX))
+
+
+def warm_content_cache():
+    """Fetch the content of every AppText URL into the content cache
+
+    Intended for deployment, so the first requests and messages after a
+    restart (or cache flush) don't each wait on the remote server.
+
+    :returns: number of URLs successfully fetched
+
+    """
+    count = 0
+    for item in AppText.query.order_by(AppText.name):
+        url = item.custom_text
+        if not (url and url.startswith(('http://', 'https://'))):
+            continue
+        try:
+            response = fetch_content(url)
+        except (MissingSchema, ConnectionError) as e:
+            current_app.logger.error(
+                "failed to warm content cache for {}: {}".format(url, e))
+            continue
+        if response.status_code == 200:
+            count += 1
+    return count
+
+
 class AppText(db.Model):
     """Model representing application specific strings for customization
 
@@ -294,7 +474,7 @@ class UnversionedResource(object):
             self._asset = asset
         else:
             try:
-                response = time_request(url)
+                response = cached_content(url)
                 self._asset = response.text
             except MissingSchema:
                 if current_app.config.get('TESTING'):
@@ -348,7 +528,7 @@ class VersionedResource(object):
         self.url = url
         self.variables = variables or {}
         try:
-            response = time_request(url)
+            response = cached_content(url)
             self._asset = response.json().get('asset')
             self.url = self._permanent_url(
                 generic_url=url, version=response.json().get('version'))
@@ -442,7 +622,7 @@ class MailResource(object):
         self.url = url
         self.variables = variables or {}
         try:
-            response = time_request(url)
+            response = cached_content(url)
             self._subject = response.json().get('subject')
             self._body = response.json().get('body')
             if current_app.config.get("DEBUG_EMAIL", False):
@@ -521,17 +701,8 @@ class MailResource(object):
 
     @property
     def variable_list(self):
-        var_list = set()
-        if self._subject:
-            var_list.update(
-                [v[1] for v in Formatter().parse(self._subject) if v[1]])
-        if self._body:
-            var_list.update(
-                [v[1] for v in Formatter().parse(self._body) if v[1]])
-        if self._footer:
-            var_list.update(
-                [v[1] for v in Formatter().parse(self._footer) if v[1]])
-        return list(var_list)
+        return list(_template_variables(
+            self._subject, self._body, self._footer))
 
     def _permanent_url(self, generic_url, version):
         """Produce a permanent url from the metadata provided
@@ -561,6 +732,30 @@ class MailResource(object):
         return url
 
 
+# Memoized `_template_variables` results, keyed by template content
+_variable_lists = {}
+VARIABLE_LIST_MAX = 1000  # templates to memoize before starting over
+
+
+def _template_variables(*templates):
+    """Returns frozenset of the variable names used in the templates
+
+    Memoized by content, so each version of a template is only parsed
+    once per process.
+
+    """
+    if templates not in _variable_lists:
+        if len(_variable_lists) >= VARIABLE_LIST_MAX:
+            _variable_lists.clear()
+        var_list = set()
+        for template in templates:
+            if template:
+                var_list.update(
+                    [v[1] for v in Formatter().parse(template) if v[1]])
+        _variable_lists[templates] = frozenset(var_list)
+    return _variable_lists[templates]
+
+
 class UndefinedAppText(Exception):
     """Exception raised when requested AppText isn't defined"""
     pass
@@ -1,13 +1,23 @@
 """AssessmentStatus module"""
-from collections import OrderedDict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 from flask import current_app
+from itertools import chain
+from sqlalchemy import func
+from dogpile.cache.api import NO_VALUE
+from sqlalchemy.orm import joinedload
 
 from ..dogpile import dogpile_cache
+from .audit import Audit
 from .fhir import QuestionnaireResponse
-from .organization import Organization
-from .questionnaire_bank import QuestionnaireBank
+from .organization import Organization, OrgTree, UserOrganization
+from .qb_timeline import qb_window, user_qb_window
+from .questionnaire_bank import QuestionnaireBank, QBD, classification_types
+from .questionnaire_bank import QuestionnaireBankQuestionnaire
+from .questionnaire_bank import current_qbd, intervention_qbs_for_users
+from .questionnaire_bank import intervention_trigger_dates
 from .user import User
+from .user_consent import UserConsent
 
 
 def recent_qnr_status(user, questionnaire_name):
@@ -15,27 +25,50 @@ def recent_qnr_status(user, questionnaire_name):
 
     :param user: Patient to whom completed QuestionnaireResponses belong
     :param questionnaire_name: name of associated questionnaire
-    :return: dictionary with authored (timestamp) of the most recent
+    :return: dictionary with authored (timestamp) of the earliest
         QuestionnaireResponse keyed by status found
 
     """
-    query = QuestionnaireResponse.query.distinct(
-        QuestionnaireResponse.status).filter(
-            QuestionnaireResponse.subject_id == user.id
-        ).filter(
-            QuestionnaireResponse.document[
-                ('questionnaire', 'reference')
-            ].astext.endswith(questionnaire_name)
-        ).order_by(
-            QuestionnaireResponse.status,
-            QuestionnaireResponse.authored).limit(9).with_entities(
-                QuestionnaireResponse.status, QuestionnaireResponse.authored)
+    return qnr_status_by_instrument(
+        [user.id], [questionnaire_name]).get(user.id, {}).get(
+            questionnaire_name, {})
 
-    results = {}
-    for qr in query:
-        if qr[0] not in results:
-            results[qr[0]] = qr[1]
 
+def qnr_status_by_instrument(user_ids, questionnaire_names=None):
+    """Look up authored timestamps by instrument and status for users
+
+    Gathers in a single grouped query on the indexed
+    `QuestionnaireResponse.questionnaire_name` what `recent_qnr_status`
+    returns for a single user and questionnaire.
+
+    :param user_ids: iterable of subject (user) ids
+    :param questionnaire_names: optional, list of questionnaire names to
+        restrict the lookup to
+    :return: nested dictionaries; keyed by user_id then questionnaire
+        name, holding the earliest authored timestamp keyed by status
+
+    """
+    user_ids = list(user_ids)
+    results = {}
+    if not user_ids:
+        return results
+    query = QuestionnaireResponse.query.filter(
+        QuestionnaireResponse.subject_id.in_(user_ids))
+    if questionnaire_names is not None:
+        if not questionnaire_names:
+            return results
+        query = query.filter(QuestionnaireResponse.questionnaire_name.in_(
+            questionnaire_names))
+    for subject_id, name, status, authored in query.group_by(
+            QuestionnaireResponse.subject_id,
+            QuestionnaireResponse.questionnaire_name,
+            QuestionnaireResponse.status).with_entities(
+                QuestionnaireResponse.subject_id,
+                QuestionnaireResponse.questionnaire_name,
+                QuestionnaireResponse.status,
+                func.min(QuestionnaireResponse.authored)):
+        results.setdefault(subject_id, {}).setdefault(name, {})[
+            status] = authored
     return results
 
 
@@ -80,22 +113,67 @@ def status_from_recents(recents, start, overdue, expired):
     return tmp
 
 
-def qb_status_dict(user, questionnaire_bank):
-    """Gather status details for a user on a given QB"""
+def qb_status_dict(user, questionnaire_bank, trigger_date=None, recents=None):
+    """Gather status details for a user on a given QB
+
+    :param trigger_date: optional, previously looked up trigger date for
+        the user on the given QB.  If not provided, the QB's window is
+        taken from the user's `QBTimeline`
+    :param recents: optional, dictionary keyed by questionnaire name
+        holding previously looked up `qnr_status_by_instrument` results
+
+    """
     d = OrderedDict()
     if not questionnaire_bank:
         return d
-    trigger_date = questionnaire_bank.trigger_date(user)
-    start = questionnaire_bank.calculated_start(trigger_date).relative_start
-    overdue = questionnaire_bank.calculated_overdue(trigger_date)
-    expired = questionnaire_bank.calculated_expiry(trigger_date)
+    if trigger_date is None:
+        window = user_qb_window(user, questionnaire_bank)
+    else:
+        window = qb_window(questionnaire_bank, trigger_date)
+    start, overdue, expired = window.start, window.overdue, window.expiry
+    if recents is None:
+        recents = qnr_status_by_instrument(
+            [user.id], [q.name for q in questionnaire_bank.questionnaires]
+        ).get(user.id, {})
     for q in questionnaire_bank.questionnaires:
-        recents = recent_qnr_status(user, q.name)
         d[q.name] = status_from_recents(
-            recents, start, overdue, expired)
+            recents.get(q.name, {}), start, overdue, expired)
     return d
 
 
+def qb_overall_status(questionnaire_bank, status_by_q):
+    """Returns the `overall_status` given the status of each questionnaire
+
+    :param questionnaire_bank: the user's most current QB
+    :param status_by_q: dictionary as returned from `qb_status_dict`
+
+    """
+    if not (questionnaire_bank and questionnaire_bank.trigger_date):
+        return 'Expired'
+    status_strings = [v['status'] for v in status_by_q.values()]
+    if all((status_strings[0] == status for status in status_strings)):
+        if not status_strings[0] in (
+                'Completed', 'Due', 'In Progress', 'Overdue',
+                'Expired'):
+            raise ValueError('Unexpected common status {}'.format(
+                status_strings[0]))
+
+        result = status_strings[0]
+
+        # Edge case where all are in progress, but no time remains
+        if status_strings[0] == 'In Progress':
+            due_by = [
+                d.get('by_date') for d in status_by_q.values()]
+            if not any(due_by):
+                result = 'Partially Completed'
+    else:
+        if any(('Expired' == status for status in status_strings)):
+            result = 'Partially Completed'
+        else:
+            result = 'In Progress'
+    return result
+
+
 class QuestionnaireBankDetails(object):
     """Gather details on users most current QuestionnaireBank
 
@@ -122,30 +200,7 @@ class QuestionnaireBankDetails(object):
 
     def overall_status(self):
         """Returns the `overall_status` for the users most_current_qb"""
-        if not (self.qb and self.qb.trigger_date):
-            return 'Expired'
-        status_strings = [v['status'] for v in self.status_by_q.values()]
-        if all((status_strings[0] == status for status in status_strings)):
-            if not status_strings[0] in (
-                    'Completed', 'Due', 'In Progress', 'Overdue',
-                    'Expired'):
-                raise ValueError('Unexpected common status {}'.format(
-                    status_strings[0]))
-
-            result = status_strings[0]
-
-            # Edge case where all are in progress, but no time remains
-            if status_strings[0] == 'In Progress':
-                due_by = [
-                    d.get('by_date') for d in self.status_by_q.values()]
-                if not any(due_by):
-                    result = 'Partially Completed'
-        else:
-            if any(('Expired' == status for status in status_strings)):
-                result = 'Partially Completed'
-            else:
-                result = 'In Progress'
-        return result
+        return qb_overall_status(self.qb, self.status_by_q)
 
 
 class AssessmentStatus(object):
@@ -314,3 +369,212 @@ def overall_assessment_status(user_id):
     a_s = AssessmentStatus(user)
     qbd = QuestionnaireBank.most_current_qb(user)
     return (a_s.overall_status, qbd)
+
+
+def bulk_overall_assessment_status(user_ids, chunk_size=1000):
+    """Compute `overall_assessment_status` values for a cohort of users
+
+    Equivalent to looking up `overall_assessment_status` for each user,
+    but the inputs (QuestionnaireBank definitions, organization affiliations,
+    consents and QuestionnaireResponse status by instrument) are gathered in
+    a few set based queries per chunk of users, and the results computed in
+    memory.
+
+    Access to intervention associated QuestionnaireBanks is evaluated in
+    bulk per chunk too, though their trigger dates are still looked up on
+    each user given one.
+
+    :param user_ids: iterable of (patient) user ids
+    :param chunk_size: max number of users to include in each query
+    :return: dictionary keyed by user_id holding the same (overall_status,
+        QBD) tuple `overall_assessment_status` generates.  Users for whom
+        the status can't be determined, or who don't exist, are logged
+        and left out.
+
+    """
+    user_ids = list(user_ids)
+    results = {}
+
+    qbs = QuestionnaireBank.query.options(
+        joinedload(QuestionnaireBank.recurs),
+        joinedload(QuestionnaireBank.questionnaires).joinedload(
+            QuestionnaireBankQuestionnaire.questionnaire)).order_by(
+                QuestionnaireBank.id).all()
+    org_qbs = defaultdict(list)
+    intervention_qbs = defaultdict(list)
+    for qb in qbs:
+        if qb.organization_id is not None:
+            org_qbs[qb.classification].append(qb)
+        else:
+            intervention_qbs[qb.classification].append(qb)
+    all_intervention_qbs = [
+        qb for qb in qbs if qb.intervention_id is not None]
+
+    orgtree = OrgTree()
+
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i:i + chunk_size]
+        now = datetime.utcnow()
+
+        top_orgs = defaultdict(set)
+        for user_id, org_id in UserOrganization.query.filter(
+                UserOrganization.user_id.in_(chunk),
+                UserOrganization.organization_id != 0).with_entities(
+                    UserOrganization.user_id,
+                    UserOrganization.organization_id):
+            top_orgs[user_id].add(orgtree.find(org_id).top_level())
+
+        # The first valid consent defines the trigger date for
+        # organization associated QBs - see `QuestionnaireBank.trigger_date`
+        consent_dates = {}
+        for user_id, timestamp in UserConsent.query.join(
+                Audit, UserConsent.audit_id == Audit.id).filter(
+                    UserConsent.user_id.in_(chunk),
+                    UserConsent.deleted_id.is_(None),
+                    UserConsent.expires > now).order_by(
+                        UserConsent.user_id, UserConsent.id).with_entities(
+                            UserConsent.user_id, Audit.timestamp):
+            consent_dates.setdefault(user_id, timestamp)
+
+        qnr_status = qnr_status_by_instrument(chunk)
+
+        found = set(r[0] for r in User.query.filter(
+            User.id.in_(chunk)).with_entities(User.id))
+        applicable_qbs = intervention_qbs_for_users(
+            found, all_intervention_qbs)
+        # Intervention QBs trigger on treatment or biopsy instead
+        intervention_dates = intervention_trigger_dates(applicable_qbs)
+
+        for user_id in chunk:
+            if user_id not in found:
+                current_app.logger.warning(
+                    "no user {} to determine assessment status "
+                    "for".format(user_id))
+                continue
+            try:
+                results[user_id] = _cohort_member_status(
+                    user_id=user_id,
+                    top_orgs=top_orgs[user_id],
+                    consent_date=consent_dates.get(user_id),
+                    intervention_date=intervention_dates.get(user_id),
+                    qnr_status=qnr_status.get(user_id, {}),
+                    org_qbs=org_qbs,
+                    intervention_qbs=intervention_qbs,
+                    applicable_qbs=applicable_qbs.get(user_id, ()))
+            except ValueError as e:
+                current_app.logger.error(
+                    "failed to determine assessment status for user "
+                    "{}: {}".format(user_id, e))
+    return results
+
+
+def _cohort_member_status(
+        user_id, top_orgs, consent_date, intervention_date, qnr_status,
+        org_qbs, intervention_qbs, applicable_qbs):
+    """Compute (overall_status, QBD) from a single user's bulk loaded data
+
+    Mirrors `QuestionnaireBank.most_current_qb` and
+    `QuestionnaireBankDetails` - see `bulk_overall_assessment_status`
+
+    """
+    applicable_ids = set(qb.id for qb in applicable_qbs)
+
+    def qbs_for(classification):
+        found = [qb for qb in org_qbs[classification]
+                 if qb.organization_id in top_orgs]
+        found.extend(qb for qb in intervention_qbs[classification]
+                     if qb.id in applicable_ids)
+        return found
+
+    def trigger_date(qb):
+        if qb.organization_id:
+            return consent_date
+        return intervention_date
+
+    no_qbd = QBD(None, None, None, None)
+    baseline = qbs_for('baseline')
+    if not baseline:
+        return ('Expired', no_qbd)
+    baseline_trigger = trigger_date(baseline[0])
+    if not baseline_trigger:
+        return ('Expired', no_qbd)
+
+    qbd = current_qbd(
+        qbs=chain.from_iterable(
+            qbs_for(classification)
+            for classification in classification_types
+            if classification != 'indefinite'),
+        trigger_date=baseline_trigger, as_of_date=datetime.utcnow(),
+        default=QBD(relative_start=None, iteration=None, recur=None,
+                    questionnaire_bank=baseline[0]))
+    qb = qbd.questionnaire_bank
+    qb_trigger = trigger_date(qb)
+    status_by_q = qb_status_dict(
+        # the user is only needed for a QB without a trigger date
+        user=User.query.get(user_id) if qb_trigger is None else None,
+        questionnaire_bank=qb, trigger_date=qb_trigger, recents=qnr_status)
+    return (qb_overall_status(qb, status_by_q), qbd)
+
+
+def _status_cache_region():
+    """Returns region and key generator for `overall_assessment_status`"""
+    region = dogpile_cache.get_region(
+        getattr(overall_assessment_status,
+                dogpile_cache.FUNC_REGION_NAME_ATTR))
+    return region, region.function_key_generator(
+        None, overall_assessment_status)
+
+
+def cached_overall_assessment_status(user_ids):
+    """Bulk lookup of `overall_assessment_status` values
+
+    Reads all cached values in a single multi-get (a redis MGET), and
+    computes any missing via `bulk_overall_assessment_status`, which
+    are then written back to the cache.
+
+    :param user_ids: iterable of (patient) user ids
+    :return: dictionary keyed by user_id of (overall_status, QBD) tuples
+
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    region, key_for = _status_cache_region()
+    values = region.get_multi([key_for(user_id) for user_id in user_ids])
+    results = {
+        user_id: value for user_id, value in zip(user_ids, values)
+        if value is not NO_VALUE}
+
+    missing = [user_id for user_id in user_ids if user_id not in results]
+    if missing:
+        statuses = bulk_overall_assessment_status(missing)
+        refresh_assessment_status_cache(statuses=statuses)
+        results.update(statuses)
+        for user_id in missing:
+            if user_id not in results:
+                # not determined in bulk; fall back to individual lookup
+                results[user_id] = overall_assessment_status(user_id)
+    return results
+
+
+def refresh_assessment_status_cache(user_ids=None, statuses=None):
+    """Bulk renewal of the `overall_assessment_status` cache values
+
+    Computes status for all given users via
+    `bulk_overall_assessment_status` and writes the results to the cache
+    region in a single multi-set.
+
+    :param user_ids: iterable of (patient) user ids
+    :param statuses: optional, previously computed results from
+        `bulk_overall_assessment_status` to write in lieu of user_ids
+    :return: the number of users for whom the cache was refreshed
+
+    """
+    if statuses is None:
+        statuses = bulk_overall_assessment_status(user_ids)
+    if not statuses:
+        return 0
+    region, key_for = _status_cache_region()
+    region.set_multi({
+        key_for(user_id): value for user_id, value in statuses.items()})
+    return len(statuses)
@@ -1,21 +1,27 @@
 """Auth related model classes """
 import base64
+import calendar
 import hashlib
 import hmac
+from itertools import chain
 import json
+import redis
 import time
 from flask import abort, current_app
 from datetime import datetime, timedelta
+from sqlalchemy import and_, event, or_
 from sqlalchemy.dialects.postgresql import ENUM
+from sqlalchemy.orm import Session
 from urlparse import urlparse
 
 from ..database import db
 from ..extensions import oauth
+from ..redis_client import redis_client
 from .relationship import RELATIONSHIP
 from ..system_uri import SUPPORTED_OAUTH_PROVIDERS, TRUENTH_IDENTITY_SYSTEM
 from ..factories.celery import create_celery
 
-from .user import current_user
+from .user import current_user, User
 
 providers_list = ENUM(
     *SUPPORTED_OAUTH_PROVIDERS, name='providers', create_type=False)
@@ -212,7 +218,7 @@ class Grant(db.Model):
     code = db.Column(db.String(255), index=True, nullable=False)
 
     redirect_uri = db.Column(db.Text)
-    expires = db.Column(db.DateTime)
+    expires = db.Column(db.DateTime, index=True)
 
     _scopes = db.Column(db.Text)
 
@@ -262,7 +268,7 @@ class Token(db.Model):
 
     access_token = db.Column(db.String(255), unique=True)
     refresh_token = db.Column(db.String(255), unique=True)
-    expires = db.Column(db.DateTime)
+    expires = db.Column(db.DateTime, index=True)
     _scopes = db.Column(db.Text)
 
     @property
@@ -272,6 +278,143 @@ class Token(db.Model):
         return []
 
 
+class CachedToken(object):
+    """Stand in for a Token, built from the token cache
+
+    Holds only what's needed to validate a bearer token.  The user and
+    client are loaded by primary key on access, the user lookup shared
+    (by way of the session identity map) with `current_user()`.
+
+    """
+    def __init__(self, access_token, data):
+        self.access_token = access_token
+        self.id = data['id']
+        self.user_id = data['user_id']
+        self.client_id = data['client_id']
+        self.token_type = data['token_type']
+        self._scopes = data['scopes']
+        self.expires = (
+            datetime.utcfromtimestamp(data['expires'])
+            if data['expires'] is not None else None)
+
+    @property
+    def scopes(self):
+        if self._scopes:
+            return self._scopes.split()
+        return []
+
+    @property
+    def user(self):
+        return User.query.get(self.user_id)
+
+    @property
+    def client(self):
+        return Client.query.get(self.client_id)
+
+
+TOKEN_CACHE_PREFIX = '{}:token'.format(__name__)
+
+
+def _token_cache_key(access_token):
+    """Cache key for access_token, hashed to keep tokens out of redis"""
+    if isinstance(access_token, unicode):
+        access_token = access_token.encode('utf-8')
+    return '{}:{}'.format(
+        TOKEN_CACHE_PREFIX, hashlib.sha256(access_token).hexdigest())
+
+
+def cache_token(token):
+    """Write token details to the token cache
+
+    Entries live for `OAUTH_TOKEN_CACHE_TTL` seconds (never beyond the
+    token's expiration); a TTL of zero disables the cache.
+
+    """
+    ttl = current_app.config.get('OAUTH_TOKEN_CACHE_TTL')
+    if not ttl or not token.access_token:
+        return
+    expires = None
+    if token.expires:
+        expires = calendar.timegm(token.expires.utctimetuple())
+        ttl = min(ttl, int(expires - time.time()))
+        if ttl <= 0:
+            return
+    data = {
+        'id': token.id, 'user_id': token.user_id,
+        'client_id': token.client_id, 'token_type': token.token_type,
+        'scopes': token._scopes, 'expires': expires}
+    try:
+        redis_client().setex(
+            _token_cache_key(token.access_token), ttl, json.dumps(data))
+    except redis.RedisError as e:
+        current_app.logger.error("failed to cache token: {}".format(e))
+
+
+def cached_token(access_token):
+    """Return CachedToken for access_token, or None if not cached"""
+    if not current_app.config.get('OAUTH_TOKEN_CACHE_TTL'):
+        return None
+    try:
+        data = redis_client().get(_token_cache_key(access_token))
+    except redis.RedisError as e:
+        current_app.logger.warn("unable to check token cache: {}".format(e))
+        return None
+    if data:
+        return CachedToken(access_token, json.loads(data))
+
+
+def invalidate_cached_tokens(access_tokens):
+    """Remove the given access tokens from the token cache"""
+    keys = [_token_cache_key(t) for t in access_tokens if t]
+    if not keys:
+        return
+    try:
+        redis_client().delete(*keys)
+    except redis.RedisError as e:
+        current_app.logger.error(
+            "failed to invalidate cached tokens: {}".format(e))
+
+
+def invalidate_user_tokens(user_id):
+    """Remove all of the user's access tokens from the token cache
+
+    NB - must be called prior to any bulk (query level) deletion of the
+    user's tokens, as that bypasses the session listeners below.
+
+    """
+    invalidate_cached_tokens(t[0] for t in db.session.query(
+        Token.access_token).filter(Token.user_id == user_id))
+
+
+@event.listens_for(Session, 'before_flush')
+def _token_flush_listener(session, flush_context, instances):
+    """Note changed or deleted tokens, and deactivated or deleted users
+
+    Collected prior to the flush, while tokens removed by cascade are
+    still found.  Invalidated once committed, or rolled back, as the
+    changes may have been cached mid transaction.
+
+    """
+    stale = session.info.setdefault('stale_tokens', set())
+    for obj in chain(session.dirty, session.deleted):
+        if isinstance(obj, Token):
+            stale.add(obj.access_token)
+        elif isinstance(obj, User) and (
+                obj in session.deleted or not obj.active or obj.deleted_id):
+            stale.update(t[0] for t in session.query(
+                Token.access_token).filter(Token.user_id == obj.id))
+    if not stale:
+        session.info.pop('stale_tokens')
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _token_commit_listener(session):
+    stale = session.info.pop('stale_tokens', None)
+    if stale:
+        invalidate_cached_tokens(stale)
+
+
 @oauth.clientgetter
 def load_client(client_id):
     return Client.query.filter_by(client_id=client_id).first()
@@ -301,8 +444,14 @@ def save_grant(client_id, code, request, *args, **kwargs):
 
 @oauth.tokengetter
 def load_token(access_token=None, refresh_token=None):
+    """Lookup token, for access tokens first checking the token cache"""
     if access_token:
-        return Token.query.filter_by(access_token=access_token).first()
+        token = cached_token(access_token)
+        if not token:
+            token = Token.query.filter_by(access_token=access_token).first()
+            if token:
+                cache_token(token)
+        return token
     elif refresh_token:
         return Token.query.filter_by(refresh_token=refresh_token).first()
 
@@ -332,9 +481,54 @@ def save_token(token, request, *args, **kwargs):
     )
     db.session.add(tok)
     db.session.commit()
+    cache_token(tok)
     return tok
 
 
+def purge_expired(batch_size=1000, as_of_date=None):
+    """Delete expired grants and tokens, in batches of batch_size
+
+    Tokens holding a refresh token are kept for the configured
+    `OAUTH_EXPIRED_TOKEN_RETENTION` beyond expiration, allowing clients
+    time to refresh.  Each batch is committed, to keep transactions (and
+    the locks they hold) short.
+
+    :param batch_size: maximum number of rows to delete per transaction
+    :param as_of_date: UTC datetime defining now, for testing
+    :return: dictionary with counts of deleted 'grants' and 'tokens'
+
+    """
+    now = as_of_date or datetime.utcnow()
+    retention = timedelta(seconds=current_app.config.get(
+        'OAUTH_EXPIRED_TOKEN_RETENTION', 0))
+    expired = {
+        'grants': Grant.expires < now,
+        'tokens': or_(
+            and_(Token.refresh_token.is_(None), Token.expires < now),
+            Token.expires < now - retention),
+    }
+    counts = {}
+    for name, cls in (('grants', Grant), ('tokens', Token)):
+        counts[name] = 0
+        while True:
+            columns = (cls.id, cls.access_token) if cls is Token else (
+                cls.id,)
+            batch = db.session.query(*columns).filter(
+                expired[name]).order_by(cls.expires).limit(batch_size).all()
+            if not batch:
+                break
+            cls.query.filter(cls.id.in_([row[0] for row in batch])).delete(
+                synchronize_session=False)
+            db.session.commit()
+            if cls is Token:
+                # bulk deletion bypasses the token cache listeners
+                invalidate_cached_tokens(row[1] for row in batch)
+            counts[name] += len(batch)
+            if len(batch) < batch_size:
+                break
+    return counts
+
+
 def validate_origin(origin):
     """Validate the origin is one we recognize
 
@@ -1,9 +1,15 @@
 """Communication model"""
 from collections import MutableMapping
+from datetime import datetime, timedelta
 from flask import current_app, url_for
 import regex
-from sqlalchemy import UniqueConstraint
+from requests.exceptions import RequestException
+import smtplib
+import socket
+from sqlalchemy import or_, UniqueConstraint
 from sqlalchemy.dialects.postgresql import ENUM
+from sqlalchemy.orm import joinedload
+import time
 
 from .assessment_status import AssessmentStatus  # avoid cycle
 from .app_text import MailResource
@@ -11,8 +17,10 @@ from ..audit import auditable_event
 from ..database import db
 from ..extensions import user_manager
 from .intervention import INTERVENTION
-from .message import EmailMessage
+from .message import EmailBatch, EmailMessage
+from .qb_timeline import user_qb_window
 from .questionnaire_bank import QuestionnaireBank
+from ..rate_limit import TokenBucket
 from ..trace import dump_trace, establish_trace, trace
 from .user import User
 
@@ -124,9 +132,8 @@ def load_template_args(user, questionnaire_bank_id=None):
         if not questionnaire_bank_id:
             return ''
         qb = QuestionnaireBank.query.get(questionnaire_bank_id)
-        trigger_date = qb.trigger_date(user)
-        due = (qb.calculated_overdue(trigger_date) or
-               qb.calculated_expiry(trigger_date))
+        window = user_qb_window(user, qb)
+        due = window.overdue or window.expiry
         return due.strftime('%-d %b %Y') if due else ''
 
     def _lookup_registrationlink():
@@ -164,6 +171,44 @@ def load_template_args(user, questionnaire_bank_id=None):
     return args
 
 
+# Dispatch priority classes - lower values are sent first
+MESSAGE_PRIORITY = {
+    'account': 0,  # i.e. password reset or account verification
+    'reminder': 10,
+}
+
+
+# Template variables linking to account actions, sent as 'account' messages
+ACCOUNT_VARIABLES = frozenset((
+    'password_reset_button', 'password_reset_link',
+    'verify_account_button', 'verify_account_link'))
+
+
+def message_priority(content_url):
+    """Returns the MESSAGE_PRIORITY for mail with content from `content_url`
+
+    Messages linking to a password reset or account verification are
+    'account' messages, the rest reminders.  The content is looked up
+    via the content cache; should it be unavailable, the message is
+    treated as a reminder.
+
+    """
+    try:
+        variables = MailResource(url=content_url).variable_list
+    except RequestException as e:
+        current_app.logger.error(
+            "unable to prioritize {}: {}".format(content_url, e))
+        variables = ()
+    if ACCOUNT_VARIABLES.intersection(variables):
+        return MESSAGE_PRIORITY['account']
+    return MESSAGE_PRIORITY['reminder']
+
+
+# Errors from losing the mail server connection, rather than the message
+SMTP_CONNECTION_ERRORS = (
+    smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, socket.error)
+
+
 class Communication(db.Model):
     """Model representing a FHIR-like Communication Resource
 
@@ -189,10 +234,24 @@ class Communication(db.Model):
         'email_messages.id', ondelete='cascade'), nullable=True)
     message = db.relationship('EmailMessage')
 
+    # See MESSAGE_PRIORITY - lower values are sent first
+    priority = db.Column(
+        db.Integer, nullable=False, default=MESSAGE_PRIORITY['reminder'],
+        server_default=str(MESSAGE_PRIORITY['reminder']))
+
+    # Failed send attempts, retried with exponential backoff until
+    # MAIL_MAX_ATTEMPTS, after which the status is set to 'aborted'
+    attempts = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
     __table_args__ = (
         UniqueConstraint(
             communication_request_id, user_id,
             name='_communication_request_user'),
+        db.Index(
+            'ix_communications_dispatch', status, priority, next_attempt_at),
     )
 
     def __str__(self):
@@ -204,8 +263,35 @@ class Communication(db.Model):
             'Communication for user {0.user_id}'
             ' of {0.communication_request.name}'.format(self))
 
+    def record_failure(self, error):
+        """Record a failed send attempt, scheduling any retry
+
+        Retries are delayed MAIL_RETRY_DELAY seconds, doubled with each
+        further attempt.  After MAIL_MAX_ATTEMPTS the communication is
+        dead lettered, its status set to 'aborted' to be sent no more.
+
+        """
+        config = current_app.config
+        self.attempts = (self.attempts or 0) + 1
+        self.last_error = str(error)
+        if self.attempts >= config.get('MAIL_MAX_ATTEMPTS', 1):
+            self.status = 'aborted'
+            self.next_attempt_at = None
+            current_app.logger.error(
+                "giving up on {} after {} attempts".format(
+                    self, self.attempts))
+            return
+        delay = config.get('MAIL_RETRY_DELAY', 0) * 2 ** (self.attempts - 1)
+        self.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+
     def generate_and_send(self):
         "Collate message details and send"
+        self.generate_message()
+        self.message.send_message()
+        self.status = 'completed'
+
+    def generate_message(self):
+        "Collate message details into self.message, ready to send"
 
         if current_app.config.get('DEBUG_EMAIL', False):
             # hack to restart trace when in loop from celery task
@@ -245,8 +331,150 @@ class Communication(db.Model):
             recipients=user.email,
             sender=current_app.config['DEFAULT_MAIL_SENDER'],
             user_id=user.id)
-        self.message.send_message()
-        self.status = 'completed'
+
+
+def ready_communications(query=None, as_of=None):
+    """Returns query for Communications due to be sent, in send order
+
+    Communications in 'preparation', other than those awaiting a retry,
+    ordered by priority class and then by age.
+
+    :param query: optional Communication query to restrict to
+    :param as_of: time to judge retries due at, defaults to now
+
+    """
+    if query is None:
+        query = Communication.query
+    as_of = as_of or datetime.utcnow()
+    return query.filter(
+        Communication.status == 'preparation',
+        or_(Communication.next_attempt_at.is_(None),
+            Communication.next_attempt_at <= as_of)).order_by(
+                Communication.priority, Communication.id)
+
+
+def dispatch_communications(query=None, batch_size=100):
+    """Send ready Communications in batches over pooled SMTP connections
+
+    Communications are sent in priority order (see `MESSAGE_PRIORITY`),
+    each batch generated and sent over a single mail server connection
+    (see `EmailBatch`), then committed along with the audit rows of all
+    messages in the batch.
+
+    Sending is rate limited, by the MAIL_RATE_LIMIT shared across all
+    workers, and per recipient by MAIL_RECIPIENT_RATE_LIMIT, deferring
+    messages to recipients over their limit.  Tokens for the shared
+    limit are taken for each batch before its connection is opened, so
+    any wait on the limit holds neither a connection nor a transaction;
+    batches are therefore no larger than MAIL_RATE_BURST.
+
+    A communication that fails to generate or send is scheduled for a
+    retry (see `Communication.record_failure`), so the rest of the
+    backlog still drains.  Should the mail server be unreachable or drop
+    the connection, the remainder is left for the next run, without
+    counting an attempt against any of it.
+
+    :param query: optional Communication query to restrict dispatch to,
+        defaults to all in 'preparation'
+    :param batch_size: most communications per connection and commit
+    :return: dictionary with `sent`, `failed`, `deferred` and `aborted`
+        (dead lettered) counts, and throughput in `seconds` and
+        `per_second`
+
+    """
+    config = current_app.config
+    ids = [c.id for c in ready_communications(query).with_entities(
+        Communication.id)]
+    rate_limit = TokenBucket(
+        'mail', rate=config.get('MAIL_RATE_LIMIT'),
+        capacity=config.get('MAIL_RATE_BURST', 1))
+
+    if rate_limit.rate:
+        batch_size = min(batch_size, rate_limit.capacity)
+
+    start = time.time()
+    counts = dict.fromkeys(('sent', 'failed', 'deferred', 'aborted'), 0)
+    for i in range(0, len(ids), batch_size):
+        batch_ids = ids[i:i + batch_size]
+        wait = rate_limit.take(len(batch_ids))
+        while wait:
+            time.sleep(wait)
+            wait = rate_limit.take(len(batch_ids))
+
+        communications = Communication.query.filter(
+            Communication.id.in_(batch_ids)).options(
+                joinedload('communication_request')).order_by(
+                    Communication.priority, Communication.id)
+        unavailable = False
+        try:
+            with EmailBatch() as batch:
+                for communication in communications:
+                    counts[_dispatch(communication, batch)] += 1
+        except (smtplib.SMTPException, socket.error) as e:
+            current_app.logger.error(
+                "mail server unavailable, dispatch stopped: {}".format(e))
+            unavailable = True
+        db.session.commit()
+        if unavailable:
+            break
+
+    counts['seconds'] = time.time() - start
+    counts['per_second'] = (
+        counts['sent'] / counts['seconds'] if counts['seconds'] else 0)
+    return counts
+
+
+def _dispatch(communication, batch):
+    """Generate and send communication within batch, returning outcome
+
+    The recipient's rate limit is checked first, so messages deferred on
+    it are never generated.
+
+    :return: 'sent', 'deferred' if the recipient is over their rate
+        limit, 'failed' if the attempt failed, or 'aborted' if it failed
+        for the last time
+
+    """
+    current_app.logger.debug(
+        "Collate ready communication {}".format(communication))
+
+    def discard_message():
+        message = communication.message
+        if message is not None:
+            communication.message = None
+            if message in db.session:
+                db.session.expunge(message)
+
+    try:
+        # Invalid addresses are left for `generate_message` to fail on
+        recipient = User.query.get(communication.user_id).email
+        if recipient and '@' in recipient:
+            recipient_limit = TokenBucket(
+                'mail-recipient:{}'.format(recipient),
+                rate=current_app.config.get('MAIL_RECIPIENT_RATE_LIMIT'),
+                capacity=current_app.config.get('MAIL_RECIPIENT_BURST', 1))
+            wait = recipient_limit.take()
+            if wait:
+                communication.next_attempt_at = (
+                    datetime.utcnow() + timedelta(seconds=wait))
+                return 'deferred'
+
+        communication.generate_message()
+        batch.send(communication.message)
+    except SMTP_CONNECTION_ERRORS:
+        # The connection is lost, not this message - the attempt isn't
+        # counted, and nothing more can be sent over the batch connection
+        discard_message()
+        raise
+    except Exception as e:
+        current_app.logger.error(
+            "failed to send {}: {}".format(communication, e))
+        discard_message()
+        communication.record_failure(e)
+        return 'aborted' if communication.status == 'aborted' else 'failed'
+    communication.status = 'completed'
+    communication.next_attempt_at = None
+    return 'sent'
 
 
 class DynamicDictLookup(MutableMapping):
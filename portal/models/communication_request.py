@@ -5,10 +5,11 @@ from sqlalchemy import UniqueConstraint
 from sqlalchemy.dialects.postgresql import ENUM
 
 from .assessment_status import overall_assessment_status
-from .communication import Communication
+from .communication import Communication, message_priority
 from ..database import db
 from ..date_tools import RelativeDelta
 from .identifier import Identifier
+from .qb_timeline import user_qb_window
 from .reference import Reference
 from ..system_uri import TRUENTH_CR_NAME
 from ..trace import trace
@@ -221,7 +222,8 @@ def queue_outstanding_messages(user, questionnaire_bank, iteration_count):
         communication = Communication(
             user_id=user.id,
             status='preparation',
-            communication_request_id=communication_request.id)
+            communication_request_id=communication_request.id,
+            priority=message_priority(communication_request.content_url))
         current_app.logger.debug(
             "communication prepared for {}".format(user.id))
         db.session.add(communication)
@@ -229,10 +231,9 @@ def queue_outstanding_messages(user, questionnaire_bank, iteration_count):
         return communication
 
     now = datetime.utcnow()
-    trigger_date = questionnaire_bank.trigger_date(user)
-    trace('trigger_date = {}'.format(trigger_date))
-    qbd = questionnaire_bank.calculated_start(trigger_date)
-    start = qbd.relative_start
+    window = user_qb_window(user, questionnaire_bank)
+    trace('trigger_date = {}'.format(window.trigger_date))
+    start = window.start
     if not start:
         trace("no relative start found, can't continue")
         return
@@ -250,7 +251,7 @@ def queue_outstanding_messages(user, questionnaire_bank, iteration_count):
             continue
 
         # The iteraction counts must match
-        if qbd.iteration != request.qb_iteration:
+        if window.iteration != request.qb_iteration:
             trace("iteration mismatch, request doesn't apply")
             continue
 
@@ -0,0 +1,226 @@
+"""Export Job module
+
+Large exports, such as all QuestionnaireResponses visible to a researcher,
+take too long to generate within a web request.  An ExportJob records
+such a request, which a celery task runs in the background, writing the
+compressed result to the upload area for later download.
+
+"""
+from datetime import datetime, timedelta
+from flask import current_app
+import gzip
+import json
+import os
+from uuid import uuid4
+
+from ..database import db
+from ..date_tools import FHIR_datetime
+from .fhir import annotated_responses, generate_qnr_csv
+from .reporting import calculate_reporting_stats
+from .user import User
+
+EXPORT_TYPES = ('assessment', 'reporting')
+EXPORT_FORMATS = {'assessment': ('csv', 'ndjson'), 'reporting': ('json',)}
+MIMETYPES = {
+    'csv': 'text/csv', 'ndjson': 'application/x-ndjson',
+    'json': 'application/json'}
+
+# Number of rows to write between progress updates
+PROGRESS_INTERVAL = 500
+
+
+class ExportJob(db.Model):
+    """ORM class for background export requests and their results"""
+    __tablename__ = 'export_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    export_type = db.Column(db.Text, nullable=False)
+    format = db.Column(db.Text, nullable=False)
+    params = db.Column(db.JSON, nullable=True)
+    status = db.Column(db.Text, nullable=False, default='queued')
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    message = db.Column(db.Text, nullable=True)
+    task_id = db.Column(db.Text, nullable=True)
+    uuid = db.Column(db.Text, nullable=True)
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+    user = db.relationship(User)
+
+    def __str__(self):
+        return "export_job {0.id} ({0.export_type} {0.format}: " \
+               "{0.status})".format(self)
+
+    @classmethod
+    def from_request(cls, user, export_type, export_format, params=None):
+        """Validate and return a new, queued job
+
+        :raises ValueError: if the type or format aren't supported
+
+        """
+        if export_type not in EXPORT_TYPES:
+            raise ValueError("unsupported export type {}".format(export_type))
+        export_format = export_format or EXPORT_FORMATS[export_type][0]
+        if export_format not in EXPORT_FORMATS[export_type]:
+            raise ValueError("format must be one of: " + ", ".join(
+                EXPORT_FORMATS[export_type]))
+        return cls(
+            user_id=user.id, export_type=export_type, format=export_format,
+            params=params or {}, status='queued', progress=0)
+
+    @property
+    def filename(self):
+        """Name for the downloaded file"""
+        return "{0.export_type}-{0.id}.{0.format}.gz".format(self)
+
+    @property
+    def mimetype(self):
+        return MIMETYPES[self.format]
+
+    @property
+    def expires_at(self):
+        """UTC datetime the job and its file expire, None if not finished"""
+        if not self.completed_at:
+            return None
+        return self.completed_at + export_retention()
+
+    def expired(self, as_of_date=None):
+        """True once the job's retention has passed"""
+        expires_at = self.expires_at
+        return bool(
+            expires_at and expires_at < (as_of_date or datetime.utcnow()))
+
+    def file_path(self):
+        """Path to the job's (compressed) result file, None if N/A"""
+        if not self.uuid:
+            return None
+        return os.path.join(
+            current_app.root_path, current_app.config.get("FILE_UPLOAD_DIR"),
+            'exports', self.uuid)
+
+    def as_json(self):
+        d = {}
+        d['id'] = self.id
+        d['resourceType'] = 'ExportJob'
+        d['user_id'] = self.user_id
+        d['export_type'] = self.export_type
+        d['format'] = self.format
+        d['params'] = self.params
+        d['status'] = self.status
+        d['progress'] = self.progress
+        if self.message:
+            d['message'] = self.message
+        for attr in (
+                'created_at', 'started_at', 'completed_at', 'expires_at'):
+            if getattr(self, attr):
+                d[attr] = FHIR_datetime.as_fhir(getattr(self, attr))
+        if self.status == 'complete':
+            d['filename'] = self.filename
+        return d
+
+    def run(self):
+        """Generate the export, recording progress and status as it goes
+
+        Any exception is recorded on the job as a failure, after which
+        the job is committed and the exception raised.
+
+        """
+        self.status = 'running'
+        self.started_at = datetime.utcnow()
+        self.uuid = str(uuid4())
+        db.session.commit()
+
+        path = self.file_path()
+        count = 0
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with gzip.open(path, 'wb') as output:
+                for count, chunk in enumerate(self.generate(), 1):
+                    output.write(
+                        chunk.encode('utf-8') if isinstance(chunk, unicode)
+                        else chunk)
+                    if count % PROGRESS_INTERVAL == 0:
+                        self.record_progress(count)
+            self.progress = count
+            self.status = 'complete'
+        except Exception as e:
+            db.session.rollback()
+            if os.path.exists(path):
+                os.remove(path)
+            self.status = 'failed'
+            self.uuid = None
+            self.message = str(e)
+            raise
+        finally:
+            self.completed_at = datetime.utcnow()
+            db.session.commit()
+
+    def generate(self):
+        """Generate the export content, in chunks of text"""
+        if self.export_type == 'reporting':
+            yield json.dumps(
+                calculate_reporting_stats(), default=FHIR_datetime.as_fhir)
+            return
+
+        documents = annotated_responses(
+            instrument_ids=self.params.get('instrument_ids'),
+            current_user=self.user)
+        if self.format == 'csv':
+            for row in generate_qnr_csv({'entry': documents}):
+                yield row
+        else:
+            for document in documents:
+                yield json.dumps(document) + '\n'
+
+    def record_progress(self, count):
+        """Record progress outside the job's transaction
+
+        A separate connection is used, as committing the session would
+        close the server side cursor the export is reading from.
+
+        """
+        db.engine.execute(ExportJob.__table__.update().where(
+            ExportJob.id == self.id).values(progress=count))
+
+
+def export_retention():
+    """Time finished jobs and their files are kept, as configured"""
+    return timedelta(seconds=current_app.config.get(
+        'EXPORT_JOB_RETENTION', 0))
+
+
+def purge_expired_exports(batch_size=1000, as_of_date=None):
+    """Delete finished export jobs past retention, along with their files
+
+    Each batch is committed, as done for `auth.purge_expired`.
+
+    :param batch_size: maximum number of jobs to delete per transaction
+    :param as_of_date: UTC datetime defining now, for testing
+    :return: dictionary with counts of deleted 'jobs' and 'files'
+
+    """
+    now = as_of_date or datetime.utcnow()
+    counts = {'jobs': 0, 'files': 0}
+    while True:
+        batch = ExportJob.query.filter(
+            ExportJob.completed_at < now - export_retention()).order_by(
+                ExportJob.completed_at).limit(batch_size).all()
+        if not batch:
+            break
+        for job in batch:
+            path = job.file_path()
+            if path and os.path.exists(path):
+                os.remove(path)
+                counts['files'] += 1
+        ExportJob.query.filter(
+            ExportJob.id.in_([job.id for job in batch])).delete(
+                synchronize_session=False)
+        db.session.commit()
+        counts['jobs'] += len(batch)
+        if len(batch) < batch_size:
+            break
+    return counts
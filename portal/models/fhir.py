@@ -2,7 +2,7 @@
 from datetime import datetime
 from html.parser import HTMLParser
 import json
-from sqlalchemy import UniqueConstraint, or_
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.dialects.postgresql import JSONB, ENUM
 import requests
 
@@ -10,7 +10,6 @@ from ..database import db
 from ..date_tools import as_fhir, FHIR_datetime
 from .lazy import lazyprop
 from .organization import OrgTree
-from .reference import Reference
 from ..system_uri import TRUENTH_CLINICAL_CODE_SYSTEM
 from ..system_uri import TRUENTH_ENCOUNTER_CODE_SYSTEM, TRUENTH_VALUESET
 from ..system_uri import TRUENTH_EXTERNAL_STUDY_SYSTEM
@@ -485,11 +484,32 @@ class QuestionnaireResponse(db.Model):
         default=default_authored
     )
 
+    # Name of the referenced questionnaire, kept in sync with the
+    # document for indexed lookups - see `questionnaire_name_from`
+    questionnaire_name = db.Column(db.Text, index=True)
+
+    __table_args__ = (
+        db.Index('ix_questionnaire_responses_subject_questionnaire',
+                 'subject_id', 'questionnaire_name'),
+    )
+
     def __str__(self):
         """Print friendly format for logging, etc."""
         return "QuestionnaireResponse {0.id} for user {0.subject_id} "\
                 "{0.status} {0.authored}".format(self)
 
+    @staticmethod
+    def questionnaire_name_from(document):
+        """Extract the questionnaire name from the document's reference"""
+        reference = (document or {}).get(
+            'questionnaire', {}).get('reference')
+        return reference.split('/')[-1] if reference else None
+
+    @db.validates('document')
+    def validate_document(self, key, document):
+        self.questionnaire_name = self.questionnaire_name_from(document)
+        return document
+
 def aggregate_responses(instrument_ids, current_user):
     """Build a bundle of QuestionnaireResponses
 
@@ -497,53 +517,104 @@ def aggregate_responses(instrument_ids, current_user):
     :param current_user: user making request, necessary to restrict results
         to list of patients the current_user has permission to see
 
+    """
+    annotated_questionnaire_responses = list(annotated_responses(
+        instrument_ids=instrument_ids, current_user=current_user))
+
+    bundle = {
+        'resourceType':'Bundle',
+        'updated':FHIR_datetime.now(),
+        'total':len(annotated_questionnaire_responses),
+        'type': 'searchset',
+        'entry':annotated_questionnaire_responses,
+    }
+
+    return bundle
+
+
+def annotated_responses(instrument_ids, current_user, batch_size=500):
+    """Generate QuestionnaireResponse documents annotated for export
+
+    Yields the documents `aggregate_responses` bundles, most recently
+    authored first, without holding them all in memory.  Responses are
+    read through a server side cursor, `batch_size` rows at a time, and
+    the encounter and subject details for each batch are gathered in a
+    few queries.  The stored documents are copied, not modified.
+
+    :param instrument_ids: list of instrument_ids to restrict results to
+    :param current_user: user making request, necessary to restrict results
+        to list of patients the current_user has permission to see
+    :param batch_size: number of responses to fetch and annotate at a time
+
     """
     # Gather up the patient IDs for whom current user has 'view' permission
     user_ids = OrgTree().visible_patients(current_user)
 
-    annotated_questionnaire_responses = []
     questionnaire_responses = QuestionnaireResponse.query.filter(
         QuestionnaireResponse.subject_id.in_(user_ids)).order_by(
-            QuestionnaireResponse.authored.desc())
+            QuestionnaireResponse.authored.desc()).with_entities(
+                QuestionnaireResponse.subject_id,
+                QuestionnaireResponse.encounter_id,
+                QuestionnaireResponse.document).execution_options(
+                    stream_results=True).yield_per(batch_size)
 
     if instrument_ids:
-        instrument_filters = (
-            QuestionnaireResponse.document[
-                ("questionnaire", "reference")
-            ].astext.endswith(instrument_id)
-            for instrument_id in instrument_ids
-        )
-        questionnaire_responses = questionnaire_responses.filter(or_(*instrument_filters))
-
-    patient_fields = ("careProvider", "identifier")
-
-    for questionnaire_response in questionnaire_responses:
-        subject = questionnaire_response.subject
-        encounter = questionnaire_response.encounter
-        encounter_fhir = encounter.as_fhir()
-        questionnaire_response.document["encounter"] = encounter_fhir
-
-        questionnaire_response.document["subject"] = {
-            k:v for k,v in subject.as_fhir().items() if k in patient_fields
-        }
+        questionnaire_responses = questionnaire_responses.filter(
+            QuestionnaireResponse.questionnaire_name.in_(instrument_ids))
 
-        if subject.organizations:
-            questionnaire_response.document["subject"]["careProvider"] = [
-                Reference.organization(org.id).as_fhir()
-                for org in subject.organizations
-            ]
+    subjects = {}
+    batch = []
+    for row in questionnaire_responses:
+        batch.append(row)
+        if len(batch) == batch_size:
+            for document in _annotate_batch(batch, subjects):
+                yield document
+            batch = []
+    for document in _annotate_batch(batch, subjects):
+        yield document
 
-        annotated_questionnaire_responses.append(questionnaire_response.document)
 
-    bundle = {
-        'resourceType':'Bundle',
-        'updated':FHIR_datetime.now(),
-        'total':len(annotated_questionnaire_responses),
-        'type': 'searchset',
-        'entry':annotated_questionnaire_responses,
-    }
+def _annotate_batch(rows, subjects):
+    """Annotate a batch of (subject_id, encounter_id, document) rows
+
+    :param rows: batch of rows to annotate
+    :param subjects: dictionary of previously built subject details,
+        keyed by user id, extended with any new subjects in the batch
+    :return: list of annotated document copies
+
+    """
+    # local to avoid cyclic import
+    from .encounter import Encounter
+    from .user import User, patients_as_fhir
+
+    if not rows:
+        return []
+
+    # Loading the users the encounters reference places them in the
+    # session's identity map, sparing `Encounter.as_fhir` a query each.
+    # Held until the encounters are serialized, once each per batch.
+    encounters = Encounter.query.filter(
+        Encounter.id.in_(set(row[1] for row in rows))).all()
+    users = User.query.filter(
+        User.id.in_(set(e.user_id for e in encounters))).all()
+    encounters = {e.id: e.as_fhir() for e in encounters}
+    del users
+
+    new_ids = set(row[0] for row in rows) - set(subjects)
+    if new_ids:
+        patient_fields = ('careProvider', 'identifier')
+        for user_id, patient in patients_as_fhir(new_ids).items():
+            subjects[user_id] = {
+                k: v for k, v in patient.items() if k in patient_fields}
+
+    annotated = []
+    for subject_id, encounter_id, document in rows:
+        document = dict(document)
+        document['encounter'] = encounters[encounter_id]
+        document['subject'] = subjects[subject_id]
+        annotated.append(document)
+    return annotated
 
-    return bundle
 
 def generate_qnr_csv(qnr_bundle):
     """Generate a CSV from a bundle of QuestionnaireResponses"""
@@ -564,6 +635,8 @@ def generate_qnr_csv(qnr_bundle):
 
     def strip_tags(html):
         """Strip HTML tags from strings. Inserts replacement whitespace if necessary."""
+        if html is None:
+            return None
 
         s = HTMLStripper()
         s.feed(html)
@@ -108,11 +108,12 @@ class Intervention(db.Model):
 
         Strategies need to be brought to life from their persisted
         state.  This generator does so, and returns them in a call
-        ready fashion, ordered by the strategy's rank.
+        ready fashion, ordered by the strategy's rank.  Instantiated
+        strategies are cached, see `AccessStrategy.compiled`.
 
         """
         for strat in self.access_strategies:
-            func = strat.instantiate()
+            func = strat.compiled()
             yield func
 
     def display_for_user(self, user):
@@ -192,6 +193,48 @@ class Intervention(db.Model):
 
         return False
 
+    def users_with_access(self, user_ids, chunk_size=1000):
+        """Return the subset of user_ids with access to the intervention
+
+        Equivalent to `quick_access_check` for each of the given users,
+        but resolves UserIntervention grants in a single query, and
+        evaluates strategies defining a `batch` function with a query
+        per strategy.  Remaining strategies are called for each user yet
+        to be granted access, loaded in chunks.
+
+        :param user_ids: iterable of user ids to consider
+        :param chunk_size: maximum number of users to load at a time
+        :return: set of user ids with access
+
+        """
+        from .user import User  # local to avoid cyclic import
+        user_ids = set(user_ids)
+        if self.public_access or not user_ids:
+            return user_ids
+
+        granted = set(r[0] for r in db.session.query(
+            UserIntervention.user_id).filter(and_(
+                UserIntervention.intervention_id == self.id,
+                UserIntervention.access == 'granted',
+                UserIntervention.user_id.in_(user_ids))))
+
+        for func in self.fetch_strategies():
+            remaining = user_ids - granted
+            if not remaining:
+                break
+            if func.__name__ == 'update_user_card_html':
+                return user_ids
+            if hasattr(func, 'batch'):
+                granted |= func.batch(intervention=self, user_ids=remaining)
+                continue
+            remaining = sorted(remaining)
+            for i in range(0, len(remaining), chunk_size):
+                chunk = remaining[i:i + chunk_size]
+                granted |= set(
+                    user.id for user in User.query.filter(User.id.in_(chunk))
+                    if func(intervention=self, user=user))
+        return granted
+
 
     def __str__(self):
         """print details needed in audit logs"""
@@ -205,6 +248,23 @@ class Intervention(db.Model):
                 "status_text: {0.status_text}".format(self))
 
 
+def access_matrix(user_ids, interventions=None):
+    """Return the users with access to each intervention
+
+    :param user_ids: iterable of user ids to consider
+    :param interventions: interventions to check, defaults to all
+    :return: dictionary keyed by intervention id, of the set of user ids
+        with access, see `Intervention.users_with_access`
+
+    """
+    user_ids = set(user_ids)
+    if interventions is None:
+        interventions = Intervention.query.all()
+    return {
+        intervention.id: intervention.users_with_access(user_ids)
+        for intervention in interventions}
+
+
 access_types = ('forbidden', 'granted')
 access_types_enum = ENUM(*access_types, name='access', create_type=False)
 
@@ -12,22 +12,35 @@ False does not.
 NB - several functions are closures returning access_strategy functions with
 the parameters given to the closures.
 
+Strategy functions may also define a `batch` attribute, a function taking
+named parameters (intervention, user_ids) and returning the set of those
+user ids granted access, for efficient evaluation over many users.  See
+`Intervention.users_with_access`.
+
 """
-from flask import current_app, url_for
+from flask import current_app, g, has_app_context, url_for
 from flask_babel import gettext as _
+import hashlib
+from itertools import chain
 import json
-from sqlalchemy import and_, UniqueConstraint
+import redis
+from sqlalchemy import and_, event, func as sql_func, UniqueConstraint
 from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import Session
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 import sys
 
 from ..database import db
-from .fhir import CC, Coding, CodeableConcept
+from .fhir import CC, Coding, CodeableConcept, Observation, UserObservation
 from .identifier import Identifier
 from .intervention import Intervention, INTERVENTION, UserIntervention
 from .organization import Organization, OrgTree, OrganizationIdentifier
-from .procedure_codes import known_treatment_started
+from .organization import UserOrganization
+from .procedure import Procedure
+from .procedure_codes import known_treatment_started, TxStartedConstants
+from ..redis_client import redis_client
 from .role import Role
+from .user import UserRoles
 from ..system_uri import DECISION_SUPPORT_GROUP, TRUENTH_CLINICAL_CODE_SYSTEM
 
 
@@ -100,6 +113,26 @@ def limit_by_clinic_w_id(
                  intervention=intervention.name)
             return True
 
+    def users_registered_with_clinics(intervention, user_ids):
+        query = db.session.query(UserOrganization.user_id).filter(and_(
+            UserOrganization.user_id.in_(user_ids),
+            UserOrganization.organization_id.in_(required)))
+        if combinator == 'all':
+            query = query.group_by(UserOrganization.user_id).having(
+                sql_func.count(UserOrganization.organization_id.distinct())
+                == len(required))
+        return set(r[0] for r in query)
+
+    if not required:
+        # Nothing to query; 'all' of none is trivially satisfied
+        user_registered_with_all_clinics.batch = (
+            lambda intervention, user_ids: set(user_ids))
+        user_registered_with_any_clinics.batch = (
+            lambda intervention, user_ids: set())
+    else:
+        user_registered_with_all_clinics.batch = users_registered_with_clinics
+        user_registered_with_any_clinics.batch = users_registered_with_clinics
+
     return user_registered_with_all_clinics if combinator == 'all' else\
         user_registered_with_any_clinics
 
@@ -143,6 +176,15 @@ def not_in_clinic_w_id(
                  intervention=intervention.name)
             return True
 
+    def users_not_registered_with_clinics(intervention, user_ids):
+        if not dont_want:
+            return set(user_ids)
+        return set(user_ids) - set(r[0] for r in db.session.query(
+            UserOrganization.user_id).filter(and_(
+                UserOrganization.user_id.in_(user_ids),
+                UserOrganization.organization_id.in_(dont_want))))
+
+    user_not_registered_with_clinics.batch = users_not_registered_with_clinics
     return user_not_registered_with_clinics
 
 
@@ -159,15 +201,19 @@ def in_role_list(role_list):
         except MultipleResultsFound:
             raise ValueError("more than one role named '{}'"
                              "found".format(role))
-    required = set(roles)
+    required = set(r.id for r in roles)
 
     def user_has_given_role(intervention, user):
-        has = set(user.roles)
+        has = set(r.id for r in user.roles)
         if has.intersection(required):
             _log(result=True, func_name='in_role_list', user=user,
                  intervention=intervention.name)
             return True
 
+    def users_with_given_role(intervention, user_ids):
+        return _users_with_roles(user_ids, required)
+
+    user_has_given_role.batch = users_with_given_role
     return user_has_given_role
 
 
@@ -184,29 +230,50 @@ def not_in_role_list(role_list):
         except MultipleResultsFound:
             raise ValueError("more than one role named '{}'"
                              "found".format(role))
-    dont_want = set(roles)
+    dont_want = set(r.id for r in roles)
 
     def user_not_given_role(intervention, user):
-        has = set(user.roles)
+        has = set(r.id for r in user.roles)
         if has.isdisjoint(dont_want):
             _log(result=True, func_name='not_in_role_list', user=user,
                  intervention=intervention.name)
             return True
 
+    def users_not_given_role(intervention, user_ids):
+        return set(user_ids) - _users_with_roles(user_ids, dont_want)
+
+    user_not_given_role.batch = users_not_given_role
     return user_not_given_role
 
 
+def _users_with_roles(user_ids, role_ids):
+    """Returns the subset of user_ids having any of the given role_ids"""
+    if not role_ids:
+        return set()
+    return set(r[0] for r in db.session.query(UserRoles.user_id).filter(and_(
+        UserRoles.user_id.in_(user_ids), UserRoles.role_id.in_(role_ids))))
+
+
 def allow_if_not_in_intervention(intervention_name):
     """Strategy API checks user does not belong to named intervention"""
 
-    exclusive_intervention = getattr(INTERVENTION, intervention_name)
+    # validate the name now, but look up on use, as the strategy may
+    # outlive the session the intervention was loaded in
+    getattr(INTERVENTION, intervention_name)
 
     def user_not_in_intervention(intervention, user):
+        exclusive_intervention = getattr(INTERVENTION, intervention_name)
         if not exclusive_intervention.quick_access_check(user):
             _log(result=True, func_name='user_not_in_intervention', user=user,
                  intervention=intervention.name)
             return True
 
+    def users_not_in_intervention(intervention, user_ids):
+        exclusive_intervention = getattr(INTERVENTION, intervention_name)
+        return set(user_ids) - exclusive_intervention.users_with_access(
+            user_ids)
+
+    user_not_in_intervention.batch = users_not_in_intervention
     return user_not_in_intervention
 
 
@@ -509,6 +576,18 @@ def tx_begun(boolean_value):
 
     def user_has_desired_tx(intervention, user):
         return check_func(user)
+
+    def users_with_desired_tx(intervention, user_ids):
+        cc_ids = set(cc.id for cc in TxStartedConstants())
+        started = set(r[0] for r in db.session.query(
+            Procedure.user_id).filter(and_(
+                Procedure.user_id.in_(user_ids),
+                Procedure.code_id.in_(cc_ids))))
+        if boolean_value == 'true':
+            return started
+        return set(user_ids) - started
+
+    user_has_desired_tx.batch = users_with_desired_tx
     return user_has_desired_tx
 
 
@@ -532,20 +611,34 @@ def observation_check(display, boolean_value):
         raise ValueError("codeable_concept'{}' not found".format(coding))
 
     if boolean_value == 'true':
-        vq = CC.TRUE_VALUE
+        vq_id = CC.TRUE_VALUE.id
     elif boolean_value == 'false':
-        vq = CC.FALSE_VALUE
+        vq_id = CC.FALSE_VALUE.id
     else:
         raise ValueError("boolean_value must be 'true' or 'false'")
 
     def user_has_matching_observation(intervention, user):
         obs = [o for o in user.observations if o.codeable_concept_id == cc_id]
-        if obs and obs[0].value_quantity == vq:
+        if obs and obs[0].value_quantity_id == vq_id:
             _log(result=True, func_name='observation_check', user=user,
                  intervention=intervention.name,
-                 message='{}:{}'.format(coding.display, vq.value))
+                 message='{}:{}'.format(display, boolean_value))
             return True
 
+    def users_with_matching_observation(intervention, user_ids):
+        # As above, only the first matching observation per user counts
+        query = db.session.query(
+            UserObservation.user_id, Observation.value_quantity_id).join(
+            Observation).filter(and_(
+                UserObservation.user_id.in_(user_ids),
+                Observation.codeable_concept_id == cc_id)).order_by(
+            UserObservation.user_id, UserObservation.id)
+        first = {}
+        for user_id, value_quantity_id in query:
+            first.setdefault(user_id, value_quantity_id)
+        return set(u for u, v in first.items() if v == vq_id)
+
+    user_has_matching_observation.batch = users_with_matching_observation
     return user_has_matching_observation
 
 
@@ -613,6 +706,30 @@ def combine_strategies(**kwargs):
             intervention=intervention.name)
         return
 
+    def call_all_combined_batch(intervention, user_ids):
+        remaining = set(user_ids)
+        for strategy in strats:
+            if not remaining:
+                break
+            remaining = strategy.batch(
+                intervention=intervention, user_ids=remaining)
+        return remaining
+
+    def call_any_combined_batch(intervention, user_ids):
+        granted = set()
+        for strategy in strats:
+            remaining = set(user_ids) - granted
+            if not remaining:
+                break
+            granted |= strategy.batch(
+                intervention=intervention, user_ids=remaining)
+        return granted
+
+    # Batch evaluation only possible if supported by all combined
+    if all(hasattr(strategy, 'batch') for strategy in strats):
+        call_all_combined.batch = call_all_combined_batch
+        call_any_combined.batch = call_any_combined_batch
+
     combinator = kwargs.get('combinator', 'all')
     if combinator == 'any':
         return call_any_combined
@@ -714,3 +831,102 @@ class AccessStrategy(db.Model):
         for argset in details['kwargs']:
             kwargs[argset['name']] = argset['value']
         return func(**kwargs)
+
+    def compiled(self):
+        """Return the instantiated strategy function, cached per process
+
+        Instantiation may be expensive (i.e. `limit_by_clinic_w_id` queries
+        identifiers and walks the OrgTree), so the resulting functions are
+        kept, keyed by id and a hash of the function_details, until
+        `invalidate_compiled_strategies` is called in any process.
+
+        """
+        if self.id is None:
+            return self.instantiate()
+        check_compiled_version()
+        key = (self.id, hashlib.sha1(
+            self.function_details.encode('utf-8')).hexdigest())
+        if key not in _compiled:
+            _compiled[key] = self.instantiate()
+        return _compiled[key]
+
+
+ACCESS_STRATEGY_VERSION_KEY = '{}:access_strategy_version'.format(__name__)
+
+# Compiled strategy functions, keyed by (strategy id, function_details hash)
+_compiled = {}
+_compiled_version = None
+
+
+def invalidate_compiled_strategies():
+    """Invalidate compiled strategies on strategy, org or role changes
+
+    Bumps the shared version, so every process recompiles its strategies
+    on next use.
+
+    """
+    global _compiled_version
+    _compiled.clear()
+    if not has_app_context():
+        return
+    try:
+        _compiled_version = str(
+            redis_client().incr(ACCESS_STRATEGY_VERSION_KEY))
+    except redis.RedisError as e:
+        current_app.logger.error(
+            "failed to bump shared access strategy version: {}".format(e))
+
+
+def check_compiled_version():
+    """Drop compiled strategies if invalidated in any process
+
+    Compares the version stamp shared via redis with the one in effect
+    when the strategies were compiled.  Only checked once per request
+    (or app context).
+
+    """
+    global _compiled_version
+    if not has_app_context() or g.get('access_strategy_version_checked'):
+        return
+    g.access_strategy_version_checked = True
+    try:
+        version = redis_client().get(ACCESS_STRATEGY_VERSION_KEY)
+    except redis.RedisError as e:
+        current_app.logger.warn(
+            "unable to check shared access strategy version: {}".format(e))
+        return
+    if version != _compiled_version:
+        _compiled.clear()
+        _compiled_version = version
+
+
+# Changes to these may alter the result of instantiating a strategy
+_STRATEGY_CLASSES = (
+    AccessStrategy, Identifier, Organization, OrganizationIdentifier, Role)
+
+
+@event.listens_for(Session, 'after_flush')
+def _flush_listener(session, flush_context):
+    """Note changes to strategy data, invalidated once committed
+
+    Objects only dirty by way of collections, such as an organization
+    gaining users via the backref, are ignored.
+
+    """
+    dirty = (o for o in session.dirty if session.is_modified(
+        o, include_collections=False))
+    for obj in chain(session.new, dirty, session.deleted):
+        if isinstance(obj, _STRATEGY_CLASSES):
+            session.info['access_strategy_changes'] = True
+            break
+
+
+@event.listens_for(Session, 'after_commit')
+def _commit_listener(session):
+    if session.info.pop('access_strategy_changes', None):
+        invalidate_compiled_strategies()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _rollback_listener(session):
+    session.info.pop('access_strategy_changes', None)
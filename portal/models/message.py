@@ -4,6 +4,8 @@ from textwrap import fill
 from flask import current_app
 from flask_mail import Message
 from flask_mail import email_dispatched
+import smtplib
+import socket
 
 from ..audit import auditable_event
 from ..database import db
@@ -75,27 +77,89 @@ class EmailMessage(db.Model):
         return '{header}{body}{footer}'.format(
             header=EMAIL_HEADER, body=body, footer=EMAIL_FOOTER)
 
-    def send_message(self):
+    def mail_message(self):
+        """Returns the flask_mail Message to send"""
         message = Message(
             subject=self.subject,
             sender=current_app.config['DEFAULT_MAIL_SENDER'],
             recipients=self.recipients.split())
         body = self.style_message(self.body)
         message.html = fill(body, width=280)
-        mail.send(message)
+        return message
+
+    def send_message(self):
+        mail.send(self.mail_message())
 
-        user = User.query.filter_by(email='__system__').first()
-        user_id = user.id if user else None
+        user_id = system_user_id()
         recipient = self.recipients.split()[0]
         subject = User.query.filter_by(email=recipient).first()
         subject_id = subject.id if subject else self.user_id
+        self.audit_send(user_id=user_id, subject_id=subject_id)
 
+    def audit_send(self, user_id, subject_id, commit=True):
+        """Record the auditable event of sending this message"""
         if user_id and subject_id:
             audit_msg = ("EmailMessage '{0.subject}' sent to "
                          "{0.recipients} from {0.sender}".format(self))
             auditable_event(message=audit_msg, user_id=user_id,
-                            subject_id=subject_id, context="user")
+                            subject_id=subject_id, context="user",
+                            commit=commit)
 
     def __str__(self):
         return "EmailMessage subj:{} sent_at:{}".format(self.subject,
                                                         self.sent_at)
+
+
+def system_user_id():
+    """Returns id of the '__system__' user, credited with sent messages"""
+    user = User.query.filter_by(email='__system__').first()
+    return user.id if user else None
+
+
+class EmailBatch(object):
+    """Send many EmailMessages over a single SMTP connection
+
+    Rather than connecting to the mail server for each message, as
+    `EmailMessage.send_message` does, messages sent within the batch
+    share one connection.  The '__system__' user is looked up once, and
+    audit rows are left for the caller to commit with the batch.
+
+    Usage::
+
+        with EmailBatch() as batch:
+            for email in emails:
+                batch.send(email)
+        db.session.commit()
+
+    """
+    def __init__(self):
+        self.system_user_id = system_user_id()
+        self._connection = None
+        self.sent = 0
+
+    def __enter__(self):
+        self._connection = mail.connect().__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        connection, self._connection = self._connection, None
+        try:
+            return connection.__exit__(exc_type, exc_value, tb)
+        except (smtplib.SMTPException, socket.error) as e:
+            # Messages sent were accepted by the server already; a failed
+            # quit mustn't keep them from being committed as sent
+            current_app.logger.warning(
+                "failed to close mail connection: {}".format(e))
+
+    def send(self, email):
+        """Send EmailMessage over the batch connection
+
+        Messages are audited as by `EmailMessage.send_message`, with the
+        message's user as subject, without a commit.
+
+        """
+        self._connection.send(email.mail_message())
+        email.audit_send(
+            user_id=self.system_user_id, subject_id=email.user_id,
+            commit=False)
+        self.sent += 1
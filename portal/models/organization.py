@@ -3,10 +3,12 @@
 Designed around FHIR guidelines for representation of organizations, locations
 and healthcare services which are used to describe hospitals and clinics.
 """
+from collections import defaultdict
 from datetime import datetime
-from sqlalchemy import UniqueConstraint, and_
+import redis
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.ext.hybrid import hybrid_property
-from flask import current_app, url_for
+from flask import current_app, g, has_app_context, url_for
 from werkzeug.exceptions import Unauthorized
 
 import address
@@ -17,6 +19,7 @@ from ..date_tools import FHIR_datetime
 from .extension import CCExtension
 from .identifier import Identifier
 from .reference import Reference
+from ..redis_client import redis_client
 from .role import Role, ROLE
 from .telecom import ContactPoint, Telecom
 
@@ -370,6 +373,25 @@ class UserOrganization(db.Model):
 
     organization = db.relationship('Organization')
 
+
+class OrganizationClosure(db.Model):
+    """Closure table for the organization hierarchy
+
+    One row for every (ancestor, descendant) pair in the OrgTree, including
+    each organization paired with itself at depth 0.  Enables queries to
+    join on the hierarchy directly.  Maintained from the OrgTree, see
+    `OrgTree.refresh_closure_table()`
+
+    """
+    __tablename__ = 'organization_closure'
+    ancestor_id = db.Column(db.ForeignKey(
+        'organizations.id', ondelete='cascade'), primary_key=True)
+    descendant_id = db.Column(db.ForeignKey(
+        'organizations.id', ondelete='cascade'), primary_key=True,
+        index=True)
+    depth = db.Column(db.Integer, nullable=False)
+
+
 class OrganizationAddress(db.Model):
     """link table for organization : n addresses"""
     __tablename__ = 'organization_addresses'
@@ -396,6 +418,9 @@ class OrganizationIdentifier(db.Model):
         name='_organization_identifier'),)
 
 
+ORG_TREE_VERSION_KEY = '{}:org_tree_version'.format(__name__)
+
+
 class OrgNode(object):
     """Node in tree of organizations - used by org tree
 
@@ -409,6 +434,8 @@ class OrgNode(object):
         self.id = id  # root node alone has id = None
         self.parent = parent
         self.children = children if children else {}
+        # nested set interval, see OrgTree.index_intervals()
+        self.left = self.right = None
         if self.id is None:
             assert self.parent is None
 
@@ -476,9 +503,12 @@ class OrgTree(object):
     """
     root = None
     lookup_table = None
+    preorder = None
+    version = None  # shared version of the org hierarchy at last build
 
     def __init__(self):
         # Maintain a singleton root object and lookup_table
+        self.check_version()
         if not OrgTree.root:
             self.__reset_cache()
 
@@ -490,28 +520,113 @@ class OrgTree(object):
 
     @classmethod
     def invalidate_cache(cls):
-        """Invalidate cache on org changes"""
+        """Invalidate cache on org changes
+
+        Bumps the shared version, so every process rebuilds its tree on
+        next use.  Also rewrites the closure table, if configured for use
+        by `ORG_CLOSURE_TABLE`.
+
+        """
         cls.root = None
+        try:
+            cls.version = str(redis_client().incr(ORG_TREE_VERSION_KEY))
+        except redis.RedisError as e:
+            current_app.logger.error(
+                "failed to bump shared OrgTree version: {}".format(e))
+        if current_app.config.get('ORG_CLOSURE_TABLE'):
+            cls().refresh_closure_table()
+
+    @classmethod
+    def check_version(cls):
+        """Invalidate this process's tree if orgs changed in any process
+
+        Compares the version stamp shared via redis with the one in effect
+        when this tree was built.  Only checked once per request (or app
+        context), the tree itself is rebuilt lazily.
+
+        """
+        if not has_app_context() or g.get('org_tree_version_checked'):
+            return
+        g.org_tree_version_checked = True
+        try:
+            version = redis_client().get(ORG_TREE_VERSION_KEY)
+        except redis.RedisError as e:
+            current_app.logger.warn(
+                "unable to check shared OrgTree version: {}".format(e))
+            return
+        if version != cls.version:
+            cls.root = None
+            cls.version = version
+
+    def refresh_closure_table(self):
+        """Rewrite the `organization_closure` table to match the tree
+
+        Written in a transaction of its own, leaving that of the session
+        (and with it, whatever the caller has yet to commit) alone.  As
+        such, the organizations must already be committed.
+
+        """
+        rows = []
+        for org_id in self.preorder:
+            node, depth = self.lookup_table[org_id], 0
+            while node.id is not None:
+                rows.append({
+                    'ancestor_id': node.id, 'descendant_id': org_id,
+                    'depth': depth})
+                node, depth = node.parent, depth + 1
+
+        table = OrganizationClosure.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.delete())
+            if rows:
+                connection.execute(table.insert(), rows)
 
     def populate_tree(self):
-        """Recursively build tree from top down"""
+        """Build tree from top down, from a single query"""
         if self.root.children:  # Done if already populated
             return
 
+        children = defaultdict(list)
+        query = Organization.query.filter(
+            Organization.id != 0  # none of the above doesn't apply
+        ).with_entities(
+            Organization.id, Organization.partOf_id).order_by(Organization.id)
+        for org_id, partOf_id in query:
+            children[partOf_id].append(org_id)
+
         def add_descendents(node):
             partOf_id = node.id
-            for org in Organization.query.filter(and_(
-                Organization.id != 0,  # none of the above doesn't apply
-                Organization.partOf_id == partOf_id)):
-                new_node = node.insert(id=org.id, partOf_id=partOf_id)
-                assert org.id not in self.lookup_table
-                self.lookup_table[org.id] = new_node
-                if Organization.query.filter(
-                    Organization.partOf_id == new_node.id).count():
-                    add_descendents(new_node)
+            for org_id in children[partOf_id]:
+                new_node = node.insert(id=org_id, partOf_id=partOf_id)
+                assert org_id not in self.lookup_table
+                self.lookup_table[org_id] = new_node
+                add_descendents(new_node)
 
         # Add top level orgs first, recurse on down
         add_descendents(self.root)
+        self.index_intervals()
+
+    def index_intervals(self):
+        """Number nodes in pre-order, defining a nested set interval on each
+
+        Each node's `left` is its position in `preorder`, and `right` the
+        position of its last descendant, so the ids at and below any node
+        are a slice of `preorder`, and a node is at or below another when
+        its `left` falls within the other's interval.
+
+        """
+        preorder = []
+
+        def visit(node):
+            node.left = len(preorder)
+            preorder.append(node.id)
+            for child_id in sorted(node.children):
+                visit(node.children[child_id])
+            node.right = len(preorder) - 1
+
+        for top_level_id in sorted(self.root.children):
+            visit(self.root.children[top_level_id])
+        OrgTree.preorder = preorder
 
     def find(self, organization_id):
         """Locates and returns node in OrgTree for given organization_id
@@ -553,17 +668,9 @@ class OrgTree(object):
     def all_leaves_below_id(self, organization_id):
         """Given org at arbitrary level, return list of leaf nodes below it"""
         arb = self.find(organization_id)
-
-        def fetch_leaves(node):
-            stack = [node]
-            while stack:
-                node = stack.pop()
-                if not node.children:
-                    yield node.id
-                for child_node in node.children.values():
-                    stack.append(child_node)
-
-        return list(fetch_leaves(arb))
+        return [
+            id for id in self.preorder[arb.left:arb.right + 1]
+            if not self.lookup_table[id].children]
 
     def here_and_below_id(self, organization_id):
         """Given org at arbitrary level, return list at and below"""
@@ -571,16 +678,7 @@ class OrgTree(object):
             arb = self.find(organization_id)
         except ValueError:
             return []
-
-        def fetch_nodes(node):
-            stack = [node]
-            while stack:
-                node = stack.pop()
-                yield node.id
-                for id, child_node in node.children.items():
-                    stack.append(child_node)
-
-        return list(fetch_nodes(arb))
+        return self.preorder[arb.left:arb.right + 1]
 
     def at_or_below_ids(self, organization_id, other_organizations):
         """Check if the other_organizations are at or below given organization
@@ -593,13 +691,20 @@ class OrgTree(object):
             given organization_id, or a child of it.
 
         """
+        try:
+            parent = self.find(organization_id)
+        except ValueError:
+            parent = None
+
         ## work through list - shortcircuit out if a qualified node is found
         for other_organization_id in other_organizations:
             if organization_id == other_organization_id:
                 return True
-            children = self.here_and_below_id(organization_id)
-            if other_organization_id in children:
+            other = self.lookup_table.get(other_organization_id)
+            if parent and other and (
+                    parent.left <= other.left <= parent.right):
                 return True
+        return False
 
     def find_top_level_org(self, organizations):
         """Returns top level organization(s) based on the organizations provided
@@ -635,11 +740,8 @@ class OrgTree(object):
             staff_user.has_role(ROLE.STAFF_ADMIN)):
             raise Unauthorized("visible_patients() exclusive to staff use")
 
-        staff_user_orgs = set()
-        for org in (o for o in staff_user.organizations if o.id != 0):
-            staff_user_orgs.update(self.here_and_below_id(org.id))
-
-        if not staff_user_orgs:
+        staff_org_ids = [o.id for o in staff_user.organizations if o.id != 0]
+        if not staff_org_ids:
             return []
 
         patient_role_id = Role.query.filter_by(name=ROLE.PATIENT).one().id
@@ -649,7 +751,23 @@ class OrgTree(object):
                 User.deleted_id.is_(None),
                 UserRoles.role_id == patient_role_id,
                 UserConsent.deleted_id.is_(None),
-                UserConsent.expires > now,
+                UserConsent.expires > now)
+
+        if current_app.config.get('ORG_CLOSURE_TABLE'):
+            # Join on the hierarchy in lieu of a potentially large IN list
+            query = query.join(
+                OrganizationClosure,
+                OrganizationClosure.descendant_id ==
+                UserOrganization.organization_id).filter(
+                    OrganizationClosure.ancestor_id.in_(
+                        staff_org_ids)).distinct()
+        else:
+            staff_user_orgs = set()
+            for org_id in staff_org_ids:
+                staff_user_orgs.update(self.here_and_below_id(org_id))
+            if not staff_user_orgs:
+                return []
+            query = query.filter(
                 UserOrganization.organization_id.in_(staff_user_orgs))
 
         return [u[0] for u in query]  # flaten return tuples to list of ids
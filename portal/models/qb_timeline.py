@@ -0,0 +1,357 @@
+"""QB Timeline module
+
+A user's QuestionnaireBank timeline holds every QuestionnaireBank applicable
+to the user, along with the start, overdue and expiry dates of each QB's
+active window.  Gathering these is expensive, so a timeline is memoized
+for the duration of a request, and optionally cached in dogpile keyed by
+user and data version.
+
+"""
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app, g, has_app_context, has_request_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from uuid import uuid4
+
+from ..date_tools import RelativeDelta
+from ..dogpile import dogpile_cache
+from ..trace import trace
+from .fhir import Observation, UserObservation
+from .intervention import Intervention, UserIntervention
+from .intervention_strategies import AccessStrategy
+from .organization import Organization, UserOrganization
+from .procedure import Procedure
+from .questionnaire_bank import (
+    QBD,
+    QuestionnaireBank,
+    QuestionnaireBankQuestionnaire,
+    classification_types,
+    current_qbd,
+)
+from .recur import QuestionnaireBankRecur, Recur
+from .user import User
+from .user_consent import UserConsent
+
+
+# Version tokens, keyed by user id or GLOBAL, name the current data for
+# cached timelines.  Random tokens (as opposed to counters) avoid races,
+# and as tokens expire with the cached timelines, a missing token can
+# safely default.
+GLOBAL = 'global'
+
+
+QBWindow = namedtuple('QBWindow', [
+    'questionnaire_bank_id', 'classification', 'trigger_date', 'start',
+    'overdue', 'expiry', 'iteration', 'recur_id'])
+
+
+def qb_window(questionnaire_bank, trigger_date, as_of_date=None):
+    """Calculate the active window for a QuestionnaireBank
+
+    Calls `calculated_start` once, deriving overdue and expiry from the
+    result, as opposed to the QB methods which each recalculate start.
+
+    :param questionnaire_bank: QuestionnaireBank in question
+    :param trigger_date: the user's trigger date for the QuestionnaireBank
+    :param as_of_date: UTC datetime defining the point in time for
+        the active window, defaults to now
+    :return: QBWindow namedtuple; dates are None if N/A
+
+    """
+    qb = questionnaire_bank
+    start, overdue, expiry, iteration, recur_id = None, None, None, None, None
+    if trigger_date:
+        qbd = qb.calculated_start(trigger_date, as_of_date)
+        start, iteration = qbd.relative_start, qbd.iteration
+        recur_id = qbd.recur.id if qbd.recur else None
+    if start:
+        expiry = start + RelativeDelta(qb.expired)
+        if qb.overdue:
+            overdue = start + RelativeDelta(qb.overdue)
+    return QBWindow(
+        questionnaire_bank_id=qb.id, classification=qb.classification,
+        trigger_date=trigger_date, start=start, overdue=overdue,
+        expiry=expiry, iteration=iteration, recur_id=recur_id)
+
+
+class QBTimeline(object):
+    """All QuestionnaireBanks applicable to a user, with active windows
+
+    Built from a single pass over the user's organizations and
+    interventions, looking up the trigger date once per association type.
+    Holds only ids and datetimes, so instances may be cached beyond the
+    life of the database session; QuestionnaireBanks are loaded on demand.
+
+    """
+    def __init__(self, user):
+        self.user_id = user.id
+        self.as_of_date = datetime.utcnow()
+
+        qbs = QuestionnaireBank.qbs_for_user(user, classification=None)
+        rank = {c: i for i, c in enumerate(classification_types)}
+        qbs.sort(key=lambda qb: rank[qb.classification])
+
+        trigger_dates = {}
+        self.windows = []
+        for qb in qbs:
+            association = 'organization' if qb.organization_id else (
+                'intervention')
+            if association not in trigger_dates:
+                trigger_dates[association] = qb.trigger_date(user)
+            self.windows.append(qb_window(
+                qb, trigger_dates[association], self.as_of_date))
+        self.valid_until = _next_transition(
+            qbs, self.windows, self.as_of_date)
+        self._qbs = {qb.id: qb for qb in qbs}
+
+    def __getstate__(self):
+        """Exclude the ORM objects when pickling"""
+        state = self.__dict__.copy()
+        state.pop('_qbs', None)
+        return state
+
+    def questionnaire_bank(self, questionnaire_bank_id):
+        """Return the QuestionnaireBank for the given id"""
+        if not hasattr(self, '_qbs'):
+            ids = [w.questionnaire_bank_id for w in self.windows]
+            self._qbs = {qb.id: qb for qb in QuestionnaireBank.query.filter(
+                QuestionnaireBank.id.in_(ids))} if ids else {}
+        return self._qbs[questionnaire_bank_id]
+
+    def qbs(self, classification):
+        """Return list of the user's QuestionnaireBanks in classification"""
+        return [
+            self.questionnaire_bank(w.questionnaire_bank_id)
+            for w in self.windows if w.classification == classification]
+
+    def window(self, questionnaire_bank):
+        """Return QBWindow for given QuestionnaireBank or None if N/A"""
+        for w in self.windows:
+            if w.questionnaire_bank_id == questionnaire_bank.id:
+                return w
+        return None
+
+    def qbd(self, window):
+        """Return QBD namedtuple equivalent to the given window"""
+        qb = self.questionnaire_bank(window.questionnaire_bank_id)
+        recur = None
+        if window.recur_id:
+            recur = next(r for r in qb.recurs if r.id == window.recur_id)
+        return QBD(
+            relative_start=window.start, iteration=window.iteration,
+            recur=recur, questionnaire_bank=qb)
+
+    def most_current_qb(self):
+        """Return QBD for the user's most current QB
+
+        Equivalent to `QuestionnaireBank.most_current_qb` as of now;
+        see that method for details.
+
+        """
+        baseline = [
+            w for w in self.windows if w.classification == 'baseline']
+        if not baseline:
+            trace("no baseline questionnaire_bank, can't continue")
+            return QBD(None, None, None, None)
+        trigger_date = baseline[0].trigger_date
+        if not trigger_date:
+            return QBD(None, None, None, None)
+
+        default = QBD(
+            relative_start=None, iteration=None, recur=None,
+            questionnaire_bank=self.questionnaire_bank(
+                baseline[0].questionnaire_bank_id))
+        windows = [w for w in self.windows if w.classification != 'indefinite']
+        if any(w.trigger_date != trigger_date for w in windows):
+            # Mixed associations use the baseline trigger date throughout,
+            # which the windows don't reflect; calculate the long way.
+            return current_qbd(
+                qbs=(self.questionnaire_bank(w.questionnaire_bank_id)
+                     for w in windows),
+                trigger_date=trigger_date, as_of_date=datetime.utcnow(),
+                default=default)
+
+        as_of_date = datetime.utcnow()
+        last_found = default
+        for w in windows:
+            if w.start is None:
+                continue
+            last_found = self.qbd(w)
+            if w.start <= as_of_date < w.expiry:
+                return last_found
+        return last_found
+
+
+def qb_timeline(user):
+    """Return the QBTimeline for user
+
+    Memoized for the life of the request, and when
+    configured with `QB_TIMELINE_CACHE`, cached in the dogpile 'hourly'
+    region keyed by user and data version.
+
+    """
+    memo = None
+    # Not memoized in bare app contexts, such as those of celery tasks,
+    # which live on while working through any number of users
+    if has_request_context():
+        memo = g.setdefault('qb_timelines', {})
+        timeline = memo.get(user.id)
+        if timeline and datetime.utcnow() < timeline.valid_until:
+            return timeline
+
+    timeline = None
+    cache_enabled = current_app.config.get('QB_TIMELINE_CACHE')
+    if cache_enabled:
+        region = dogpile_cache.get_region('hourly')
+        key = _timeline_key(user.id)
+        timeline = region.get(key)
+        if timeline and not datetime.utcnow() < timeline.valid_until:
+            timeline = None
+    if not timeline:
+        timeline = QBTimeline(user)
+        if cache_enabled:
+            region.set(key, timeline)
+
+    if memo is not None:
+        memo[user.id] = timeline
+    return timeline
+
+
+def timeline_memoized():
+    """True if `qb_timeline` results outlive the call
+
+    As they do within a request, or when cached per `QB_TIMELINE_CACHE`.
+    Elsewhere, as in celery tasks, each call builds a full timeline, so
+    callers after a single QB are better off calculating it alone.
+
+    """
+    return (has_request_context() or
+            current_app.config.get('QB_TIMELINE_CACHE', False))
+
+
+def user_qb_window(user, questionnaire_bank):
+    """Return the QBWindow for the user's questionnaire_bank
+
+    Taken from the user's timeline when memoized (see `timeline_memoized`),
+    otherwise calculated for the given QuestionnaireBank alone.
+
+    """
+    window = None
+    if timeline_memoized():
+        window = qb_timeline(user).window(questionnaire_bank)
+    return window or qb_window(
+        questionnaire_bank, questionnaire_bank.trigger_date(user))
+
+
+def _next_transition(qbs, windows, as_of_date):
+    """Return the earliest datetime after as_of_date the windows change
+
+    A timeline remains accurate until either data changes or time passes
+    into a new window, such as the start of the next recurrence.
+
+    """
+    candidates = []
+    for qb, w in zip(qbs, windows):
+        if not w.trigger_date:
+            continue
+        candidates.extend((w.start, w.expiry))
+        for recur in qb.recurs:
+            candidates.append(w.trigger_date + recur.start_delta)
+            if recur.termination:
+                candidates.append(w.trigger_date + recur.termination_delta)
+            start, _ = recur.active_interval_start(
+                trigger_date=w.trigger_date, as_of_date=as_of_date)
+            if start:
+                candidates.append(start + recur.cycle_length_delta)
+    future = [c for c in candidates if c and c > as_of_date]
+    return min(future) if future else datetime.max
+
+
+def _version_key(scope):
+    return "{}:version|{}".format(__name__, scope)
+
+
+def _timeline_key(user_id):
+    region = dogpile_cache.get_region('hourly')
+    versions = region.get_multi(
+        [_version_key(GLOBAL), _version_key(user_id)])
+    versions = [v if isinstance(v, basestring) else '0' for v in versions]
+    return "{}:timeline|{}|{}".format(__name__, user_id, '|'.join(versions))
+
+
+def _forget_memoized(user_ids=None):
+    """Drop request memoized timelines for given users, or all if None"""
+    if not has_app_context():
+        return
+    memo = g.get('qb_timelines')
+    if not memo:
+        return
+    if user_ids is None:
+        memo.clear()
+    else:
+        for user_id in user_ids:
+            memo.pop(user_id, None)
+
+
+def invalidate_qb_timelines(user_ids=None):
+    """Invalidate timelines for given users, or all if None"""
+    _forget_memoized(user_ids)
+    if has_app_context() and current_app.config.get('QB_TIMELINE_CACHE'):
+        scopes = [GLOBAL] if user_ids is None else user_ids
+        region = dogpile_cache.get_region('hourly')
+        region.set_multi({_version_key(s): uuid4().hex for s in scopes})
+
+
+# Changes to these invalidate all timelines
+_GLOBAL_CLASSES = (
+    AccessStrategy, Intervention, Organization, QuestionnaireBank,
+    QuestionnaireBankQuestionnaire, QuestionnaireBankRecur, Recur)
+
+# Changes to these invalidate the timeline of the respective `user_id`
+_USER_CLASSES = (
+    Procedure, UserConsent, UserIntervention, UserObservation,
+    UserOrganization)
+
+
+def _change_listener(mapper, connection, target):
+    """Drop memoized timelines for data changed in the flush
+
+    Also records the change in `session.info`, as the cached versions
+    are only bumped once committed.
+
+    """
+    if isinstance(target, User):
+        scope = target.id
+    elif isinstance(target, _USER_CLASSES):
+        scope = target.user_id
+    else:
+        scope = GLOBAL
+    session = object_session(target)
+    session.info.setdefault('qb_timeline_changes', set()).add(scope)
+    _forget_memoized(None if scope == GLOBAL else [scope])
+
+
+# Users are included as changes to collections such as `user.organizations`
+# only mark the user dirty.  New observations don't alter existing ones
+# shared with other users, so only updates and deletes apply.
+for cls in _GLOBAL_CLASSES + _USER_CLASSES + (User, Observation):
+    for identifier in ('after_insert', 'after_update', 'after_delete'):
+        if cls is Observation and identifier == 'after_insert':
+            continue
+        event.listen(cls, identifier, _change_listener)
+
+
+@event.listens_for(Session, 'after_commit')
+def _commit_listener(session):
+    changed = session.info.pop('qb_timeline_changes', None)
+    if changed:
+        invalidate_qb_timelines(None if GLOBAL in changed else changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _rollback_listener(session):
+    """Drop timelines memoized from the rolled back changes"""
+    changed = session.info.pop('qb_timeline_changes', None)
+    if changed:
+        _forget_memoized(None if GLOBAL in changed else changed)
@@ -1,17 +1,20 @@
 """Questionnaire Bank module"""
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 from datetime import datetime
+from itertools import chain
 from flask import current_app, url_for
-from sqlalchemy import UniqueConstraint, CheckConstraint
+from sqlalchemy import and_, func, UniqueConstraint, CheckConstraint
 from sqlalchemy.dialects.postgresql import ENUM
 
 from ..database import db
 from ..date_tools import FHIR_datetime, RelativeDelta
-from .fhir import CC
+from .fhir import CC, Observation, UserObservation
 from .intervention import Intervention
 from .intervention_strategies import observation_check
 from .organization import OrgTree
+from .procedure import Procedure
 from .procedure_codes import latest_treatment_started_date
+from .procedure_codes import TxStartedConstants
 from .questionnaire import Questionnaire
 from .recur import Recur
 from .reference import Reference
@@ -232,21 +235,8 @@ class QuestionnaireBank(db.Model):
         else:
             intervention_associated_qbs = QuestionnaireBank.query.filter(
                 QuestionnaireBank.intervention_id.isnot(None))
-        for qb in intervention_associated_qbs:
-            # At this time, doesn't apply to metastatic patients.
-            if any((obs.codeable_concept == CC.PCaLocalized
-                    and obs.value_quantity == CC.FALSE_VALUE)
-                   for obs in user.observations):
-                break
-
-            intervention = Intervention.query.get(qb.intervention_id)
-            if intervention.quick_access_check(user):
-                # TODO: business rule details like the following should
-                # move to site persistence for QB to user mappings.
-                check_func = observation_check("biopsy", 'true')
-                if check_func(intervention=intervention, user=user):
-
-                    results.append(qb)
+        results.extend(intervention_qbs_for_user(
+            user, intervention_associated_qbs))
 
         def validate_classification_count(qbs):
             if qbs and qbs[0].classification == 'recurring':
@@ -258,7 +248,8 @@ class QuestionnaireBank(db.Model):
                     "more than one at this time.".format(
                         user=user, classification=classification))
 
-        validate_classification_count(results)
+        if classification:
+            validate_classification_count(results)
         return results
 
     @staticmethod
@@ -269,7 +260,8 @@ class QuestionnaireBank(db.Model):
         the QB's calculated start date, the current QB recurrence, and the
         recurrence iteration number. Values are set as None if N/A.
 
-        :param as_of_date: if not provided, use current utc time.
+        :param as_of_date: if not provided, use current utc time, by way
+            of the user's `QBTimeline` when memoized.
 
         Ideally, return the one current QuestionnaireBank that applies
         to the user 'as_of_date'.  If none, return the most recently
@@ -279,7 +271,12 @@ class QuestionnaireBank(db.Model):
         and should be treated independently
 
         """
-        as_of_date = as_of_date or datetime.utcnow()
+        if as_of_date is None:
+            # local to avoid cyclic import
+            from .qb_timeline import qb_timeline, timeline_memoized
+            if timeline_memoized():
+                return qb_timeline(user).most_current_qb()
+            as_of_date = datetime.utcnow()
 
         baseline = QuestionnaireBank.qbs_for_user(user, 'baseline')
         if not baseline:
@@ -290,22 +287,14 @@ class QuestionnaireBank(db.Model):
             return QBD(None, None, None, None)
 
         # Iterate over users QBs looking for current
-        last_found = QBD(relative_start=None, iteration=None, recur=None,
-                         questionnaire_bank=baseline[0])
-        for classification in classification_types:
-            if classification == 'indefinite':
-                continue
-            for qb in QuestionnaireBank.qbs_for_user(user, classification):
-                qbd = qb.calculated_start(trigger_date, as_of_date)
-                if qbd.relative_start is None:
-                    # indicates QB hasn't started yet, continue
-                    continue
-                expiry = qb.calculated_expiry(trigger_date)
-                last_found = qbd._replace(questionnaire_bank=qb)
-
-                if qbd.relative_start <= as_of_date and as_of_date < expiry:
-                    return last_found
-        return last_found
+        qbs = chain.from_iterable(
+            QuestionnaireBank.qbs_for_user(user, classification)
+            for classification in classification_types
+            if classification != 'indefinite')
+        return current_qbd(
+            qbs=qbs, trigger_date=trigger_date, as_of_date=as_of_date,
+            default=QBD(relative_start=None, iteration=None, recur=None,
+                        questionnaire_bank=baseline[0]))
 
     def calculated_start(self, trigger_date, as_of_date=None):
         """Return namedtuple (QBD) for QB
@@ -414,6 +403,138 @@ class QuestionnaireBank(db.Model):
                     return self.__trigger_date
 
 
+def intervention_qbs_for_user(user, questionnaire_banks):
+    """Filter intervention associated QBs down to those given to the user
+
+    Complicated rules (including strategies and UserIntervention rows)
+    define a user's access to an intervention.  Rely on the same check
+    used to display the intervention cards.
+
+    :param user: the user in question
+    :param questionnaire_banks: intervention associated QuestionnaireBanks
+        to consider
+    :return: list of the given QuestionnaireBanks applicable to user
+
+    """
+    results = []
+    for qb in questionnaire_banks:
+        # At this time, doesn't apply to metastatic patients.
+        if any((obs.codeable_concept == CC.PCaLocalized
+                and obs.value_quantity == CC.FALSE_VALUE)
+               for obs in user.observations):
+            break
+
+        intervention = Intervention.query.get(qb.intervention_id)
+        if intervention.quick_access_check(user):
+            # TODO: business rule details like the following should
+            # move to site persistence for QB to user mappings.
+            check_func = observation_check("biopsy", 'true')
+            if check_func(intervention=intervention, user=user):
+
+                results.append(qb)
+    return results
+
+
+def intervention_qbs_for_users(user_ids, questionnaire_banks):
+    """Bulk `intervention_qbs_for_user` for a cohort of users
+
+    Applies the same rules with a few set based queries, using
+    `Intervention.users_with_access` and the batch form of the biopsy
+    observation check, rather than evaluating each user in turn.
+
+    :param user_ids: iterable of user ids to consider
+    :param questionnaire_banks: intervention associated QuestionnaireBanks
+        to consider
+    :return: dictionary keyed by user id, of the list of given
+        QuestionnaireBanks applicable to each user.  Users without any
+        are left out.
+
+    """
+    user_ids = set(user_ids)
+    if not user_ids or not questionnaire_banks:
+        return {}
+
+    # At this time, doesn't apply to metastatic patients.
+    user_ids -= set(r[0] for r in db.session.query(
+        UserObservation.user_id).join(Observation).filter(and_(
+            UserObservation.user_id.in_(user_ids),
+            Observation.codeable_concept_id == CC.PCaLocalized.id,
+            Observation.value_quantity_id == CC.FALSE_VALUE.id)))
+
+    check_func = observation_check("biopsy", 'true')
+    eligible = {}
+    results = defaultdict(list)
+    for qb in questionnaire_banks:
+        if qb.intervention_id not in eligible:
+            intervention = Intervention.query.get(qb.intervention_id)
+            with_access = intervention.users_with_access(user_ids)
+            eligible[qb.intervention_id] = check_func.batch(
+                intervention=intervention,
+                user_ids=with_access) if with_access else set()
+        for user_id in eligible[qb.intervention_id]:
+            results[user_id].append(qb)
+    return results
+
+
+def intervention_trigger_dates(user_ids):
+    """Bulk intervention `QuestionnaireBank.trigger_date` for users
+
+    Applies the same rule, the latest treatment started procedure, else
+    the newest biopsy observation, in two grouped queries.
+
+    :param user_ids: iterable of user ids to look up
+    :return: dictionary keyed by user id of the UTC trigger datetime.
+        Users without one are left out.
+
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+    cc_ids = set(cc.id for cc in TxStartedConstants())
+    results = dict(db.session.query(
+        Procedure.user_id, func.max(Procedure.start_time)).filter(and_(
+            Procedure.user_id.in_(user_ids),
+            Procedure.code_id.in_(cc_ids))).group_by(Procedure.user_id))
+
+    untreated = user_ids - set(results)
+    if untreated:
+        biopsy = CC.BIOPSY.add_if_not_found()
+        results.update(
+            (user_id, issued) for user_id, issued in db.session.query(
+                UserObservation.user_id, func.max(Observation.issued)).join(
+                    Observation).filter(and_(
+                        UserObservation.user_id.in_(untreated),
+                        Observation.codeable_concept_id == biopsy.id)
+                ).group_by(UserObservation.user_id) if issued)
+    return results
+
+
+def current_qbd(qbs, trigger_date, as_of_date, default):
+    """Return QBD for the first of the given QBs active as_of_date
+
+    :param qbs: iterable of QuestionnaireBanks, in classification order
+    :param trigger_date: the user's trigger date for the QuestionnaireBanks
+    :param as_of_date: UTC datetime defining the point in time to check
+    :param default: QBD to return if none of the QBs have started
+
+    :return: namedtuple QBD for the active QB, or if none are active, the
+        last one found to have started
+
+    """
+    last_found = default
+    for qb in qbs:
+        qbd = qb.calculated_start(trigger_date, as_of_date)
+        if qbd.relative_start is None:
+            # indicates QB hasn't started yet, continue
+            continue
+        expiry = qb.calculated_expiry(trigger_date)
+        last_found = qbd._replace(questionnaire_bank=qb)
+
+        if qbd.relative_start <= as_of_date and as_of_date < expiry:
+            return last_found
+    return last_found
+
+
 class QuestionnaireBankQuestionnaire(db.Model):
     """link table for n:n association between Questionnaires and Banks"""
     __tablename__ = 'questionnaire_bank_questionnaires'
@@ -496,10 +617,10 @@ def visit_name(qbd):
         return None
     name = qbd.questionnaire_bank.name.replace('_', ' ').split()[0]
     if qbd.recur:
-        srd = RelativeDelta(qbd.recur.start)
+        srd = qbd.recur.start_delta
         sm = srd.months or 0
         sm += (srd.years * 12) if srd.years else 0
-        clrd = RelativeDelta(qbd.recur.cycle_length)
+        clrd = qbd.recur.cycle_length_delta
         clm = clrd.months or 0
         clm += (clrd.years * 12) if clrd.years else 0
         total = clm * qbd.iteration + sm
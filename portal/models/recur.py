@@ -1,4 +1,5 @@
 """Recur module"""
+from calendar import monthrange
 from datetime import datetime
 from sqlalchemy import UniqueConstraint
 
@@ -91,9 +92,9 @@ class Recur(db.Model):
 
         """
         as_of_date = as_of_date or datetime.utcnow()
-        start_date = trigger_date + RelativeDelta(self.start)
+        start_date = trigger_date + self.start_delta
         termination = (
-            trigger_date + RelativeDelta(self.termination) if
+            trigger_date + self.termination_delta if
             self.termination else None)
 
         if as_of_date < start_date:
@@ -105,17 +106,113 @@ class Recur(db.Model):
 
         # Still here implies we're in a valid period - find the current
         # and return its effective start date
-        assert (as_of_date + RelativeDelta(self.cycle_length) > as_of_date)
+        cycle_length = self.cycle_length_delta
+        assert (as_of_date + cycle_length > as_of_date)
 
+        # Iterations start by repeatedly adding the cycle_length.  Step
+        # through them one at a time until that's known to land on the
+        # same dates as adding multiples of the cycle_length.
         effective_start = start_date
         iteration_count = 0
-        while True:
-            if effective_start + RelativeDelta(self.cycle_length) < as_of_date:
-                effective_start += RelativeDelta(self.cycle_length)
+        while not _multiples_match(cycle_length, effective_start):
+            if effective_start + cycle_length < as_of_date:
+                effective_start += cycle_length
                 iteration_count += 1
             else:
                 return (effective_start, iteration_count)
 
+        def cycle_end(skipped):
+            return effective_start + cycle_length * (skipped + 1)
+
+        # Jump straight to the estimated iteration, then correct for
+        # irregularities such as month and year lengths
+        skipped = 0
+        average = _average_seconds(cycle_length)
+        if average > 0:
+            elapsed = as_of_date - effective_start
+            skipped = int((elapsed.days * 86400 + elapsed.seconds) // average)
+        while skipped > 0 and cycle_end(skipped - 1) >= as_of_date:
+            skipped -= 1
+        while cycle_end(skipped) < as_of_date:
+            skipped += 1
+
+        return (
+            effective_start + cycle_length * skipped,
+            iteration_count + skipped)
+
+    def _relative_delta(self, field):
+        """Returns memoized RelativeDelta for named field, or None if unset
+
+        Keyed by the field's value, so changes to the field are respected.
+
+        """
+        value = getattr(self, field)
+        if not value:
+            return None
+        if not hasattr(self, '_deltas'):
+            self._deltas = {}
+        if (field, value) not in self._deltas:
+            self._deltas[(field, value)] = RelativeDelta(value)
+        return self._deltas[(field, value)]
+
+    @property
+    def start_delta(self):
+        """RelativeDelta from trigger date to start of recurrence"""
+        return self._relative_delta('start')
+
+    @property
+    def cycle_length_delta(self):
+        """RelativeDelta from the start of one iteration to the next"""
+        return self._relative_delta('cycle_length')
+
+    @property
+    def termination_delta(self):
+        """RelativeDelta from trigger date to termination, or None"""
+        return self._relative_delta('termination')
+
+
+def _multiples_match(delta, date):
+    """Returns True if repeatedly adding delta to date matches multiples
+
+    Adding months or years clips the day at the end of short months
+    (Jan 31 + 1 month is Feb 28), and repeated additions keep the
+    clipped day, whereas adding a multiple of the delta to the original
+    date doesn't.  Deltas free of months and years always match, as do
+    those in whole months or years applied to days no later than the
+    shortest month the additions land in, February counting as 28 days.
+    Absolute fields (i.e. `day` or `weekday`) never match.
+
+    """
+    if any(getattr(delta, field) is not None for field in (
+            'year', 'month', 'day', 'weekday', 'hour', 'minute', 'second',
+            'microsecond')) or delta.leapdays:
+        return False
+    if not (delta.years or delta.months):
+        return True
+    if (delta.days or delta.hours or delta.minutes or delta.seconds or
+            delta.microseconds):
+        return False
+    if date.day <= 28:
+        return True
+    # Months of the year repeat within 12 additions
+    step = delta.years * 12 + delta.months
+    months = set((date.month - 1 + step * i) % 12 + 1 for i in range(1, 13))
+    return date.day <= min(
+        monthrange(2001, month)[1] for month in months)
+
+
+def _average_seconds(delta):
+    """Returns average length in seconds of the relative delta
+
+    Only the relative fields (years, months, days, etc.) are considered,
+    using average year and month lengths.
+
+    """
+    days = delta.years * 365.2425 + delta.months * 30.436875 + delta.days
+    return (
+        days * 86400 + delta.hours * 3600 + delta.minutes * 60 +
+        delta.seconds + delta.microseconds / 1e6)
+
 
 class QuestionnaireBankRecur(db.Model):
     """Link table for QB -> Recur"""
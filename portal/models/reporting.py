@@ -1,24 +1,46 @@
 """Reporting statistics and data module"""
 from collections import defaultdict
-from flask import current_app
+from datetime import datetime
+from flask import current_app, has_app_context
+from itertools import chain
+import json
+import redis
+from sqlalchemy import and_, event, exc, func, select
+from sqlalchemy.orm import Session, attributes
 
-from ..dogpile import dogpile_cache
-from .fhir import CC
-from .intervention import Intervention
-from .procedure_codes import known_treatment_started
-from .procedure_codes import known_treatment_not_started
-from .role import ROLE
-from .user import User
+from ..database import db
+from ..date_tools import FHIR_datetime
+from .encounter import Encounter
+from .fhir import CC, Observation, UserObservation, ValueQuantity
+from .intervention import Intervention, UserIntervention
+from .organization import Organization, UserOrganization
+from .procedure import Procedure
+from .procedure_codes import TxNotStartedConstants, TxStartedConstants
+from ..redis_client import redis_client
+from .role import Role, ROLE
+from .user import User, UserRoles
+from .user_document import UserDocument
 
 
-@dogpile_cache.region('hourly')
-def get_reporting_stats():
-    """Cachable interface for expensive reporting data queries
+def intervention_description(intervention):
+    """Returns the description used to label intervention stats"""
+    if intervention.name == 'decision_support_p3p':
+        return 'Decision Support P3P'
+    return intervention.description
 
-    The following code is only run on a cache miss.
+
+def calculate_reporting_stats(chunk_size=1000):
+    """Gather reporting stats via grouped queries
+
+    Includes all active users without the test role.
+
+    :param chunk_size: maximum number of users to load at a time, when
+        intervention access strategies must be evaluated
+    :return: dictionary of stats, as used by the reporting dashboard.
+        Registrations and encounters (by label) are histograms, keyed as
+        `time_buckets`, counted by day in the database
 
     """
-    current_app.logger.debug("CACHE MISS: {}".format(__name__))
     stats = {}
     stats['roles'] = defaultdict(int)
     stats['patients'] = defaultdict(int)
@@ -26,59 +48,467 @@ def get_reporting_stats():
     stats['intervention_access'] = defaultdict(int)
     stats['intervention_reports'] = defaultdict(int)
     stats['organizations'] = defaultdict(int)
-    stats['registrations'] = []
-    stats['encounters'] = defaultdict(list)
+    stats['registrations'] = {}
+    stats['encounters'] = {}
 
-    interventions = Intervention.query.all()
+    test_users = db.session.query(UserRoles.user_id).join(Role).filter(
+        Role.name == ROLE.TEST)
+    users = db.session.query(User.id).filter(
+        User.active.is_(True), ~User.id.in_(test_users))
+    user_ids = users.subquery()
 
-    for user in User.query.filter_by(active=True):
-        if user.has_role(ROLE.TEST):
-            continue
+    def with_role(role_names):
+        return set(r[0] for r in db.session.query(UserRoles.user_id).join(
+            Role).filter(
+                Role.name.in_(role_names),
+                UserRoles.user_id.in_(user_ids)))
+
+    # Roles
+    query = db.session.query(Role.name, func.count(UserRoles.user_id)).join(
+        UserRoles).filter(UserRoles.user_id.in_(user_ids)).group_by(Role.name)
+    for name, count in query:
+        stats['roles'][name] = count
+
+    # Patient diagnosis buckets
+    patients = with_role((ROLE.PATIENT,))
+    if patients:
+        def observed(*criteria):
+            return set(r[0] for r in db.session.query(
+                UserObservation.user_id).join(Observation).join(
+                ValueQuantity).filter(
+                    UserObservation.user_id.in_(user_ids), *criteria))
+
+        def with_procedure(constants):
+            return set(r[0] for r in db.session.query(
+                Procedure.user_id).filter(
+                    Procedure.user_id.in_(user_ids),
+                    Procedure.code_id.in_([cc.id for cc in constants])))
+
+        biopsy = observed(
+            Observation.codeable_concept_id == CC.BIOPSY.id,
+            ValueQuantity.value.isnot(None), ValueQuantity.value != '')
+        not_started = with_procedure(TxNotStartedConstants())
+        started = with_procedure(TxStartedConstants())
+        metastatic = observed(
+            Observation.codeable_concept_id == CC.PCaLocalized.id,
+            Observation.value_quantity_id == CC.FALSE_VALUE.id)
+
+        stats['patients']['pre-dx'] = len(patients - biopsy)
+        diagnosed = patients & biopsy
+        stats['patients']['dx-nt'] = len(diagnosed & not_started)
+        stats['patients']['dx-t'] = len((diagnosed - not_started) & started)
+        stats['patients']['meta'] = len(patients & metastatic)
+
+    # Interventions, only considering patients and partners
+    descriptions = {i.id: intervention_description(i)
+                    for i in Intervention.query}
+    patients_and_partners = with_role((ROLE.PATIENT, ROLE.PARTNER))
+    if patients_and_partners:
+        p_and_p_ids = db.session.query(UserRoles.user_id).join(Role).filter(
+            Role.name.in_((ROLE.PATIENT, ROLE.PARTNER)),
+            UserRoles.user_id.in_(user_ids))
+
+        query = db.session.query(
+            UserIntervention.intervention_id,
+            func.count(UserIntervention.user_id.distinct())).filter(
+                UserIntervention.user_id.in_(p_and_p_ids)).group_by(
+                UserIntervention.intervention_id)
+        for intervention_id, count in query:
+            stats['interventions'][descriptions[intervention_id]] += count
+
+        query = db.session.query(
+            UserDocument.intervention_id,
+            func.count(UserDocument.user_id.distinct())).filter(
+                UserDocument.intervention_id.isnot(None),
+                UserDocument.user_id.in_(p_and_p_ids)).group_by(
+                UserDocument.intervention_id)
+        for intervention_id, count in query:
+            stats['intervention_reports'][descriptions[intervention_id]] += (
+                count)
+
+        for intervention_id, count in intervention_access_counts(
+                patients_and_partners, chunk_size).items():
+            if count:
+                stats['intervention_access'][
+                    descriptions[intervention_id]] += count
+
+    # Organizations
+    query = db.session.query(
+        Organization.name, func.count(UserOrganization.user_id)).join(
+        UserOrganization).filter(
+            UserOrganization.user_id.in_(user_ids)).group_by(
+            Organization.name)
+    for name, count in query:
+        stats['organizations'][name] = count
+    unspecified = users.filter(~User.id.in_(
+        db.session.query(UserOrganization.user_id))).count()
+    if unspecified:
+        stats['organizations']['Unspecified'] = unspecified
+
+    # Registrations and encounters
+    day = func.date_trunc('day', User.registered)
+    stats['registrations'] = _histogram(db.session.query(
+        day, func.count()).filter(
+            User.id.in_(user_ids), User.registered.isnot(None)).group_by(day))
+
+    day = func.date_trunc('day', Encounter.start_time)
+    password_encounters = (
+        Encounter.auth_method == 'password_authenticated',
+        Encounter.user_id.in_(user_ids))
+    day_counts = db.session.query(day, func.count()).filter(
+        *password_encounters).group_by(day).all()
+    if day_counts:
+        stats['encounters']['all'] = _histogram(day_counts)
+    # and for each intervention, the encounters of its users
+    by_label = defaultdict(list)
+    for intervention_id, day, count in db.session.query(
+            UserIntervention.intervention_id, day, func.count()).select_from(
+                Encounter).join(
+                    UserIntervention,
+                    UserIntervention.user_id == Encounter.user_id).filter(
+                        *password_encounters).group_by(
+                            UserIntervention.intervention_id, day):
+        by_label[descriptions[intervention_id]].append((day, count))
+    for label, day_counts in by_label.items():
+        stats['encounters'][label] = _histogram(day_counts)
+
+    return stats
+
+
+def intervention_access_counts(user_ids, chunk_size=1000):
+    """Count users with access to each intervention
+
+    Tallies the same result as calling `Intervention.quick_access_check`
+    for every (user, intervention) pair, by way of the bulk
+    `Intervention.users_with_access`.
+
+    :param user_ids: set of user ids to consider
+    :param chunk_size: maximum number of users to load at a time, for
+        strategies lacking batch evaluation
+    :return: dictionary of counts keyed by intervention id
+
+    """
+    return {
+        intervention.id: len(intervention.users_with_access(
+            user_ids, chunk_size=chunk_size))
+        for intervention in Intervention.query}
+
+
+# Incremental stats store, held in redis.  Counters are redis hashes keyed
+# by label; registrations and encounters are histograms, hashes keyed by
+# time bucket (see `time_buckets`).  Rebuilt in full by
+# `rebuild_stats_store`, and kept current in between by the session
+# listeners below, which queue committed changes for the next read.
+STORE_PREFIX = '{}:stats'.format(__name__)
+COUNTERS = (
+    'roles', 'patients', 'interventions', 'intervention_access',
+    'intervention_reports', 'organizations')
+
+
+def _store_key(*parts):
+    return '|'.join((STORE_PREFIX,) + parts)
+
+
+BUILT_KEY = _store_key('built')
+ENCOUNTER_LABELS_KEY = _store_key('encounter_labels')
+REGISTRATIONS_KEY = _store_key('registrations')
+PENDING_KEY = _store_key('pending')
+
+
+def time_buckets(timestamp):
+    """Returns the histogram buckets to which the timestamp belongs"""
+    return (
+        'all', timestamp.strftime('y:%Y'), timestamp.strftime('m:%Y-%m'),
+        timestamp.strftime('d:%Y-%m-%d'))
+
+
+def _histogram(day_counts):
+    """Returns histogram keyed by `time_buckets` from (day, count) pairs"""
+    histogram = defaultdict(int)
+    for day, count in day_counts:
+        for bucket in time_buckets(day):
+            histogram[bucket] += count
+    return histogram
+
+
+def rebuild_stats_store():
+    """Replace the contents of the stats store with a full calculation
+
+    Reconciles any drift in the incrementally maintained values, such as
+    from role changes or direct database edits.  Expected to be called as
+    a scheduled job.
+
+    """
+    stats = calculate_reporting_stats()
+    r = redis_client()
+    stale = [_store_key('encounters', label) for label in
+             r.smembers(ENCOUNTER_LABELS_KEY)]
+    stale.extend(_store_key(name) for name in COUNTERS)
+    stale.extend((ENCOUNTER_LABELS_KEY, REGISTRATIONS_KEY, PENDING_KEY))
+
+    pipe = r.pipeline()  # executes as a single transaction
+    pipe.delete(*stale)
+    for name in COUNTERS:
+        if stats[name]:
+            pipe.hmset(_store_key(name), dict(stats[name]))
+    if stats['registrations']:
+        pipe.hmset(REGISTRATIONS_KEY, dict(stats['registrations']))
+    for label, histogram in stats['encounters'].items():
+        pipe.hmset(_store_key('encounters', label), dict(histogram))
+        pipe.sadd(ENCOUNTER_LABELS_KEY, label)
+    pipe.set(BUILT_KEY, FHIR_datetime.as_fhir(datetime.utcnow()))
+    pipe.execute()
+
+
+def read_stats_store(as_of_date=None):
+    """Return reporting stats from the stats store, or None if not built
 
-        for role in user.roles:
-            stats['roles'][role.name] += 1
-            if role.name == 'patient':
-                if not any((obs.codeable_concept == CC.BIOPSY
-                            and obs.value_quantity.value)
-                           for obs in user.observations):
-                    stats['patients']['pre-dx'] += 1
-                elif known_treatment_not_started(user):
-                    stats['patients']['dx-nt'] += 1
-                elif known_treatment_started(user):
-                    stats['patients']['dx-t'] += 1
-                if any((obs.codeable_concept == CC.PCaLocalized
-                        and obs.value_quantity == CC.FALSE_VALUE)
-                       for obs in user.observations):
-                    stats['patients']['meta'] += 1
-
-        if user.has_role(ROLE.PATIENT) or user.has_role(ROLE.PARTNER):
-            for interv in interventions:
-                desc = interv.description
-                if interv.name == 'decision_support_p3p':
-                    desc = 'Decision Support P3P'
-                if interv.quick_access_check(user):
-                    stats['intervention_access'][desc] += 1
-                if interv in user.interventions:
-                    stats['interventions'][desc] += 1
-                if (any(doc.intervention == interv for doc in user.documents)):
-                    stats['intervention_reports'][desc] += 1
-
-        if not user.organizations.count():
-            stats['organizations']['Unspecified'] += 1
-        else:
-            for org in user.organizations:
-                stats['organizations'][org.name] += 1
-
-        stats['registrations'].append(user.registered)
-
-        for enc in user.encounters:
-            if enc.auth_method == 'password_authenticated':
-                st = enc.start_time
-                stats['encounters']['all'].append(st)
-                for interv in user.interventions:
-                    if interv.name == 'decision_support_p3p':
-                        stats['encounters']["Decision Support P3P"].append(st)
-                    else:
-                        stats['encounters'][interv.description].append(st)
+    Counters match those from `calculate_reporting_stats`, whereas
+    registrations and encounters (by label) are summarized as dictionaries
+    of counts for the 'day', 'month' and 'year' of as_of_date, and 'all'.
 
+    :param as_of_date: UTC datetime defining the current periods,
+        defaults to now
+
+    """
+    r = redis_client()
+    if not r.exists(BUILT_KEY):
+        return None
+    apply_pending_changes()
+    as_of_date = as_of_date or datetime.utcnow()
+    fields = time_buckets(as_of_date)
+    labels = [l.decode('utf-8') for l in r.smembers(ENCOUNTER_LABELS_KEY)]
+
+    pipe = r.pipeline()
+    for name in COUNTERS:
+        pipe.hgetall(_store_key(name))
+    pipe.hmget(REGISTRATIONS_KEY, fields)
+    for label in labels:
+        pipe.hmget(_store_key('encounters', label), fields)
+    results = iter(pipe.execute())
+
+    def periods(values):
+        return {
+            period: int(value or 0) for period, value in
+            zip(('all', 'year', 'month', 'day'), values)}
+
+    stats = {}
+    for name in COUNTERS:
+        stats[name] = defaultdict(int, {
+            k.decode('utf-8'): int(v) for k, v in next(results).items()})
+    stats['registrations'] = periods(next(results))
+    stats['encounters'] = defaultdict(
+        lambda: periods((None,) * 4),
+        ((label, periods(next(results))) for label in labels))
     return stats
+
+
+def current_reporting_stats():
+    """Return reporting stats from the stats store, building if necessary"""
+    stats = read_stats_store()
+    if stats is None:
+        rebuild_stats_store()
+        stats = read_stats_store()
+    return stats
+
+
+def apply_pending_changes():
+    """Apply the changes committed since last applied to the stats store
+
+    Commits only queue their changes (see `_stats_commit_listener`), so
+    the lookups necessary to apply them are made here, once for all
+    changes pending.
+
+    """
+    r = redis_client()
+    pipe = r.pipeline()  # executes as a single transaction
+    pipe.lrange(PENDING_KEY, 0, -1)
+    pipe.delete(PENDING_KEY)
+    pending = pipe.execute()[0]
+    if not pending:
+        return
+
+    changes = {'registered': [], 'role_changes': [], 'records': []}
+    for queued in pending:
+        for name, values in json.loads(queued).items():
+            changes[name].extend(tuple(value) for value in values)
+    try:
+        increments = _stats_increments(db.session, **changes)
+    except exc.SQLAlchemyError as e:
+        current_app.logger.error(
+            "failed to update reporting stats store: {}".format(e))
+        return
+    pipe = r.pipeline()
+    for command in increments:
+        getattr(pipe, command[0])(*command[1:])
+    pipe.execute()
+
+
+def _stats_increments(connection, registered, role_changes, records):
+    """Returns list of redis commands to apply the committed changes
+
+    :param connection: database connection or session for the lookups
+    :param registered: list of (user_id, buckets) for new Users, buckets
+        being the `time_buckets` of their registration
+    :param role_changes: list of (user_id, role_id, +1 or -1) tuples
+    :param records: list of ('encounter', user_id, buckets),
+        ('intervention', user_id, intervention_id) and ('report', user_id,
+        intervention_id, document_id) tuples for new password
+        authenticated Encounters, UserInterventions and intervention
+        UserDocuments respectively
+
+    """
+    def user_ids_with(*criteria):
+        return set(r[0] for r in connection.execute(
+            select([UserRoles.user_id]).where(and_(
+                UserRoles.role_id == Role.id,
+                UserRoles.user_id.in_(user_ids), *criteria))))
+
+    user_ids = set(user_id for user_id, _ in registered)
+    user_ids.update(user_id for user_id, _, _ in role_changes)
+    user_ids.update(record[1] for record in records)
+    excluded = user_ids_with(Role.name == ROLE.TEST)
+    excluded.update(r[0] for r in connection.execute(select([User.id]).where(
+        and_(User.id.in_(user_ids), User.active.isnot(True)))))
+
+    def histogram_increments(key, buckets):
+        return [('hincrby', key, bucket, 1) for bucket in buckets]
+
+    increments = []
+    for user_id, buckets in registered:
+        if user_id not in excluded:
+            increments.extend(histogram_increments(
+                REGISTRATIONS_KEY, buckets))
+    role_changes = [
+        change for change in role_changes if change[0] not in excluded]
+    if role_changes:
+        role_names = dict(tuple(r) for r in connection.execute(
+            select([Role.id, Role.name]).where(
+                Role.id.in_(set(c[1] for c in role_changes)))))
+        for user_id, role_id, delta in role_changes:
+            increments.append((
+                'hincrby', _store_key('roles'), role_names[role_id], delta))
+
+    records = [r for r in records if r[1] not in excluded]
+    if not records:
+        return increments
+
+    patients_and_partners = user_ids_with(
+        Role.name.in_((ROLE.PATIENT, ROLE.PARTNER)))
+    users_interventions = defaultdict(list)
+    for row in connection.execute(select([
+            UserIntervention.user_id, Intervention.name,
+            Intervention.description]).where(and_(
+                UserIntervention.intervention_id == Intervention.id,
+                UserIntervention.user_id.in_(user_ids)))):
+        users_interventions[row.user_id].append(intervention_description(row))
+    intervention_ids = set(r[2] for r in records if r[0] != 'encounter')
+    descriptions = {}
+    if intervention_ids:
+        descriptions = {
+            r.id: intervention_description(r) for r in connection.execute(
+                select([Intervention.id, Intervention.name,
+                        Intervention.description]).where(
+                    Intervention.id.in_(intervention_ids)))}
+
+    # Tallies users with any reports, so only count the first
+    reports = set(r[1:3] for r in records if r[0] == 'report')
+    if reports:
+        new_documents = set(r[3] for r in records if r[0] == 'report')
+        reports -= set(tuple(r) for r in connection.execute(
+            select([UserDocument.user_id, UserDocument.intervention_id]).where(
+                and_(
+                    UserDocument.user_id.in_(set(r[0] for r in reports)),
+                    UserDocument.intervention_id.in_(
+                        set(r[1] for r in reports)),
+                    ~UserDocument.id.in_(new_documents)))))
+
+    for record in records:
+        user_id = record[1]
+        if record[0] == 'encounter':
+            for label in ['all'] + users_interventions[user_id]:
+                increments.append(('sadd', ENCOUNTER_LABELS_KEY, label))
+                increments.extend(histogram_increments(
+                    _store_key('encounters', label), record[2]))
+        elif user_id not in patients_and_partners:
+            continue
+        elif record[0] == 'intervention':
+            increments.append((
+                'hincrby', _store_key('interventions'),
+                descriptions[record[2]], 1))
+        elif record[1:3] in reports:
+            reports.discard(record[1:3])
+            increments.append((
+                'hincrby', _store_key('intervention_reports'),
+                descriptions[record[2]], 1))
+    return increments
+
+
+@event.listens_for(Session, 'after_flush')
+def _stats_flush_listener(session, flush_context):
+    """Note flushed changes to the reporting stats
+
+    Only values at hand are kept, in `session.info`, until the transaction
+    commits.  Any lookups are left to `apply_pending_changes`.
+
+    """
+    registered, role_changes, records = [], [], []
+    for obj in session.new:
+        if isinstance(obj, User):
+            registered.append((obj.id, time_buckets(
+                obj.registered or datetime.utcnow())))
+        elif isinstance(obj, UserRoles):
+            role_changes.append((obj.user_id, obj.role_id, 1))
+        elif isinstance(obj, Encounter):
+            if obj.auth_method == 'password_authenticated':
+                records.append((
+                    'encounter', obj.user_id, time_buckets(obj.start_time)))
+        elif isinstance(obj, UserIntervention):
+            records.append(('intervention', obj.user_id, obj.intervention_id))
+        elif isinstance(obj, UserDocument) and obj.intervention_id:
+            records.append(
+                ('report', obj.user_id, obj.intervention_id, obj.id))
+    for obj in session.deleted:
+        if isinstance(obj, UserRoles):
+            role_changes.append((obj.user_id, obj.role_id, -1))
+    for user in chain(session.new, session.dirty):
+        if not isinstance(user, User):
+            continue
+        # Roles modified via the relationship, as opposed to UserRoles
+        added, _, deleted = attributes.get_history(
+            user, 'roles', passive=attributes.PASSIVE_NO_INITIALIZE)
+        role_changes.extend((user.id, role.id, 1) for role in added or ())
+        role_changes.extend((user.id, role.id, -1) for role in deleted or ())
+
+    if registered or role_changes or records:
+        changes = session.info.setdefault('stats_changes', {
+            'registered': [], 'role_changes': [], 'records': []})
+        changes['registered'].extend(registered)
+        changes['role_changes'].extend(role_changes)
+        changes['records'].extend(records)
+
+
+@event.listens_for(Session, 'after_commit')
+def _stats_commit_listener(session):
+    """Queue the committed changes for the stats store
+
+    Commits don't wait on the lookups applying the changes requires;
+    those are left to the next read, see `apply_pending_changes`.
+
+    """
+    changes = session.info.pop('stats_changes', None)
+    if not (changes and has_app_context()):
+        return
+    try:
+        r = redis_client()
+        if not r.exists(BUILT_KEY):
+            return  # nothing to maintain until first built
+        r.rpush(PENDING_KEY, json.dumps(changes))
+    except redis.RedisError as e:
+        current_app.logger.error(
+            "failed to update reporting stats store: {}".format(e))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _stats_rollback_listener(session):
+    session.info.pop('stats_changes', None)
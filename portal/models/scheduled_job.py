@@ -4,6 +4,7 @@ from datetime import datetime
 import re
 
 from ..database import db
+from ..date_tools import FHIR_datetime
 
 
 class ScheduledJob(db.Model):
@@ -22,6 +23,7 @@ class ScheduledJob(db.Model):
     _schedule = db.Column('schedule', db.Text, nullable=False)
     active = db.Column(db.Boolean(), nullable=False, server_default='1')
     last_runtime = db.Column(db.DateTime, nullable=True)
+    progress = db.Column(db.JSON, nullable=True)
 
     def __str__(self):
         return "scheduled_job {0.name} ({0.task}: {0._schedule})".format(self)
@@ -68,6 +70,7 @@ class ScheduledJob(db.Model):
         d['schedule'] = self.schedule
         d['active'] = self.active
         d['last_runtime'] = self.last_runtime
+        d['progress'] = self.progress
         return d
 
     def crontab_schedule(self):
@@ -81,12 +84,69 @@ class ScheduledJob(db.Model):
                       )
 
 
-def update_runtime(job_id, runtime=None):
+def update_runtime(job_id, runtime=None, progress=None):
+    """Record the job's runtime, and optionally a summary of the run
+
+    :param progress: JSON friendly details of the run, such as counts
+        and duration, to replace the job's `progress`
+
+    """
     if job_id:
         runtime = runtime or datetime.now()
         sj = ScheduledJob.query.get(job_id)
         if sj:
             sj.last_runtime = runtime
+            if progress is not None:
+                sj.progress = progress
             db.session.add(sj)
             db.session.commit()
             return db.session.merge(sj)
+
+
+def start_progress(job_id, total_chunks):
+    """Reset progress of job about to process `total_chunks` chunks"""
+    if job_id:
+        sj = ScheduledJob.query.get(job_id)
+        if sj:
+            sj.progress = {
+                'started': FHIR_datetime.as_fhir(datetime.utcnow()),
+                'total_chunks': total_chunks,
+                'completed_chunks': 0,
+                'failed_chunks': 0,
+                'chunks': {},
+            }
+            db.session.commit()
+
+
+def record_chunk_progress(job_id, chunk, patients, seconds, error=None):
+    """Record completion of a single chunk of a fanned out job
+
+    Chunks complete concurrently in different workers, so the job row
+    is locked for the read, modify, write of the progress.
+
+    :param job_id: ScheduledJob id, ignored if None
+    :param chunk: index of the completed chunk
+    :param patients: number of patients included in the chunk
+    :param seconds: time spent processing the chunk
+    :param error: error message if the chunk failed
+
+    """
+    if not job_id:
+        return
+    sj = ScheduledJob.query.filter_by(id=job_id).with_for_update().first()
+    if not sj:
+        db.session.commit()
+        return
+    progress = dict(sj.progress or {})
+    chunks = dict(progress.get('chunks', {}))
+    chunks[str(chunk)] = {'patients': patients, 'seconds': seconds}
+    if error:
+        chunks[str(chunk)]['error'] = error
+        progress['failed_chunks'] = progress.get('failed_chunks', 0) + 1
+    else:
+        progress['completed_chunks'] = progress.get(
+            'completed_chunks', 0) + 1
+    progress['chunks'] = chunks
+    # assign a new value, as in place changes to JSON aren't tracked
+    sj.progress = progress
+    db.session.commit()
@@ -2,17 +2,19 @@
 from cgi import escape
 from datetime import datetime
 from dateutil import parser
-from flask import abort, current_app
+from flask import abort, current_app, g, has_request_context
 from flask_user import UserMixin, _call_or_get
 import pytz
-from sqlalchemy import text
+from sqlalchemy import event, text
 from sqlalchemy.orm import synonym, class_mapper, ColumnProperty
+from sqlalchemy.orm import joinedload, Session
 from sqlalchemy import and_, or_, UniqueConstraint
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.dialects.postgresql import ENUM
 from StringIO import StringIO
 from flask_login import current_user as flask_login_current_user
 from fuzzywuzzy import fuzz
+from itertools import chain
 import time
 
 from .audit import Audit
@@ -23,10 +25,11 @@ from ..date_tools import as_fhir, FHIR_datetime
 from .extension import CCExtension
 from .fhir import Observation, UserObservation
 from .fhir import Coding, CodeableConcept, ValueQuantity
-from .identifier import Identifier
+from .fhir import UserEthnicity, UserIndigenous, UserRace
+from .identifier import Identifier, UserIdentifier
 from .intervention import UserIntervention
 from .performer import Performer
-from .organization import Organization, OrgTree
+from .organization import Organization, OrgTree, UserOrganization
 import reference
 from .relationship import Relationship, RELATIONSHIP
 from .role import Role, ROLE
@@ -183,6 +186,70 @@ user_extension_classes = (UserEthnicityExtension, UserRaceExtension,
                           UserTimezone, UserIndigenousStatusExtension)
 
 
+def patients_as_fhir(user_ids):
+    """Return FHIR Patient resources for many users
+
+    Equivalent to calling `User.as_fhir` for each user, but loads the
+    users with their locale, phones and audits, then the identifiers,
+    organizations and extension codings of all, with a fixed number of
+    queries.
+
+    :param user_ids: ids of users to serialize
+    :return: dictionary of Patient resources keyed by user id; ids
+        not found are omitted
+
+    """
+    from .auth import AuthProvider  # local to avoid cyclic import
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+    users = User.query.filter(User.id.in_(user_ids)).options(
+        joinedload('_locale').joinedload('codings'),
+        joinedload('_phone'), joinedload('_alt_phone'),
+        joinedload('deleted'), joinedload('deceased')).all()
+    preloaded = dict((user.id, {
+        'identifiers': [], 'organization_ids': [],
+        'codings': dict((kls.extension_url, []) for kls in (
+            UserEthnicityExtension, UserIndigenousStatusExtension,
+            UserRaceExtension))}) for user in users)
+
+    for user_id, identifier in db.session.query(
+            UserIdentifier.user_id, Identifier).join(Identifier).filter(
+                UserIdentifier.user_id.in_(user_ids)).order_by(
+                    UserIdentifier.id):
+        preloaded[user_id]['identifiers'].append(identifier)
+    providers = {}
+    for provider in AuthProvider.query.filter(
+            AuthProvider.user_id.in_(user_ids)):
+        providers.setdefault(provider.user_id, []).append(provider)
+    for user_id, org_id in db.session.query(
+            UserOrganization.user_id,
+            UserOrganization.organization_id).filter(
+                UserOrganization.user_id.in_(user_ids)).order_by(
+                    UserOrganization.id):
+        preloaded[user_id]['organization_ids'].append(org_id)
+    for kls, link in (
+            (UserEthnicityExtension, UserEthnicity),
+            (UserIndigenousStatusExtension, UserIndigenous),
+            (UserRaceExtension, UserRace)):
+        for user_id, coding in db.session.query(
+                link.user_id, Coding).join(Coding).filter(
+                    link.user_id.in_(user_ids)).order_by(link.id):
+            preloaded[user_id]['codings'][kls.extension_url].append(coding)
+
+    results = {}
+    for user in users:
+        details = preloaded[user.id]
+        # `User.identifiers` adds any missing implicit identifiers -
+        # defer to it in the rare case one is missing
+        implicit = user.implicit_identifiers(providers.get(user.id, []))
+        if any(i not in details['identifiers'] for i in implicit):
+            details['identifiers'] = user.identifiers
+        results[user.id] = user.as_fhir(preloaded=details)
+    return results
+
+
 def user_extension_map(user, extension):
     """Map the given extension to the User
 
@@ -487,22 +554,31 @@ class User(db.Model, UserMixin):
         with this account.
 
         """
-        primary = Identifier(use='official', system=TRUENTH_ID, value=self.id)
-        if primary not in self._identifiers.all():
-            self._identifiers.append(primary)
+        for identifier in self.implicit_identifiers():
+            if identifier not in self._identifiers.all():
+                self._identifiers.append(identifier)
 
-        if self.username:
-            secondary = Identifier(
-                use='secondary', system=TRUENTH_USERNAME, value=self.username)
-            if secondary not in self._identifiers.all():
-                self._identifiers.append(secondary)
+        return self._identifiers
 
-        for provider in self.auth_providers:
-            p_id = Identifier.from_fhir(provider.as_fhir())
-            if p_id not in self._identifiers.all():
-                self._identifiers.append(p_id)
+    def implicit_identifiers(self, auth_providers=None):
+        """Return list of the user's implicit identifiers
 
-        return self._identifiers
+        The primary key from the user table, the username if set, and one
+        for each of the user's auth_providers - see `identifiers`
+
+        :param auth_providers: the user's AuthProviders if already loaded,
+            as by bulk lookups, in place of the relationship
+
+        """
+        implicit = [Identifier(use='official', system=TRUENTH_ID, value=self.id)]
+        if self.username:
+            implicit.append(Identifier(
+                use='secondary', system=TRUENTH_USERNAME, value=self.username))
+        if auth_providers is None:
+            auth_providers = self.auth_providers
+        implicit.extend(
+            Identifier.from_fhir(p.as_fhir()) for p in auth_providers)
+        return implicit
 
     @property
     def external_study_id(self):
@@ -760,12 +836,21 @@ class User(db.Model, UserMixin):
             fhir['entry'].append({"resource": proc.as_fhir()})
         return fhir
 
-    def as_fhir(self):
+    def as_fhir(self, preloaded=None):
+        """Return the user as a FHIR Patient resource
+
+        :param preloaded: the user's identifiers, organization ids and
+            extension codings, as loaded in bulk by `patients_as_fhir`, to
+            use in place of the respective relationships
+
+        """
         def careProviders():
             """build and return list of careProviders (AKA clinics)"""
+            org_ids = preloaded['organization_ids'] if preloaded else (
+                o.id for o in self.organizations)
             orgs = []
-            for o in self.organizations:
-                orgs.append(reference.Reference.organization(o.id).as_fhir())
+            for org_id in org_ids:
+                orgs.append(reference.Reference.organization(org_id).as_fhir())
             return orgs
 
         def deceased():
@@ -784,7 +869,9 @@ class User(db.Model, UserMixin):
 
         d = {}
         d['resourceType'] = "Patient"
-        d['identifier'] = [id.as_fhir() for id in self.identifiers]
+        identifiers = preloaded['identifiers'] if preloaded else (
+            self.identifiers)
+        d['identifier'] = [id.as_fhir() for id in identifiers]
         d['name'] = {}
         if self.first_name:
             d['name']['given'] = self.first_name
@@ -806,8 +893,16 @@ class User(db.Model, UserMixin):
             d['photo'].append({'url': self.image_url})
         extensions = []
         for kls in user_extension_classes:
-            instance = user_extension_map(self, {'url': kls.extension_url})
-            data = instance.as_fhir()
+            if preloaded and kls.extension_url in preloaded['codings']:
+                codings = preloaded['codings'][kls.extension_url]
+                data = codings and {
+                    'url': kls.extension_url,
+                    'valueCodeableConcept': {
+                        'coding': [c.as_fhir() for c in codings]}}
+            else:
+                instance = user_extension_map(
+                    self, {'url': kls.extension_url})
+                data = instance.as_fhir()
             if data:
                 extensions.append(data)
         if extensions:
@@ -1166,7 +1261,7 @@ class User(db.Model, UserMixin):
             int(other_id)
         except ValueError:
             abort(400, "Non Integer value for User ID: {}".format(other_id))
-        other = User.query.get(other_id)
+        other = get_user(other_id)
         if not other:
             abort(404, "User not found {}".format(other_id))
 
@@ -1232,8 +1327,123 @@ class User(db.Model, UserMixin):
 
         abort(401, "Inadequate role for {} of {}".format(permission, other_id))
 
+    def permitted_user_ids(self, permission, other_ids):
+        """Bulk equivalent of `check_role` over a list of users
+
+        Rather than looking up each user, their consents and organizations
+        in turn, the roles, valid consents, organizations and interventions
+        of all other users are gathered in a single query each, and
+        compared against the set of organizations at or below this user's.
+
+        :param permission: 'view' or 'edit', as in `check_role`
+        :param other_ids: iterable of user ids to check
+        :return: set of the other_ids `check_role` would grant permission
+            to.  Ids of users not found are excluded rather than raising.
+
+        """
+        # local to avoid cyclic import
+        from .user_consent import STAFF_EDITABLE_MASK, UserConsent
+
+        assert(permission in ('view', 'edit'))  # limit vocab for now
+        other_ids = set(int(i) for i in other_ids)
+        if not other_ids:
+            return set()
+        roles = role_names_by_user(other_ids)
+        found = set(u[0] for u in db.session.query(User.id).filter(
+            User.id.in_(other_ids)))
+
+        permitted = found & set([self.id])
+        if self.has_role(ROLE.ADMIN) or self.has_role(ROLE.SERVICE):
+            return found
+
+        def with_role(role_name):
+            return set(
+                user_id for user_id in found - permitted
+                if role_name in roles.get(user_id, ()))
+
+        orgtree = OrgTree()
+        org_ids = [org.id for org in self.organizations]
+        below = set(org_ids)
+        for org_id in org_ids:
+            below.update(orgtree.here_and_below_id(org_id))
+
+        def orgs_by_user(user_ids):
+            results = {}
+            if user_ids:
+                for user_id, org_id in db.session.query(
+                        UserOrganization.user_id,
+                        UserOrganization.organization_id).filter(
+                            UserOrganization.user_id.in_(user_ids)):
+                    results.setdefault(user_id, set()).add(org_id)
+            return results
+
+        patients = with_role(ROLE.PATIENT)
+        if patients and any(
+                self.has_role(r) for r in (ROLE.STAFF, ROLE.STAFF_ADMIN)):
+            # See `check_role` for rules; consents at or below the staff
+            # orgs, or above the staff orgs for patients with orgs below
+            consents = UserConsent.query.filter(
+                UserConsent.user_id.in_(patients),
+                UserConsent.deleted_id.is_(None),
+                UserConsent.expires > datetime.utcnow()).with_entities(
+                    UserConsent.user_id, UserConsent.organization_id,
+                    UserConsent.options)
+            consented_orgs = {}
+            for user_id, org_id, options in consents:
+                if permission == 'edit' and not (
+                        options & STAFF_EDITABLE_MASK):
+                    continue
+                consented_orgs.setdefault(user_id, set()).add(org_id)
+
+            above = {}
+            patient_orgs = orgs_by_user(list(consented_orgs))
+            for user_id, con_org_ids in consented_orgs.items():
+                if con_org_ids & below:
+                    permitted.add(user_id)
+                    continue
+                for con_org_id in con_org_ids:
+                    if con_org_id not in above:
+                        above[con_org_id] = orgtree.at_or_below_ids(
+                            con_org_id, org_ids)
+                    if above[con_org_id] and (
+                            patient_orgs.get(user_id, set()) & below):
+                        permitted.add(user_id)
+                        break
+
+        staff = with_role(ROLE.STAFF) - permitted
+        if staff and self.has_role(ROLE.STAFF_ADMIN):
+            for user_id, staff_org_ids in orgs_by_user(staff).items():
+                if staff_org_ids & below:
+                    permitted.add(user_id)
+
+        patients = patients - permitted
+        if patients and self.has_role(ROLE.INTERVENTION_STAFF):
+            intervention_ids = [i.id for i in self.interventions]
+            if intervention_ids:
+                permitted.update(u[0] for u in db.session.query(
+                    UserIntervention.user_id).filter(
+                        UserIntervention.user_id.in_(patients),
+                        UserIntervention.intervention_id.in_(
+                            intervention_ids)))
+        return permitted
+
+    @property
+    def role_names(self):
+        """Frozen set of the user's role names
+
+        Computed once per load of the roles collection, and dropped on
+        any change to or expiration of the collection (see listeners
+        below).
+
+        """
+        role_names = self.__dict__.get('_role_names')
+        if role_names is None:
+            role_names = frozenset(r.name for r in self.roles)
+            self.__dict__['_role_names'] = role_names
+        return role_names
+
     def has_role(self, role_name):
-        return role_name in [r.name for r in self.roles]
+        return role_name in self.role_names
 
     def staff_html(self):
         """Helper used from templates to display any custom staff/provider text
@@ -1282,7 +1492,7 @@ class User(db.Model, UserMixin):
         :param acting_user: individual executing the command, for audit trail
 
         """
-        from .auth import Client, Token
+        from .auth import Client, Token, invalidate_user_tokens
 
         if self == acting_user:
             raise ValueError("can't delete self")
@@ -1304,6 +1514,7 @@ class User(db.Model, UserMixin):
                              context='account')
 
         # purge any outstanding access tokens
+        invalidate_user_tokens(self.id)
         Token.query.filter_by(user_id=self.id).delete()
         db.session.commit()
 
@@ -1338,6 +1549,43 @@ def add_role(user, role_name):
     return user
 
 
+@event.listens_for(User.roles, 'append')
+@event.listens_for(User.roles, 'remove')
+def _roles_changed(target, value, initiator):
+    target.__dict__.pop('_role_names', None)
+
+
+@event.listens_for(User, 'expire')
+def _user_expired(target, attrs):
+    # target may already be garbage collected when expired on commit
+    if target is not None and (attrs is None or 'roles' in attrs):
+        target.__dict__.pop('_role_names', None)
+
+
+@event.listens_for(User, 'refresh')
+def _user_refreshed(target, context, attrs):
+    if attrs is None or 'roles' in attrs:
+        target.__dict__.pop('_role_names', None)
+
+
+def role_names_by_user(user_ids):
+    """Returns role names for many users from a single query
+
+    :param user_ids: iterable of user ids to look up
+    :return: dictionary of frozen sets of role names, keyed by user id;
+        users without roles are included with an empty set
+
+    """
+    user_ids = set(user_ids)
+    roles = dict((user_id, set()) for user_id in user_ids)
+    if user_ids:
+        for user_id, role_name in db.session.query(
+                UserRoles.user_id, Role.name).join(Role).filter(
+                    UserRoles.user_id.in_(user_ids)):
+            roles[user_id].add(role_name)
+    return dict((k, frozenset(v)) for k, v in roles.items())
+
+
 def current_user():
     """Obtain the "current" user object
 
@@ -1359,13 +1607,69 @@ def current_user():
         uid = request.oauth.user.id
     if uid:
         with db.session.no_autoflush:
-            return User.query.get(uid)
+            return get_user(uid)
     return None
 
 
 def get_user(uid):
-    if uid:
+    """Return user for given id, or None if not found
+
+    Within a request, users are kept in a map on `flask.g`, so repeat
+    lookups for the same id return the same user without a query.  Not
+    so in bare app contexts, such as those of celery tasks, which live on
+    while working through any number of users.  Roles are eager loaded, as nearly every lookup is
+    followed by a role check.  See `_request_users` for invalidation.
+
+    """
+    if not uid:
+        return None
+    if not has_request_context():
         return User.query.get(uid)
+    users = _request_users()
+    user = users.get(uid)
+    if user is None or user not in db.session:
+        # Reload if missing or left behind by a session reset
+        user = User.query.options(joinedload('roles')).get(uid)
+        if user is None:
+            return None
+        users[uid] = user
+    return user
+
+
+def _request_users():
+    """Returns the request scoped map of users, keyed by id
+
+    Role and organization changes made within the request are applied by
+    the session listeners below, expiring the respective collections on
+    the mapped user so they reload on next access.
+
+    """
+    if 'users' not in g:
+        g.users = {}
+    return g.users
+
+
+@event.listens_for(Session, 'after_flush')
+def _user_flush_listener(session, flush_context):
+    """Note users with role or organization changes in the flush"""
+    if not has_request_context() or not g.get('users'):
+        return
+    changed = session.info.setdefault('changed_user_ids', set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, (UserRoles, UserOrganization)):
+            changed.add(obj.user_id)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _user_flush_postexec_listener(session, flush_context):
+    changed = session.info.pop('changed_user_ids', None)
+    if not changed or not has_request_context():
+        return
+    users = g.get('users', {})
+    for user_id in changed:
+        user = users.get(user_id)
+        if user is not None and user in session:
+            session.expire(user, ['roles', 'organizations'])
 
 
 class UserRoles(db.Model):
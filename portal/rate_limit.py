@@ -0,0 +1,83 @@
+"""Rate limiting, shared by all processes via the configured redis instance
+
+Each `TokenBucket` holds up to `capacity` tokens, refilled at `rate`
+tokens per second.  An action is permitted when a token can be taken,
+so bursts of up to `capacity` actions are allowed, and a sustained
+rate no greater than `rate`.
+
+"""
+from flask import current_app
+from hashlib import sha1
+import redis
+import time
+
+from .redis_client import redis_client
+
+RATE_LIMIT_PREFIX = 'rate-limit:'
+
+# Refill and take tokens atomically, as many workers share the bucket.
+# Returns seconds to wait for the requested tokens, having taken them
+# only if that's 0.  Returned as a string, as redis truncates numbers
+# returned from lua to integers.
+TAKE_TOKENS = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter, kept in redis
+
+    :param name: identifies the bucket; processes using the same name
+        share the same limit
+    :param rate: tokens added per second; 0 disables the limit
+    :param capacity: most tokens the bucket holds, i.e. the largest
+        permitted burst
+
+    """
+    def __init__(self, name, rate, capacity):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self.key = RATE_LIMIT_PREFIX + sha1(name).hexdigest()
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+
+    def take(self, tokens=1):
+        """Take tokens from the bucket if available
+
+        :return: 0 if the tokens were taken, otherwise the seconds to
+            wait until they will be available.  Nothing is taken when
+            a wait is returned.
+
+        """
+        if not self.rate:
+            return 0
+        try:
+            wait = redis_client().eval(
+                TAKE_TOKENS, 1, self.key, self.rate, self.capacity,
+                time.time(), tokens)
+        except redis.RedisError as e:
+            # Don't hold up the work on account of the limiter
+            current_app.logger.error(
+                "unable to check rate limit: {}".format(e))
+            return 0
+        return float(wait)
+
+    def reset(self):
+        """Refill the bucket"""
+        redis_client().delete(self.key)
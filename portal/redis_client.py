@@ -0,0 +1,18 @@
+"""Module for shared access to the configured redis instance"""
+from flask import current_app
+import redis
+
+_clients = {}
+
+
+def redis_client():
+    """Return StrictRedis client for the configured `REDIS_URL`
+
+    Clients (and so their connection pools) are shared per URL, as the
+    value of `REDIS_URL` may change, i.e. when testing.
+
+    """
+    url = current_app.config['REDIS_URL']
+    if url not in _clients:
+        _clients[url] = redis.StrictRedis.from_url(url)
+    return _clients[url]
@@ -16,7 +16,7 @@ from models.communication_request import CommunicationRequest
 from models.fhir import FHIR_datetime
 from models.intervention import Intervention, INTERVENTION
 from models.intervention_strategies import AccessStrategy
-from models.organization import Organization
+from models.organization import Organization, OrgTree
 from models.questionnaire import Questionnaire
 from models.questionnaire_bank import QuestionnaireBank
 from models.scheduled_job import ScheduledJob
@@ -469,6 +469,7 @@ class SitePersistence(object):
 
         fix_sequence('organizations_id_seq', max_org_id)
         fix_sequence('access_strategies_id_seq', max_strat_id)
+        OrgTree.invalidate_cache()
         self._log("SitePersistence import complete")
 
 
@@ -3804,6 +3804,72 @@ var tnthTables = {
         if (isNaN(b_d)) b_d = 0;
 
         return  b_d - a_d;
+    },
+    /***
+     * bootstrapTable options to list users from one of the server side
+     * list APIs (e.g. /patients/list), which page by the `next` cursor
+     * returned with each page rather than by offset.  Cursors to the pages
+     * seen are kept, so moving further on walks the pages in between.
+     * @param url - the list API
+     * @param params - any additional query parameters, e.g. org_list
+     * @returns options for bootstrapTable
+     */
+    "keysetOptions": function(url, params) {
+        var cursors = [null];
+        var listKey = null;
+        return {
+            url: url,
+            sidePagination: "server",
+            ajax: function(request) {
+                var data = request.data;
+                var query = $.extend({
+                    limit: data.limit,
+                    sort: data.sort || "userid",
+                    order: data.order || "asc"
+                }, params || {});
+                if (hasValue(data.search)) query.search = data.search;
+                /*
+                 * cursors only hold for the same list in the same order
+                 */
+                var key = JSON.stringify(query);
+                if (key !== listKey) {
+                    listKey = key;
+                    cursors = [null];
+                }
+                var page = Math.floor((data.offset || 0) / data.limit);
+                var at = Math.min(page, cursors.length - 1);
+                var fetch = function() {
+                    $.ajax({
+                        type: "GET",
+                        url: url,
+                        data: $.extend({}, query, cursors[at] ? {after: cursors[at]} : {}),
+                        dataType: "json"
+                    }).done(function(result) {
+                        if (result.next) cursors[at + 1] = result.next;
+                        if (at < page && result.next) {
+                            at++;
+                            fetch();
+                        } else request.success(result);
+                    }).fail(request.error);
+                };
+                fetch();
+            }
+        };
+    },
+    /***
+     * formatters for the columns of server side lists
+     */
+    "textFormatter": function(value) {
+        return hasValue(value) ? escapeHtml(String(value)) : "";
+    },
+    "listFormatter": function(value) {
+        return $.map(value || [], function(item) {
+            return "<span class='medium-text'>" + escapeHtml(item) + "</span>";
+        }).join("<br/>");
+    },
+    "profileLinkFormatter": function(value, row) {
+        if (!hasValue(value)) return "";
+        return "<a href='" + row.profile_url + "'>" + escapeHtml(String(value)) + "</a>";
     }
 };
 /**
@@ -12,21 +12,29 @@ from datetime import datetime
 from flask import current_app
 from requests import Request, Session
 from requests.exceptions import RequestException
+from celery import chord, group
 from celery.utils.log import get_task_logger
 
 from .database import db
-from .dogpile import dogpile_cache
 from factories.celery import create_celery
 from factories.app import create_app
+from .models.app_text import refresh_content as refresh_cached_content
+from .models.assessment_status import bulk_overall_assessment_status
+from .models.auth import purge_expired
 from .models.assessment_status import invalidate_assessment_status_cache
-from .models.assessment_status import overall_assessment_status
-from .models.communication import Communication
+from .models.assessment_status import refresh_assessment_status_cache
+from .models.communication import Communication, dispatch_communications
 from .models.communication_request import queue_outstanding_messages
-from .models.reporting import get_reporting_stats
+from .models.export_job import ExportJob, purge_expired_exports
+from .models.reporting import rebuild_stats_store
 from .models.role import Role, ROLE
 from .models.questionnaire_bank import QuestionnaireBank
 from .models.user import User, UserRoles
-from .models.scheduled_job import update_runtime
+from .models.scheduled_job import (
+    record_chunk_progress,
+    start_progress,
+    update_runtime,
+)
 
 # To debug, stop the celeryd running out of /etc/init, start in console:
 #   celery worker -A portal.celery_worker.celery --loglevel=debug
@@ -95,18 +103,17 @@ def test(job_id=None):
 
 @celery.task
 def cache_reporting_stats(job_id=None):
-    """Populate reporting dashboard stats cache
+    """Populate reporting dashboard stats store
 
-    Reporting stats can be a VERY expensive lookup - cached for an hour
-    at a time.  This task is responsible for renewing the potenailly
-    stale cache.  Expected to be called as a scheduled job.
+    The reporting stats store is maintained incrementally as data
+    changes.  This task is responsible for reconciling any drift with a
+    full rebuild.  Expected to be called as a scheduled job.
 
     """
     try:
         message = "failed"
         before = datetime.now()
-        dogpile_cache.invalidate(get_reporting_stats)
-        dogpile_cache.refresh(get_reporting_stats)
+        rebuild_stats_store()
         duration = datetime.now() - before
         message = (
             'Reporting stats updated in {0.seconds} seconds'.format(duration))
@@ -119,14 +126,107 @@ def cache_reporting_stats(job_id=None):
 
 
 @celery.task
-def cache_assessment_status(job_id=None):
+def purge_expired_auth(job_id=None, batch_size=1000):
+    """Delete expired OAuth grants and tokens
+
+    Expected to be called as a scheduled job.  Deleted counts and the
+    duration are recorded in the job's progress.
+
+    """
+    try:
+        message = "failed"
+        before = datetime.now()
+        counts = purge_expired(batch_size=batch_size)
+        duration = datetime.now() - before
+        message = (
+            'Purged {0[grants]} grants and {0[tokens]} tokens in '
+            '{1.seconds} seconds'.format(counts, duration))
+        current_app.logger.debug(message)
+        counts['seconds'] = duration.total_seconds()
+        update_runtime(job_id, progress=counts)
+    except Exception as exc:
+        logger.error("Unexpected exception in `purge_expired_auth` "
+                     "on {} : {}".format(job_id, exc))
+    return message
+
+
+@celery.task
+def purge_expired_export_jobs(job_id=None, batch_size=1000):
+    """Delete export jobs and their files once past retention
+
+    Expected to be called as a scheduled job.  Deleted counts and the
+    duration are recorded in the job's progress.
+
+    """
+    try:
+        message = "failed"
+        before = datetime.now()
+        counts = purge_expired_exports(batch_size=batch_size)
+        duration = datetime.now() - before
+        message = (
+            'Purged {0[jobs]} export jobs and {0[files]} files in '
+            '{1.seconds} seconds'.format(counts, duration))
+        current_app.logger.debug(message)
+        counts['seconds'] = duration.total_seconds()
+        update_runtime(job_id, progress=counts)
+    except Exception as exc:
+        logger.error("Unexpected exception in `purge_expired_export_jobs` "
+                     "on {} : {}".format(job_id, exc))
+    return message
+
+
+@celery.task
+def refresh_content(url):
+    """Refresh the content cache entry for url, queued when found stale"""
+    try:
+        refresh_cached_content(url)
+    except Exception as exc:
+        logger.error("Unexpected exception in `refresh_content` "
+                     "for {} : {}".format(url, exc))
+
+
+@celery.task
+def export_job(job_id):
+    """Generate the result of the requested `ExportJob`
+
+    Progress and status are recorded on the job itself, polled by the
+    requesting user via the export job API.
+
+    """
+    job = ExportJob.query.get(job_id)
+    if not job:
+        logger.error("export job {} not found".format(job_id))
+        return "failed"
+    try:
+        before = datetime.now()
+        job.run()
+        duration = datetime.now() - before
+        message = "{0} generated in {1.seconds} seconds".format(
+            job, duration)
+        current_app.logger.debug(message)
+    except Exception as exc:
+        message = "failed"
+        logger.error("Unexpected exception in `export_job` "
+                     "on {} : {}".format(job_id, exc))
+    return message
+
+
+@celery.task
+def cache_assessment_status(job_id=None, chunk_size=None):
     """Populate assessment status cache
 
     Assessment status is an expensive lookup - cached for an hour
     at a time.  This task is responsible for renewing the potenailly
     stale cache.  Expected to be called as a scheduled job.
 
+    :param chunk_size: if set, fan out the work as subtasks processing
+        `chunk_size` patients each - see `fan_out_patient_loop`
+
     """
+    if chunk_size:
+        return fan_out_patient_loop(
+            job_id=job_id, chunk_size=chunk_size, label='Assessment Cache',
+            update_cache=True, queue_messages=False)
     try:
         message = "failed"
         before = datetime.now()
@@ -143,8 +243,17 @@ def cache_assessment_status(job_id=None):
 
 
 @celery.task
-def prepare_communications(job_id=None):
-    """Move any ready communications into prepared state """
+def prepare_communications(job_id=None, chunk_size=None):
+    """Move any ready communications into prepared state
+
+    :param chunk_size: if set, fan out the work as subtasks processing
+        `chunk_size` patients each - see `fan_out_patient_loop`
+
+    """
+    if chunk_size:
+        return fan_out_patient_loop(
+            job_id=job_id, chunk_size=chunk_size, label='Prepared messages',
+            update_cache=False, queue_messages=True)
     try:
         message = "failed"
         before = datetime.now()
@@ -160,27 +269,50 @@ def prepare_communications(job_id=None):
     return message
 
 
-def update_patient_loop(update_cache=True, queue_messages=True):
-    """Function to loop over valid patients and update as per settings
-
-    Typically called as a scheduled_job - also directly from tests
-    """
+def valid_patients():
+    """Returns query for all (not deleted) patients"""
     patient_role_id = Role.query.filter(
         Role.name == ROLE.PATIENT).with_entities(Role.id).first()[0]
-    valid_patients = User.query.join(
+    return User.query.join(
         UserRoles).filter(
             and_(User.id == UserRoles.user_id,
                  User.deleted_id.is_(None),
                  UserRoles.role_id == patient_role_id))
 
-    for user in valid_patients:
-        if update_cache:
-            dogpile_cache.refresh(overall_assessment_status, user.id)
-        if queue_messages:
+
+def update_patient_loop(
+        update_cache=True, queue_messages=True, patient_ids=None):
+    """Function to loop over valid patients and update as per settings
+
+    Typically called as a scheduled_job - also directly from tests
+
+    :param patient_ids: optional, limit the loop to the given patients,
+        as done for each chunk of a fanned out job
+
+    """
+    valid_patients_query = valid_patients()
+    if patient_ids is not None:
+        if not patient_ids:
+            return
+        valid_patients_query = valid_patients_query.filter(
+            User.id.in_(patient_ids))
+
+    # Status and QBD for the whole cohort are computed in bulk, written
+    # to the cache if requested, and reused for queuing messages.
+    statuses = bulk_overall_assessment_status(
+        [u[0] for u in valid_patients_query.with_entities(User.id)])
+    if update_cache:
+        refresh_assessment_status_cache(statuses=statuses)
+
+    if queue_messages:
+        for user in valid_patients_query:
             if not user.email or '@' not in user.email:
                 # can't send to users w/o legit email
                 continue
-            qbd = QuestionnaireBank.most_current_qb(user=user)
+            if user.id in statuses:
+                qbd = statuses[user.id][1]
+            else:
+                qbd = QuestionnaireBank.most_current_qb(user=user)
             if qbd.questionnaire_bank:
                 queue_outstanding_messages(
                     user=user,
@@ -189,24 +321,118 @@ def update_patient_loop(update_cache=True, queue_messages=True):
     db.session.commit()
 
 
+def patient_chunks(chunk_size):
+    """Split the ids of all valid patients into lists of chunk_size"""
+    ids = [u[0] for u in valid_patients().with_entities(
+        User.id).order_by(User.id)]
+    return [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+
+
+def fan_out_patient_loop(job_id, chunk_size, label, **loop_kwargs):
+    """Dispatch `update_patient_loop` over chunks of patients
+
+    Each chunk runs as an `update_patient_chunk` subtask, committing on
+    its own, so chunks run in parallel across available workers and
+    a failure only loses the work of the failing chunk.  The job's
+    progress is updated as each chunk completes, and a final
+    `finish_patient_loop` callback updates the job's runtime.
+
+    :param job_id: ScheduledJob id for progress reporting
+    :param chunk_size: max number of patients per subtask
+    :param label: name of the work for log messages
+    :param loop_kwargs: `update_cache` and `queue_messages` flags
+        for `update_patient_loop`
+    :return: message describing the dispatch
+
+    """
+    try:
+        chunks = patient_chunks(int(chunk_size))
+        start_progress(job_id, len(chunks))
+        if not chunks:
+            update_runtime(job_id)
+            return '{}: no patients to process'.format(label)
+        header = group(
+            update_patient_chunk.s(
+                patient_ids=ids, chunk=i, job_id=job_id, **loop_kwargs)
+            for i, ids in enumerate(chunks))
+        chord(header)(finish_patient_loop.s(job_id=job_id, label=label))
+        message = '{}: dispatched {} chunks of up to {} patients'.format(
+            label, len(chunks), chunk_size)
+        current_app.logger.debug(message)
+    except Exception as exc:
+        message = "failed"
+        logger.error("Unexpected exception dispatching `{}` on {} : {}".format(
+            label, job_id, exc))
+    return message
+
+
+@celery.task
+def update_patient_chunk(patient_ids, chunk, job_id=None, **loop_kwargs):
+    """Celery subtask wrapper for `process_patient_chunk`"""
+    return process_patient_chunk(
+        patient_ids=patient_ids, chunk=chunk, job_id=job_id, **loop_kwargs)
+
+
+def process_patient_chunk(patient_ids, chunk, job_id=None, **loop_kwargs):
+    """Run `update_patient_loop` over a single chunk of patients
+
+    Exceptions are logged and recorded in the job progress rather than
+    raised, so the remaining chunks and the chord callback still run.
+
+    :return: dictionary summarizing the chunk for `finish_patient_loop`
+
+    """
+    error = None
+    before = datetime.now()
+    try:
+        update_patient_loop(patient_ids=patient_ids, **loop_kwargs)
+    except Exception as exc:
+        db.session.rollback()
+        error = str(exc)
+        logger.error("Unexpected exception in chunk {} on {} : {}".format(
+            chunk, job_id, exc))
+    seconds = (datetime.now() - before).total_seconds()
+    record_chunk_progress(
+        job_id, chunk=chunk, patients=len(patient_ids), seconds=seconds,
+        error=error)
+    return {'chunk': chunk, 'patients': len(patient_ids),
+            'seconds': seconds, 'error': error}
+
+
+@celery.task
+def finish_patient_loop(results, job_id=None, label=None):
+    """Chord callback, run once all chunks of a fanned out job are done"""
+    failed = [r['chunk'] for r in results if r['error']]
+    message = '{} updated {} patients in {} chunks ({} failed)'.format(
+        label, sum(r['patients'] for r in results), len(results),
+        len(failed))
+    current_app.logger.debug(message)
+    update_runtime(job_id)
+    return message
+
+
 @celery.task
 def send_queued_communications(job_id=None):
     "Look for communication objects ready to send"
-    send_messages()
-    update_runtime(job_id)
+    stats = send_messages()
+    update_runtime(job_id, progress=stats)
 
 
 def send_messages():
     """Function to send all queued messages
 
     Typically called as a scheduled_job - also directly from tests
+
+    :return: dispatch counts and throughput, see `dispatch_communications`
+
     """
-    ready = Communication.query.filter(Communication.status == 'preparation')
-    for communication in ready:
-        current_app.logger.debug("Collate ready communication {}".format(
-            communication))
-        communication.generate_and_send()
-        db.session.commit()
+    stats = dispatch_communications(
+        batch_size=current_app.config.get('MAIL_BATCH_SIZE', 100))
+    current_app.logger.info(
+        "Sent {sent} messages ({failed} failed, {aborted} aborted, "
+        "{deferred} deferred) in {seconds:.1f} seconds, "
+        "{per_second:.1f} per second".format(**stats))
+    return stats
 
 
 def send_user_messages(email, force_update=False):
@@ -229,16 +455,13 @@ def send_user_messages(email, force_update=False):
                 user=user,
                 questionnaire_bank=qbd.questionnaire_bank,
                 iteration_count=qbd.iteration)
-    count = 0
-    ready = Communication.query.join(User).filter(
-        Communication.status == 'preparation').filter(User.email == email)
-    for communication in ready:
-        current_app.logger.debug("Collate ready communication {}".format(
-            communication))
-        communication.generate_and_send()
-        db.session.commit()
-        count += 1
-    message = "Sent {} messages to {}".format(count, email)
+    stats = dispatch_communications(
+        query=Communication.query.join(User).filter(User.email == email))
+    message = "Sent {} messages to {}".format(stats['sent'], email)
+    if stats['failed'] or stats['aborted']:
+        message += ", {} failed".format(stats['failed'] + stats['aborted'])
+    if stats['deferred']:
+        message += ", {} deferred by rate limit".format(stats['deferred'])
     if force_update:
         message += " after forced update"
     return message
@@ -1,7 +1,7 @@
 """Assessment Engine API view functions"""
 from flask import abort, Blueprint, current_app, jsonify, request, redirect, Response
-from flask import session
-from flask_swagger import swagger
+from flask import session, stream_with_context
+import json
 from flask_user import roles_required
 import jsonschema
 import requests
@@ -12,16 +12,19 @@ from ..database import db
 from ..date_tools import FHIR_datetime
 from ..extensions import oauth
 from ..models.assessment_status import AssessmentStatus
+from ..models.assessment_status import cached_overall_assessment_status
 from ..models.assessment_status import invalidate_assessment_status_cache
-from ..models.assessment_status import overall_assessment_status
 from ..models.auth import validate_origin
 from ..models.fhir import QuestionnaireResponse, EC, aggregate_responses, generate_qnr_csv
+from ..models.fhir import annotated_responses
 from ..models.intervention import INTERVENTION
 from ..models.questionnaire import Questionnaire
 from ..models.questionnaire_bank import QuestionnaireBank
 from ..models.role import ROLE
 from ..models.user import current_user, get_user, User
+from ..models.user_consent import UserConsent
 from .portal import check_int
+from .schema import validator
 
 assessment_engine_api = Blueprint('assessment_engine_api', __name__,
                                   url_prefix='/api')
@@ -578,10 +581,7 @@ def assessment(patient_id, instrument_id):
     instrument_id = request.args.get('instrument_id', instrument_id)
     if instrument_id is not None:
         questionnaire_responses = questionnaire_responses.filter(
-            QuestionnaireResponse.document[
-                ("questionnaire", "reference")
-            ].astext.endswith(instrument_id)
-        )
+            QuestionnaireResponse.questionnaire_name == instrument_id)
 
     documents = [qnr.document for qnr in questionnaire_responses]
 
@@ -617,12 +617,16 @@ def get_assessments():
     parameters:
       - name: format
         in: query
-        description: format of file to download (CSV or JSON)
+        description:
+          format of file to download (CSV, JSON or NDJSON).  CSV and
+          NDJSON (one QuestionnaireResponse per line) are streamed,
+          suitable for large exports
         required: false
         type: string
         enum:
           - json
           - csv
+          - ndjson
         default: json
       - name: instrument_id
         in: query
@@ -690,28 +694,39 @@ def get_assessments():
     """
     # Rather than call current_user.check_role() for every patient
     # in the bundle, deligate that responsibility to aggregate_responses()
-    bundle = aggregate_responses(
-        instrument_ids=request.args.getlist('instrument_id'),
-        current_user=current_user()
-    )
-    bundle.update({
-        'link': {
-            'rel':'self',
-            'href':request.url,
-        },
-    })
+    instrument_ids = request.args.getlist('instrument_id')
+    export_format = request.args.get('format', 'json')
 
     # Default to JSON output if format unspecified
-    if request.args.get('format', 'json') == 'json':
+    if export_format == 'json':
+        bundle = aggregate_responses(
+            instrument_ids=instrument_ids,
+            current_user=current_user()
+        )
+        bundle.update({
+            'link': {
+                'rel':'self',
+                'href':request.url,
+            },
+        })
         return jsonify(bundle)
 
-
+    # Stream other formats as generated, rather than build the whole bundle
+    documents = annotated_responses(
+        instrument_ids=instrument_ids, current_user=current_user())
+    if export_format == 'ndjson':
+        content = (json.dumps(d) + '\n' for d in documents)
+        mimetype = 'application/x-ndjson'
+    else:
+        export_format = 'csv'
+        content = generate_qnr_csv({'entry': documents})
+        mimetype = 'text/csv'
     return Response(
-        generate_qnr_csv(bundle),
-        mimetype='text/csv',
+        stream_with_context(content),
+        mimetype=mimetype,
         headers={
-            "Content-Disposition":
-                "attachment;filename=qnr_data-%s.csv" % FHIR_datetime.now()
+            "Content-Disposition": "attachment;filename=qnr_data-{}.{}".format(
+                FHIR_datetime.now(), export_format)
         }
     )
 
@@ -760,18 +775,6 @@ def assessment_update(patient_id):
     if patient.deleted:
         abort(400, "deleted user - operation not permitted")
 
-    swag = swagger(current_app)
-
-    draft4_schema = {
-        '$schema': 'http://json-schema.org/draft-04/schema#',
-        'type': 'object',
-        'definitions': swag['definitions'],
-    }
-
-    validation_schema = 'QuestionnaireResponse'
-    # Copy desired schema (to validate against) to outermost dict
-    draft4_schema.update(swag['definitions'][validation_schema])
-
     response = {
         'ok': False,
         'message': 'error updating questionnaire response',
@@ -781,7 +784,7 @@ def assessment_update(patient_id):
     updated_qnr = request.json
 
     try:
-        jsonschema.validate(updated_qnr, draft4_schema)
+        validator('QuestionnaireResponse').validate(updated_qnr)
     except jsonschema.ValidationError as e:
         return jsonify({
             'ok': False,
@@ -1254,18 +1257,6 @@ def assessment_add(patient_id):
     if patient.deleted:
         abort(400, "deleted user - operation not permitted")
 
-    swag = swagger(current_app)
-
-    draft4_schema = {
-        '$schema': 'http://json-schema.org/draft-04/schema#',
-        'type': 'object',
-        'definitions': swag['definitions'],
-    }
-
-    validation_schema = 'QuestionnaireResponse'
-    # Copy desired schema (to validate against) to outermost dict
-    draft4_schema.update(swag['definitions'][validation_schema])
-
     response = {
         'ok': False,
         'message': 'error saving questionnaire reponse',
@@ -1273,7 +1264,7 @@ def assessment_add(patient_id):
     }
 
     try:
-        jsonschema.validate(request.json, draft4_schema)
+        validator('QuestionnaireResponse').validate(request.json)
 
     except jsonschema.ValidationError as e:
         response = {
@@ -1576,17 +1567,29 @@ def batch_assessment_status():
     results = []
     for uid in user_ids:
         check_int(uid)
-    users = User.query.filter(User.id.in_(user_ids))
-    for user in users:
-        if not acting_user.check_role('view', user.id):
-            continue
+    # As with `check_role`, any user the acting user isn't permitted to
+    # view is an error; ids of users not found are left out
+    permitted = acting_user.permitted_user_ids('view', user_ids)
+    refused = set(int(uid) for uid in user_ids) - permitted
+    if refused:
+        existing = db.session.query(User.id).filter(User.id.in_(refused))
+        for user_id, in existing.order_by(User.id).limit(1):
+            abort(401, "Inadequate role for view of {}".format(user_id))
+    permitted = sorted(permitted)
+    statuses = cached_overall_assessment_status(permitted)
+    consents = {user_id: [] for user_id in permitted}
+    if permitted:
+        for consent in UserConsent.query.filter(
+                UserConsent.user_id.in_(permitted)).order_by(UserConsent.id):
+            consents[consent.user_id].append(consent)
+    for user_id in permitted:
         details = []
-        assessment_status, _ = overall_assessment_status(user.id)
-        for consent in user.all_consents:
+        assessment_status, _ = statuses[user_id]
+        for consent in consents[user_id]:
             details.append(
                 {'consent': consent.as_json(),
                  'assessment_status': assessment_status})
-        results.append({'user_id': user.id, 'consents': details})
+        results.append({'user_id': user_id, 'consents': details})
 
     return jsonify(status=results)
 
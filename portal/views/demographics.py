@@ -5,9 +5,10 @@ import json
 
 from ..audit import auditable_event
 from ..database import db
+from ..date_tools import FHIR_datetime
 from ..extensions import oauth
 from ..models.reference import MissingReference
-from ..models.user import current_user, get_user
+from ..models.user import current_user, get_user, patients_as_fhir
 
 demographics_api = Blueprint('demographics_api', __name__, url_prefix='/api')
 
@@ -72,6 +73,70 @@ def demographics(patient_id):
     return jsonify(patient.as_fhir())
 
 
+@demographics_api.route('/demographics/bundle')
+@oauth.require_oauth()
+def demographics_bundle():
+    """Get demographics for several patients as a FHIR Bundle
+
+    Bulk equivalent of /api/demographics/<patient_id>, serializing all
+    requested patients with a fixed number of queries rather than several
+    per patient.  Requested patients the logged-in user lacks permission
+    to view, deleted patients and those not found are omitted.
+
+    ---
+    tags:
+      - Demographics
+    operationId: getPatientDemographicsBundle
+    produces:
+      - application/json
+    parameters:
+      - name: patient_id
+        in: query
+        description: TrueNTH patient ID, repeat for each patient
+        required: true
+        type: array
+        items:
+          type: integer
+          format: int64
+        collectionFormat: multi
+    responses:
+      200:
+        description:
+          Returns a FHIR bundle of patient resources
+          (http://www.hl7.org/fhir/patient.html) in JSON, in the order
+          requested
+      400:
+        description: if a `patient_id` isn't an integer
+      401:
+        description: if missing valid OAuth token
+
+    """
+    try:
+        patient_ids = [int(i) for i in request.args.getlist('patient_id')]
+    except ValueError:
+        abort(400, "patient_id must be an integer")
+    permitted = current_user().permitted_user_ids('view', patient_ids)
+    patients = patients_as_fhir(permitted)
+    entries = []
+    for patient_id in patient_ids:
+        patient = patients.pop(patient_id, None)
+        if patient and 'deleted' not in patient:
+            entries.append(patient)
+
+    bundle = {
+        'resourceType': 'Bundle',
+        'updated': FHIR_datetime.now(),
+        'total': len(entries),
+        'type': 'searchset',
+        'link': {
+            'rel': 'self',
+            'href': request.url,
+        },
+        'entry': entries,
+    }
+    return jsonify(bundle)
+
+
 @demographics_api.route('/demographics/<int:patient_id>', methods=('PUT',))
 @oauth.require_oauth()
 def demographics_set(patient_id):
@@ -0,0 +1,204 @@
+"""Views for asynchronous Export Jobs"""
+from flask import abort, Blueprint, current_app, jsonify, request
+from flask import send_file, url_for
+import os
+
+from ..audit import auditable_event
+from ..database import db
+from ..extensions import oauth
+from ..factories.celery import create_celery
+from ..models.export_job import ExportJob
+from ..models.role import ROLE
+from ..models.user import current_user
+
+
+export_api = Blueprint('export_api', __name__)
+
+# Roles permitted to request each type of export
+EXPORT_ROLES = {
+    'assessment': (ROLE.STAFF_ADMIN, ROLE.STAFF, ROLE.RESEARCHER),
+    'reporting': (ROLE.ADMIN, ROLE.ANALYST),
+}
+
+
+@export_api.route('/api/export/<string:export_type>', methods=('POST',))
+@oauth.require_oauth()
+def request_export(export_type):
+    """Queue an export job, returning its status for polling
+
+    Exports are generated in the background, rather than holding the
+    connection open for the duration.  Poll the returned status URL
+    until the job is complete, then fetch the result from the download
+    URL as a gzip compressed file.
+    ---
+    operationId: request_export
+    tags:
+      - Export
+    parameters:
+      - name: export_type
+        in: path
+        description:
+          type of export; `assessment` for all QuestionnaireResponses the
+          user may view (as /api/patient/assessment), or `reporting` for
+          the reporting dashboard stats
+        required: true
+        type: string
+        enum:
+          - assessment
+          - reporting
+      - name: format
+        in: query
+        description:
+          format of the export, `csv` (default) or `ndjson` for assessment;
+          reporting exports are `json`
+        required: false
+        type: string
+      - name: instrument_id
+        in: query
+        description: for assessment exports, instruments to restrict to
+        required: false
+        type: array
+        items:
+          type: string
+        collectionFormat: multi
+    produces:
+      - application/json
+    responses:
+      202:
+        description:
+          export job queued; job details returned with status and
+          download URLs
+      400:
+        description: if the export type or format is not supported
+      401:
+        description:
+          if missing valid OAuth token or logged-in user lacks a role
+          permitted to request the export
+
+    """
+    user = current_user()
+    if export_type not in EXPORT_ROLES:
+        abort(400, "unsupported export type {}".format(export_type))
+    if not any(user.has_role(r) for r in EXPORT_ROLES[export_type]):
+        abort(401, "Inadequate role for {} export".format(export_type))
+
+    params = {}
+    if export_type == 'assessment':
+        params['instrument_ids'] = request.args.getlist('instrument_id')
+    try:
+        job = ExportJob.from_request(
+            user=user, export_type=export_type,
+            export_format=request.args.get('format'), params=params)
+    except ValueError as e:
+        abort(400, str(e))
+    db.session.add(job)
+    db.session.commit()
+    job = db.session.merge(job)
+
+    celery = create_celery(current_app)
+    res = celery.send_task('portal.tasks.export_job', args=(job.id,))
+    job.task_id = res.task_id
+    db.session.commit()
+    auditable_event("export job {} requested".format(job.id),
+                    user_id=user.id, subject_id=user.id, context='other')
+    return jsonify(_job_json(job)), 202
+
+
+@export_api.route('/api/export/job/<int:job_id>')
+@oauth.require_oauth()
+def export_status(job_id):
+    """Return the status of an export job
+
+    ---
+    operationId: export_status
+    tags:
+      - Export
+    parameters:
+      - name: job_id
+        in: path
+        description: Export job ID
+        required: true
+        type: integer
+        format: int64
+    produces:
+      - application/json
+    responses:
+      200:
+        description:
+          job details including `status` (queued, running, complete or
+          failed) and `progress` (rows written)
+      401:
+        description:
+          if missing valid OAuth token or the job belongs to another user
+      404:
+        description: if job_id doesn't exist
+
+    """
+    return jsonify(_job_json(_users_job(job_id)))
+
+
+@export_api.route('/api/export/job/<int:job_id>/download')
+@oauth.require_oauth()
+def export_download(job_id):
+    """Download the gzip compressed result of a complete export job
+
+    ---
+    operationId: export_download
+    tags:
+      - Export
+    parameters:
+      - name: job_id
+        in: path
+        description: Export job ID
+        required: true
+        type: integer
+        format: int64
+    produces:
+      - application/gzip
+    responses:
+      200:
+        description: the compressed export file
+      400:
+        description: if the job isn't complete
+      401:
+        description:
+          if missing valid OAuth token or the job belongs to another user
+      404:
+        description: if job_id or the result file doesn't exist
+      410:
+        description:
+          if the job has expired, its file removed or due to be
+
+    """
+    job = _users_job(job_id)
+    if job.status != 'complete':
+        abort(400, "export job {} is {}".format(job_id, job.status))
+    if job.expired():
+        abort(410, "export job {} expired".format(job_id))
+    path = job.file_path()
+    if not (path and os.path.exists(path)):
+        abort(404, "export file not found")
+    return send_file(
+        path, mimetype='application/gzip', as_attachment=True,
+        attachment_filename=job.filename)
+
+
+def _users_job(job_id):
+    """Return job for given id, if it belongs to the current user"""
+    job = ExportJob.query.get(job_id)
+    if not job:
+        abort(404, 'job ID not found')
+    user = current_user()
+    if job.user_id != user.id and not user.has_role(ROLE.ADMIN):
+        abort(401, "export job {} belongs to another user".format(job_id))
+    return job
+
+
+def _job_json(job):
+    d = job.as_json()
+    d['status_url'] = url_for(
+        'export_api.export_status', job_id=job.id, _external=True)
+    if job.status == 'complete' and not job.expired():
+        d['download_url'] = url_for(
+            'export_api.export_download', job_id=job.id, _external=True)
+    return d
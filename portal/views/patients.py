@@ -1,26 +1,82 @@
 """Patient view functions (i.e. not part of the API or auth)"""
+from collections import defaultdict
 from flask import abort, Blueprint, jsonify, render_template, request
 from flask import current_app, url_for
 from flask_user import roles_required
-from sqlalchemy import and_
+from sqlalchemy import and_, exists, or_
+from sqlalchemy.orm import aliased, joinedload
 
+from ..database import db
+from ..date_tools import FHIR_datetime
 from ..extensions import oauth
 from ..models.app_text import MailResource, UserInviteEmail_ATMA
-from ..models.assessment_status import overall_assessment_status
+from ..models.assessment_status import cached_overall_assessment_status
+from ..models.audit import Audit
 from ..models.communication import load_template_args
+from ..models.identifier import Identifier, UserIdentifier
 from ..models.intervention import Intervention, UserIntervention
-from ..models.organization import Organization, OrgTree, UserOrganization
+from ..models.organization import Organization, UserOrganization
 from ..models.questionnaire_bank import QuestionnaireBank, visit_name
 from ..models.role import Role, ROLE
 from ..models.user import User, current_user, get_user, UserRoles
 from ..models.user_consent import UserConsent
+from ..models.user_document import UserDocument
 from ..models.app_text import app_text, InitialConsent_ATMA, VersionedResource
-from .portal import check_int
+from ..system_uri import TRUENTH_EXTERNAL_STUDY_SYSTEM
+from .portal import staff_org_list, user_list_keyset, user_list_parameters
 from datetime import datetime
 
 
 patients = Blueprint('patients', __name__, url_prefix='/patients')
 
+def patient_list_query(user, org_list):
+    """Returns query for the patients listed for the given staff user
+
+    Patients must be consented and not deleted, and belong to one of the
+    organizations in `org_list` (for staff) or one of the user's
+    interventions (for intervention staff).  Each condition is an EXISTS
+    subquery, so the list is filtered, sorted and paginated in SQL.
+
+    :param user: the staff or intervention staff user
+    :param org_list: organization ids, as from `staff_org_list`
+
+    """
+    now = datetime.utcnow()
+    is_patient = exists().where(and_(
+        UserRoles.user_id == User.id,
+        UserRoles.role_id == Role.id,
+        Role.name == ROLE.PATIENT))
+    consented = exists().where(and_(
+        UserConsent.user_id == User.id,
+        UserConsent.deleted_id.is_(None),
+        UserConsent.expires > now))
+
+    memberships = []
+    if user.has_role(ROLE.STAFF) and org_list:
+        # Patients belonging to any of the orgs (and their children)
+        # this (staff) user belongs to.
+        memberships.append(exists().where(and_(
+            UserOrganization.user_id == User.id,
+            UserOrganization.organization_id != 0,
+            UserOrganization.organization_id.in_(org_list))))
+
+    if user.has_role(ROLE.INTERVENTION_STAFF):
+        # Patients belonging to any of the interventions this
+        # intervention_staff user belongs to
+        staff_interventions = db.session.query(
+            UserIntervention.intervention_id).filter(
+                UserIntervention.user_id == user.id)
+        patient_ui = aliased(UserIntervention)
+        memberships.append(exists().where(and_(
+            patient_ui.user_id == User.id,
+            patient_ui.intervention_id.in_(staff_interventions))))
+
+    if not memberships:
+        return User.query.filter(User.id == -1)
+    return User.query.filter(
+        User.deleted_id.is_(None), is_patient, consented, or_(*memberships))
+
+
 @patients.route('/')
 @roles_required([ROLE.STAFF, ROLE.INTERVENTION_STAFF])
 @oauth.require_oauth()
@@ -28,93 +84,140 @@ def patients_root():
     """patients view function, intended for staff
 
     Present the logged in staff the list of patients matching
-    the staff's organizations (and any decendent organizations)
+    the staff's organizations (and any decendent organizations),
+    a page at a time from `patient_list`
 
     """
     user = current_user()
 
-    patient_role_id = Role.query.filter(
-        Role.name==ROLE.PATIENT).with_entities(Role.id).first()
+    org_list = set()
+    if user.has_role(ROLE.STAFF):
+        org_list = staff_org_list(user, request.args.get('org_list', None))
 
-    # empty patient query list to start, unionize with other relevant lists
-    patients = User.query.filter(User.id==-1)
+    return render_template(
+        'patients_by_org.html', user=user, org_list=org_list,
+        wide_container="true")
 
-    org_list = set()
 
-    now = datetime.utcnow()
-    consented_users = []
+@patients.route('/list')
+@roles_required([ROLE.STAFF, ROLE.INTERVENTION_STAFF])
+@oauth.require_oauth()
+def patient_list():
+    """Paginated patient list, as JSON, intended for staff
 
-    consent_query = UserConsent.query.filter(and_(
-                         UserConsent.deleted_id.is_(None),
-                         UserConsent.expires > now)).with_entities(
-                             UserConsent.user_id)
-    consented_users = [u.user_id for u in consent_query]
+    Returns a page of the patients `patients_root` lists, sorted,
+    filtered and paginated in SQL.  Pages follow the `after` cursor
+    returned with the previous page (keyset pagination), so each page
+    costs the same regardless of its depth in the list.  Assessment
+    status, study ids and reports, when configured in
+    PATIENT_LIST_ADDL_FIELDS, are only looked up for the patients on the
+    page.
+
+    Query parameters, beyond those of `user_list_parameters` and
+    `user_list_keyset`:
+      org_list: comma separated organization ids to filter by, limited
+        to those of the logged in staff user
+
+    """
+    user = current_user()
 
+    org_list = set()
     if user.has_role(ROLE.STAFF):
-        request_org_list = request.args.get('org_list', None)
-        # Build list of all organization ids, and their decendents, the
-        # user belongs to
-        OT = OrgTree()
-
-        if request_org_list:
-            # for selected filtered orgs, we also need to get the children
-            # of each, if any
-            request_org_list = set(request_org_list.split(","))
-            for orgId in request_org_list:
-                check_int(orgId)
-                if orgId == 0:  # None of the above doesn't count
-                    continue
-                org_list.update(OT.here_and_below_id(orgId))
-        else:
-            for org in user.organizations:
-                if org.id == 0:  # None of the above doesn't count
-                    continue
-                org_list.update(OT.here_and_below_id(org.id))
-
-        # Gather up all patients belonging to any of the orgs (and their
-        # children) this (staff) user belongs to.
-        org_patients = User.query.join(UserRoles).filter(
-            and_(User.id==UserRoles.user_id,
-                 UserRoles.role_id==patient_role_id,
-                 User.deleted_id.is_(None),
-                 User.id.in_(consented_users)
-                 )
-            ).join(UserOrganization).filter(
-                and_(UserOrganization.user_id==User.id,
-                     UserOrganization.organization_id != 0,
-                     UserOrganization.organization_id.in_(org_list)))
-        patients = patients.union(org_patients)
+        org_list = staff_org_list(user)
+        if request.args.get('org_list'):
+            org_list &= staff_org_list(user, request.args.get('org_list'))
+    params = user_list_parameters(patient_list_query(user, org_list))
+    total = params.query.count()
+    rows, next_cursor = user_list_keyset(params._replace(
+        query=params.query.options(
+            joinedload('_phone'), joinedload('_alt_phone'))))
+    patients = [row[0] for row in rows]
+    page_ids = [patient.id for patient in patients]
 
-    if user.has_role(ROLE.INTERVENTION_STAFF):
-        uis = UserIntervention.query.filter(UserIntervention.user_id == user.id)
-        ui_list = [ui.intervention_id for ui in uis]
-
-        # Gather up all patients belonging to any of the interventions
-        # this intervention_staff user belongs to
-        ui_patients = User.query.join(UserRoles).filter(
-            and_(User.id==UserRoles.user_id,
-                 UserRoles.role_id==patient_role_id,
-                 User.deleted_id.is_(None),
-                 User.id.in_(consented_users))
-                 ).join(UserIntervention).filter(
-                 and_(UserIntervention.user_id==User.id,
-                     UserIntervention.intervention_id.in_(ui_list)))
-        patients = patients.union(ui_patients)
-
-    # get assessment status only if it is needed as specified by config
-    if 'status' in current_app.config.get('PATIENT_LIST_ADDL_FIELDS'):
-        patient_list = []
-        for patient in patients:
-            a_s, qbd = overall_assessment_status(patient.id)
-            patient.assessment_status = a_s
-            patient.current_qb = visit_name(qbd)
-            patient_list.append(patient)
-        patients = patient_list
+    addl_fields = current_app.config.get('PATIENT_LIST_ADDL_FIELDS')
+    organizations = defaultdict(list)
+    consent_dates = defaultdict(list)
+    study_ids = defaultdict(list)
+    staff_html = defaultdict(list)
+    reports = defaultdict(list)
+    statuses = {}
+    if page_ids:
+        for user_id, org_name in db.session.query(
+                UserOrganization.user_id, Organization.name).join(
+                    Organization).filter(
+                        UserOrganization.user_id.in_(page_ids)).order_by(
+                            Organization.id):
+            organizations[user_id].append(org_name)
+        for user_id, timestamp in db.session.query(
+                UserConsent.user_id, Audit.timestamp).join(
+                    Audit, UserConsent.audit_id == Audit.id).filter(
+                        UserConsent.user_id.in_(page_ids),
+                        UserConsent.deleted_id.is_(None),
+                        UserConsent.expires > datetime.utcnow()).order_by(
+                            UserConsent.id):
+            consent_dates[user_id].append(FHIR_datetime.as_fhir(timestamp))
+        if 'status' in addl_fields:
+            statuses = cached_overall_assessment_status(page_ids)
+        if 'study_id' in addl_fields:
+            for user_id, value in db.session.query(
+                    UserIdentifier.user_id, Identifier.value).join(
+                        Identifier).filter(
+                            UserIdentifier.user_id.in_(page_ids),
+                            Identifier.system ==
+                            TRUENTH_EXTERNAL_STUDY_SYSTEM).order_by(
+                                Identifier.id):
+                study_ids[user_id].append(value)
+        if 'reports' in addl_fields:
+            for user_id, html in db.session.query(
+                    UserIntervention.user_id,
+                    UserIntervention.staff_html).filter(
+                        UserIntervention.user_id.in_(page_ids),
+                        UserIntervention.staff_html.isnot(None)):
+                staff_html[user_id].append(html)
+            for user_id, description in db.session.query(
+                    UserDocument.user_id, Intervention.description).join(
+                        Intervention).filter(
+                            UserDocument.user_id.in_(page_ids),
+                            UserDocument.document_type ==
+                            'PatientReport').distinct().order_by(
+                                UserDocument.user_id,
+                                Intervention.description):
+                reports[user_id].append(description)
+
+    results = []
+    for patient in patients:
+        row = {
+            'userid': patient.id,
+            'username': patient.username,
+            'firstname': patient.first_name,
+            'lastname': patient.last_name,
+            'email': patient.email,
+            'phone': patient.phone,
+            'altPhone': patient.alt_phone,
+            'consentdate': consent_dates[patient.id],
+            'organization': organizations[patient.id],
+            'profile_url': url_for(
+                'patients.patient_profile', patient_id=patient.id)}
+        if patient.id in statuses:
+            a_s, qbd = statuses[patient.id]
+            row['status'] = a_s
+            row['visit'] = visit_name(qbd)
+        if 'study_id' in addl_fields:
+            row['study_id'] = ', '.join(study_ids[patient.id]) or None
+        if 'reports' in addl_fields:
+            # as `User.staff_html`, from all the patient's interventions
+            html = staff_html[patient.id]
+            row['staff_html'] = html[0] if len(html) == 1 else (
+                '<div>' + '</div><div>'.join(html) + '</div>' if html
+                else '')
+            row['reports'] = reports[patient.id]
+        results.append(row)
+
+    d = {'total': total, 'rows': results}
+    if next_cursor:
+        d['next'] = next_cursor
+    return jsonify(d)
 
-    return render_template(
-        'patients_by_org.html', patients_list=patients,
-        user=user, org_list=org_list,
-        wide_container="true")
 
 @patients.route('/patient-profile-create')
 @roles_required(ROLE.STAFF)
@@ -1,5 +1,7 @@
 """Portal view functions (i.e. not part of the API or auth)"""
 from celery.result import AsyncResult
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
 from flask import current_app, Blueprint, jsonify, render_template, flash
 from flask import abort, make_response, redirect, request, session, url_for
 from flask import render_template_string
@@ -9,8 +11,9 @@ from flask_sqlalchemy import get_debug_queries
 from flask_swagger import swagger
 from flask_wtf import FlaskForm
 from jinja2 import TemplateNotFound
+import json
 from pprint import pformat
-from sqlalchemy import and_
+from sqlalchemy import and_, exists, func, or_, tuple_
 from sqlalchemy.orm.exc import NoResultFound
 from wtforms import validators, HiddenField, IntegerField, StringField
 from datetime import datetime
@@ -37,9 +40,10 @@ from ..models.identifier import Identifier
 from ..models.intervention import Intervention
 from ..models.message import EmailMessage
 from ..models.organization import Organization, OrganizationIdentifier, OrgTree, UserOrganization
-from ..models.reporting import get_reporting_stats
+from ..models.reporting import current_reporting_stats
 from ..models.role import Role, ROLE, ALL_BUT_WRITE_ONLY
-from ..models.user import current_user, get_user, User, UserRoles
+from ..models.user import current_user, get_user
+from ..models.user import User, UserRoles
 from ..system_uri import SHORTCUT_ALIAS
 from ..trace import establish_trace, dump_trace
 
@@ -361,7 +365,7 @@ def access_via_token(token):
     if user.deleted:
         abort(400, "deleted user - operation not permitted")
     not_allowed = set([ROLE.ADMIN, ROLE.APPLICATION_DEVELOPER, ROLE.SERVICE])
-    has = set([role.name for role in user.roles])
+    has = user.role_names
     if not has.isdisjoint(not_allowed):
         abort(400, "Access URL not allowed for privileged accounts")
     if ROLE.WRITE_ONLY in has:
@@ -617,18 +621,120 @@ def home():
         interventions=interventions, consent_agreements=consent_agreements)
 
 
-@portal.route('/admin')
-@roles_required(ROLE.ADMIN)
-@oauth.require_oauth()
-def admin():
-    """user admin view function"""
-    # can't do list comprehension in template - prepopulate a 'rolelist'
+# Largest page the user and patient list APIs will return
+USER_LIST_MAX_LIMIT = 100
 
-    request_org_list = request.args.get('org_list', None)
+# Sortable user list columns, by the field names of the list templates
+USER_LIST_SORT_COLUMNS = {
+    'userid': User.id,
+    'username': User._email,
+    'firstname': User.first_name,
+    'lastname': User.last_name,
+    'email': User._email,
+}
 
-    if request_org_list:
-        org_list = set()
+UserListParameters = namedtuple(
+    'UserListParameters', ['query', 'limit', 'keys', 'order'])
+
+
+def user_list_parameters(query):
+    """Apply the request parameters shared by the user list APIs
+
+    Query parameters:
+      limit: page size, defaults to 10, at most USER_LIST_MAX_LIMIT
+      sort: column to sort by, one of USER_LIST_SORT_COLUMNS
+      order: 'asc' (default) or 'desc'
+      search: text to match against names, email or exact TrueNTH ID
+
+    :param query: the User query to list
+    :return: UserListParameters namedtuple, holding the query filtered by
+        any search, the page size, the keys to sort by and the order.
+        Text columns sort case insensitively, nulls as empty strings, and
+        the keys end with User.id to break ties.
+
+    """
+    search = request.args.get('search', '').strip()
+    if search:
+        pattern = u'%{}%'.format(search)
+        matches = [
+            User.first_name.ilike(pattern), User.last_name.ilike(pattern),
+            User._email.ilike(pattern)]
+        if search.isdigit():
+            matches.append(User.id == int(search))
+        query = query.filter(or_(*matches))
+
+    limit = min(check_int(request.args.get('limit', 10)),
+                USER_LIST_MAX_LIMIT)
+    if limit < 1:
+        abort(400, "limit must be positive")
+    sort = request.args.get('sort', 'userid')
+    if sort not in USER_LIST_SORT_COLUMNS:
+        abort(400, "sort must be one of: " + ", ".join(
+            sorted(USER_LIST_SORT_COLUMNS)))
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        abort(400, "order must be 'asc' or 'desc'")
+
+    if sort == 'userid':
+        keys = (User.id,)
+    else:
+        keys = (func.lower(func.coalesce(
+            USER_LIST_SORT_COLUMNS[sort], '')), User.id)
+    return UserListParameters(query, limit, keys, order)
+
+
+def user_list_keyset(params, *columns):
+    """Returns one page of the users listed by params, and the next cursor
+
+    Pages follow the `after` request parameter, the cursor returned with
+    the previous page (keyset pagination), so each page costs the same
+    regardless of its depth in the list.
+
+    :param params: UserListParameters, as from `user_list_parameters`
+    :param columns: additional columns to select with each user
+    :return: (rows, cursor) - rows holding the user and any `columns`,
+        and the cursor to the next page, or None on the last page
+
+    """
+    query, limit, keys, order = params
+    if request.args.get('after'):
+        try:
+            cursor = json.loads(urlsafe_b64decode(
+                request.args['after'].encode('ascii')))
+            assert len(cursor) == len(keys)
+        except (AssertionError, TypeError, ValueError):
+            abort(400, "invalid `after` cursor")
+        if order == 'asc':
+            query = query.filter(tuple_(*keys) > tuple_(*cursor))
+        else:
+            query = query.filter(tuple_(*keys) < tuple_(*cursor))
+    query = query.order_by(*(
+        key.asc() if order == 'asc' else key.desc() for key in keys))
+
+    rows = query.add_columns(*(columns + keys)).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = urlsafe_b64encode(
+            json.dumps(list(rows[-1][-len(keys):])))
+    return [row[:-len(keys)] for row in rows], next_cursor
+
+
+def staff_org_list(user, request_org_list=None):
+    """Returns ids of organizations whose patients the staff user lists
+
+    :param user: the staff user
+    :param request_org_list: optional comma separated string of
+        organization ids to filter by, in place of the user's own
+    :return: set of the organization ids, including all decendents
+
+    """
+    org_list = set()
+    # Build list of all organization ids, and their decendents, the
+    # user belongs to
+    OT = OrgTree()
 
+    if request_org_list:
         # for selected filtered orgs, we also need to get the children
         # of each, if any
         request_org_list = set(request_org_list.split(","))
@@ -636,23 +742,109 @@ def admin():
             check_int(orgId)
             if orgId == 0:  # None of the above doesn't count
                 continue
-            org_list.update(OrgTree().here_and_below_id(orgId))
+            org_list.update(OT.here_and_below_id(orgId))
+    else:
+        for org in user.organizations:
+            if org.id == 0:  # None of the above doesn't count
+                continue
+            org_list.update(OT.here_and_below_id(org.id))
+    return org_list
+
+
+def admin_list_query(org_list=None):
+    """Returns query for the users listed on the admin page
+
+    :param org_list: optional organization ids, as from `staff_org_list`;
+        if given, only users belonging to one of them are included
 
-        users = User.query.join(UserOrganization).filter(
-                    and_(User.deleted_id.is_(None),
-                         UserOrganization.user_id == User.id,
-                         UserOrganization.organization_id != 0,
-                         UserOrganization.organization_id.in_(org_list)))
+    """
+    users = User.query.filter(User.deleted_id.is_(None))
+    if org_list is not None:
+        users = users.filter(exists().where(and_(
+            UserOrganization.user_id == User.id,
+            UserOrganization.organization_id != 0,
+            UserOrganization.organization_id.in_(org_list or [-1]))))
+    return users
+
+
+def user_list_page(query):
+    """Returns JSON response with one page of the users in query
+
+    Searching, sorting and pagination are applied in SQL from the request
+    parameters (see `user_list_parameters` and `user_list_keyset`), and
+    each user's roles and organization names aggregated with `array_agg`
+    subqueries in the same statement, so a page costs a single query
+    (plus the count) however many users are listed.
+
+    """
+    params = user_list_parameters(query)
+    total = params.query.count()
+
+    roles = db.session.query(func.array_agg(Role.name)).join(
+        UserRoles).filter(UserRoles.user_id == User.id).correlate(
+            User).as_scalar()
+    organizations = db.session.query(
+        func.array_agg(Organization.name)).join(UserOrganization).filter(
+            UserOrganization.user_id == User.id).correlate(User).as_scalar()
+    rows, next_cursor = user_list_keyset(params, roles, organizations)
+
+    results = []
+    for user, role_names, org_names in rows:
+        results.append({
+            'userid': user.id,
+            'username': user.username,
+            'firstname': user.first_name,
+            'lastname': user.last_name,
+            'email': user.email,
+            'roles': sorted(role_names or []),
+            'organization': sorted(org_names or []),
+            'profile_url': url_for('portal.profile', user_id=user.id)})
+    d = {'total': total, 'rows': results}
+    if next_cursor:
+        d['next'] = next_cursor
+    return jsonify(d)
+
+
+@portal.route('/admin')
+@roles_required(ROLE.ADMIN)
+@oauth.require_oauth()
+def admin():
+    """user admin view function
+
+    The page lists the users a page at a time, from `admin_list`
+
+    """
+    request_org_list = request.args.get('org_list', None)
+
+    if request_org_list:
+        org_list = staff_org_list(
+            current_user(), request_org_list=request_org_list)
     else:
         org_list = Organization.query.all()
-        users = User.query.filter_by(deleted=None).all()
 
-    for u in users:
-        u.rolelist = ', '.join([r.name for r in u.roles])
-    return render_template('admin.html', users=users, wide_container="true",
+    return render_template('admin.html', wide_container="true",
                            org_list=list(org_list), user=current_user())
 
 
+@portal.route('/admin/list')
+@roles_required(ROLE.ADMIN)
+@oauth.require_oauth()
+def admin_list():
+    """Paginated user list, as JSON, for the admin page
+
+    Returns a page of the users `admin` lists, as filtered by the
+    optional `org_list` parameter (comma separated organization ids,
+    including their decendents).  See `user_list_page` for the search,
+    sort and pagination parameters.
+
+    """
+    org_list = None
+    if request.args.get('org_list'):
+        org_list = staff_org_list(
+            current_user(), request_org_list=request.args.get('org_list'))
+    return user_list_page(admin_list_query(org_list))
+
+
 @portal.route('/staff-profile-create')
 @roles_required(ROLE.STAFF_ADMIN)
 @oauth.require_oauth()
@@ -674,6 +866,39 @@ def staff_profile_create():
         consent_agreements=consent_agreements,
         org_list=list(org_list))
 
+
+def staff_list_query(user):
+    """Returns query for the staff listed for the given staff admin
+
+    Includes staff belonging to any of the staff admin's organizations
+    (and their children), excluding staff admins and admins at the same
+    organization(s) as the staff admin, as they should NOT be able to
+    edit their records.
+
+    """
+    org_list = staff_org_list(user)
+    user_orgs = set(org.id for org in user.organizations if org.id != 0)
+    if not org_list:
+        return User.query.filter(User.id == -1)
+
+    def with_role(*role_names):
+        return exists().where(and_(
+            UserRoles.user_id == User.id,
+            UserRoles.role_id == Role.id,
+            Role.name.in_(role_names)))
+
+    def in_orgs(org_ids):
+        return exists().where(and_(
+            UserOrganization.user_id == User.id,
+            UserOrganization.organization_id.in_(org_ids)))
+
+    admin_staff = and_(
+        with_role(ROLE.ADMIN, ROLE.STAFF_ADMIN), in_orgs(user_orgs))
+    return User.query.filter(
+        User.deleted_id.is_(None), with_role(ROLE.STAFF), in_orgs(org_list),
+        ~admin_staff)
+
+
 @portal.route('/staff')
 @roles_required(ROLE.STAFF_ADMIN)
 @oauth.require_oauth()
@@ -681,64 +906,25 @@ def staff():
     """staff view function, intended for staff admin
 
     Present the logged in staff admin the list of staff matching
-    the staff admin's organizations (and any decendent organizations)
+    the staff admin's organizations (and any decendent organizations),
+    a page at a time from `staff_list`
 
     """
-    user = current_user()
-
-    OT = OrgTree()
-
-    staff_role_id = Role.query.filter(
-        Role.name==ROLE.STAFF).with_entities(Role.id).first()
-    admin_role_id = Role.query.filter(
-        Role.name==ROLE.ADMIN).with_entities(Role.id).first()
-    staff_admin_role_id = Role.query.filter(
-        Role.name==ROLE.STAFF_ADMIN).with_entities(Role.id).first()
-
-    # empty patient query list to start, unionize with other relevant lists
-    staff_list = User.query.filter(User.id==-1)
+    return render_template(
+        'staff_by_org.html', user=current_user(), wide_container="true")
 
-    org_list = set()
 
-    user_orgs = set()
+@portal.route('/staff/list')
+@roles_required(ROLE.STAFF_ADMIN)
+@oauth.require_oauth()
+def staff_list():
+    """Paginated staff list, as JSON, intended for staff admin
 
-    # Build list of all organization ids, and their decendents, the
-    # user belongs to
-    for org in user.organizations:
-        if org.id == 0:  # None of the above doesn't count
-            continue
-        org_list.update(OT.here_and_below_id(org.id))
-        user_orgs.add(org.id)
-
-    #Gather up all staff admin and admin that belongs to user's org(s)
-    admin_staff = User.query.join(UserRoles).filter(
-        and_(User.id==UserRoles.user_id,
-             UserRoles.role_id.in_([admin_role_id, staff_admin_role_id]),
-             User.deleted_id.is_(None)
-             )
-        ).join(UserOrganization).filter(
-            and_(UserOrganization.user_id==User.id,
-                 UserOrganization.organization_id.in_(user_orgs)))
-    admin_list = [u.id for u in admin_staff]
-
-
-    # Gather up all staff belonging to any of the orgs (and their children)
-    # NOTE, need to exclude staff_admin or admin user at the same org(s) as the user
-    # as the user should NOT be able to edit their record
-    org_staff = User.query.join(UserRoles).filter(
-        and_(User.id==UserRoles.user_id,
-            ~User.id.in_(admin_list),
-             UserRoles.role_id==staff_role_id,
-             User.deleted_id.is_(None)
-             )
-        ).join(UserOrganization).filter(
-            and_(UserOrganization.user_id==User.id,
-                 UserOrganization.organization_id.in_(org_list)))
-    staff_list = staff_list.union(org_staff)
+    Returns a page of the staff `staff` lists.  See `user_list_page`
+    for the search, sort and pagination parameters.
 
-    return render_template(
-        'staff_by_org.html', staff_list=staff_list.all(),
-        user=user, wide_container="true")
+    """
+    return user_list_page(staff_list_query(current_user()))
 
 
 @portal.route('/invite', methods=('GET', 'POST'))
@@ -1044,7 +1230,7 @@ def reporting_dashboard():
 
     """
     return render_template('reporting_dashboard.html', now=datetime.utcnow(),
-                           counts=get_reporting_stats())
+                           counts=current_reporting_stats())
 
 
 @portal.route('/spec')
@@ -0,0 +1,51 @@
+"""Schema registry for validating FHIR input
+
+The swagger definitions are gathered by parsing the docstring of every
+view function, far too expensive to repeat for each request.  Definitions
+are built once per application, and a compiled JSON schema validator is
+kept for each resource type, for use by any view validating input.
+
+"""
+from flask import current_app
+from flask_swagger import swagger
+import jsonschema
+
+
+def _registry():
+    """Returns the current application's registry dictionary"""
+    return current_app.extensions.setdefault('schema_registry', {})
+
+
+def swagger_definitions():
+    """Returns swagger definitions, built on first access"""
+    registry = _registry()
+    if 'definitions' not in registry:
+        registry['definitions'] = swagger(current_app)['definitions']
+    return registry['definitions']
+
+
+def validator(resource_type):
+    """Returns validator for the given resource type
+
+    :param resource_type: name of the swagger definition to validate
+        against, such as 'QuestionnaireResponse'
+    :return: compiled `jsonschema.Draft4Validator`; `validate()` raises
+        `jsonschema.ValidationError` on invalid input
+    :raises KeyError: if no definition exists for resource_type
+
+    """
+    validators = _registry().setdefault('validators', {})
+    if resource_type not in validators:
+        definitions = swagger_definitions()
+        if resource_type not in definitions:
+            raise KeyError("no schema defined for {}".format(resource_type))
+        draft4_schema = {
+            '$schema': 'http://json-schema.org/draft-04/schema#',
+            'type': 'object',
+            'definitions': definitions,
+        }
+        # Copy desired schema (to validate against) to outermost dict
+        draft4_schema.update(definitions[resource_type])
+        jsonschema.Draft4Validator.check_schema(draft4_schema)
+        validators[resource_type] = jsonschema.Draft4Validator(draft4_schema)
+    return validators[resource_type]
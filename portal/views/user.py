@@ -362,7 +362,7 @@ def access_url(user_id):
     if user.deleted:
         abort(400, "deleted user - operation not permitted")
     not_allowed = {ROLE.ADMIN, ROLE.APPLICATION_DEVELOPER, ROLE.SERVICE}
-    has = set([role.name for role in user.roles])
+    has = user.role_names
     if not has.isdisjoint(not_allowed):
         abort(400, "Access URL not provided for privileged accounts")
 
@@ -10,11 +10,14 @@ options:
 from datetime import datetime
 from flask_testing import TestCase as Base
 from flask_webtest import SessionScope
+import json
 from sqlalchemy.exc import IntegrityError
 
 from portal.factories.app import create_app
 from portal.config import TestConfig
 from portal.extensions import db
+from portal.models.app_text import CachedResponse, CONTENT_REFRESH_PREFIX
+from portal.models.app_text import store_content, _content_cache_key
 from portal.models.assessment_status import invalidate_assessment_status_cache
 from portal.models.audit import Audit
 from portal.models.auth import Client
@@ -33,6 +36,7 @@ from portal.models.user import User, UserRoles, get_user
 from portal.models.user_consent import UserConsent, SEND_REMINDERS_MASK
 from portal.models.user_consent import STAFF_EDITABLE_MASK
 from portal.models.user_consent import INCLUDE_IN_REPORTS_MASK
+from portal.redis_client import redis_client
 from portal.system_uri import SNOMED
 
 TEST_USER_ID = 1
@@ -246,6 +250,21 @@ class TestCase(Base):
             db.session.commit()
         OrgTree.invalidate_cache()
 
+    def cache_content(self, url, **fields):
+        """Serve JSON `fields` for `url` from the content cache
+
+        Enables the content cache for the test, so the remote server is
+        never reached for `url`.  The entry is removed after the test.
+
+        """
+        keys = (_content_cache_key(url),
+                _content_cache_key(url, prefix=CONTENT_REFRESH_PREFIX))
+        redis_client().delete(*keys)
+        self.addCleanup(redis_client().delete, *keys)
+        self.app.config['CONTENT_CACHE_FRESH'] = 60
+        store_content(CachedResponse(
+            url=url, status_code=200, reason='OK', text=json.dumps(fields)))
+
     def add_concepts(self):
         """Only tests needing concepts should load - VERY SLOW
 
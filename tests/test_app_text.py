@@ -1,11 +1,16 @@
 """Unit test module for app_text"""
 from flask import render_template
 from flask_webtest import SessionScope
+from requests.exceptions import ConnectionError
 
 from portal.extensions import db
 from portal.models.app_text import AppText, app_text, VersionedResource
 from portal.models.app_text import UnversionedResource, MailResource
+from portal.models.app_text import CONTENT_REFRESH_PREFIX
+from portal.models.app_text import cached_content, refresh_content
+from portal.models.app_text import store_content, _content_cache_key
 from portal.models.user import User
+from portal.redis_client import redis_client
 from tests import TestCase, TEST_USER_ID
 
 
@@ -132,3 +137,29 @@ class TestAppText(TestCase):
         # test footer optionality
         tmr._footer = None
         self.assertEquals(len(tmr.body.splitlines()), 1)
+
+    def test_content_cache(self):
+        url = "https://notarealwebsitebeepboop.com/detailed"
+        self.cache_content(url, asset='Hello {name}', version='1.2')
+
+        # served from the cache, without reaching the (fake) server
+        resource = VersionedResource(url, variables={'name': 'Bob'})
+        self.assertEquals(resource.asset, 'Hello Bob')
+        self.assertEquals(
+            resource.url, "https://notarealwebsitebeepboop.com?version=1.2")
+
+        # stale content is still served, while a refresh is underway
+        stale = cached_content(url)
+        stale.fetched_at -= 120
+        store_content(stale)
+        redis_client().set(
+            _content_cache_key(url, prefix=CONTENT_REFRESH_PREFIX), 1)
+        resource = VersionedResource(url, variables={'name': 'Bob'})
+        self.assertEquals(resource.asset, 'Hello Bob')
+
+        # a failed refresh keeps the stale content, and ends the refresh
+        self.assertRaises(ConnectionError, refresh_content, url)
+        self.assertFalse(redis_client().exists(
+            _content_cache_key(url, prefix=CONTENT_REFRESH_PREFIX)))
+        self.assertEquals(redis_client().get(
+            _content_cache_key(url)), stale.as_json())
@@ -5,6 +5,7 @@ from flask_webtest import SessionScope
 
 from portal.extensions import db
 from portal.models.audit import Audit
+from portal.models.fhir import annotated_responses
 from portal.models.organization import Organization
 from portal.models.role import ROLE
 from portal.models.questionnaire import Questionnaire
@@ -12,6 +13,7 @@ from portal.models.questionnaire_bank import QuestionnaireBank
 from portal.models.questionnaire_bank import QuestionnaireBankQuestionnaire
 from portal.models.user import get_user
 from portal.models.user_consent import UserConsent
+from portal.views.schema import validator
 from tests import TestCase, TEST_USER_ID
 
 class TestAssessmentEngine(TestCase):
@@ -35,6 +37,26 @@ class TestAssessmentEngine(TestCase):
             self.test_user.questionnaire_responses[0].encounter.auth_method,
             'password_authenticated')
 
+    def test_submit_invalid_assessment(self):
+        swagger_spec = swagger(self.app)
+        data = swagger_spec['definitions']['QuestionnaireResponse']['example']
+        data['status'] = 'bogus'
+
+        self.login()
+        rv = self.client.post(
+            '/api/patient/{}/assessment'.format(TEST_USER_ID),
+            content_type='application/json',
+            data=json.dumps(data),
+        )
+        self.assert200(rv)
+        self.assertEquals(rv.json['ok'], False)
+        self.assertEquals(self.test_user.questionnaire_responses.count(), 0)
+
+    def test_validator_cache(self):
+        compiled = validator('QuestionnaireResponse')
+        self.assertIs(validator('QuestionnaireResponse'), compiled)
+        self.assertRaises(KeyError, validator, 'NoSuchResource')
+
     def test_submit_assessment_for_qb(self):
         swagger_spec = swagger(self.app)
         data = swagger_spec['definitions']['QuestionnaireResponse']['example']
@@ -187,6 +209,42 @@ class TestAssessmentEngine(TestCase):
         self.assertEquals(response['total'], len(response['entry']))
         self.assertTrue(response['entry'][0]['questionnaire']['reference'].endswith(instrument_id))
 
+    def test_assessments_ndjson(self):
+        swagger_spec = swagger(self.app)
+        example_data = swagger_spec['definitions']['QuestionnaireResponse']['example']
+
+        self.login()
+        self.bless_with_basics()
+        self.promote_user(role_name=ROLE.STAFF)
+        self.promote_user(role_name=ROLE.PATIENT)
+
+        for i in range(3):
+            example_data['identifier']['value'] = str(i)
+            upload = self.client.post(
+                '/api/patient/{}/assessment'.format(TEST_USER_ID),
+                content_type='application/json',
+                data=json.dumps(example_data),
+            )
+            self.assert200(upload)
+
+        bundle = self.client.get('/api/patient/assessment').json
+        rv = self.client.get('/api/patient/assessment?format=ndjson')
+        self.assert200(rv)
+        lines = [json.loads(l) for l in rv.data.splitlines()]
+        self.assertEquals(len(lines), 3)
+        self.assertEquals(lines, bundle['entry'])
+        self.test_user = db.session.merge(self.test_user)
+        self.assertEquals(
+            lines[0]['subject']['identifier'][0]['value'], str(TEST_USER_ID))
+        self.assertEquals(
+            lines[0]['subject']['careProvider'][0]['display'],
+            self.test_user.organizations[0].name)
+
+        # batching yields the same results
+        self.assertEquals(list(annotated_responses(
+            instrument_ids=[], current_user=self.test_user,
+            batch_size=2)), lines)
+
     def test_assessments_csv(self):
         swagger_spec = swagger(self.app)
         example_data = swagger_spec['definitions']['QuestionnaireResponse']['example']
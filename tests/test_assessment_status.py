@@ -9,6 +9,12 @@ from portal.models.audit import Audit
 from portal.models.fhir import CC
 from portal.models.intervention import INTERVENTION
 from portal.models.assessment_status import AssessmentStatus
+from portal.models.assessment_status import bulk_overall_assessment_status
+from portal.models.assessment_status import cached_overall_assessment_status
+from portal.models.assessment_status import overall_assessment_status
+from portal.models.assessment_status import qnr_status_by_instrument
+from portal.models.assessment_status import recent_qnr_status
+from portal.models.assessment_status import refresh_assessment_status_cache
 from portal.models.encounter import Encounter
 from portal.models.organization import Organization
 from portal.models.questionnaire import Questionnaire
@@ -456,6 +462,94 @@ class TestAssessmentStatus(TestQuestionnaireSetup):
             set(a_s.instruments_needing_full_assessment()),
             metastatic_4)
 
+    def test_qnr_status_by_instrument(self):
+        mock_qr(user_id=TEST_USER_ID, instrument_id='epic26')
+        mock_qr(user_id=TEST_USER_ID, instrument_id='epic26',
+                status='in-progress')
+        mock_qr(user_id=TEST_USER_ID, instrument_id='comorb')
+        self.test_user = db.session.merge(self.test_user)
+
+        qnr = QuestionnaireResponse.query.first()
+        self.assertEquals(qnr.questionnaire_name, 'epic26')
+
+        results = qnr_status_by_instrument([TEST_USER_ID])
+        self.assertEquals(
+            set(results[TEST_USER_ID].keys()), set(('epic26', 'comorb')))
+        self.assertEquals(
+            set(results[TEST_USER_ID]['epic26'].keys()),
+            set(('completed', 'in-progress')))
+
+        results = qnr_status_by_instrument([TEST_USER_ID], ['comorb'])
+        self.assertEquals(results[TEST_USER_ID].keys(), ['comorb'])
+        self.assertEquals(
+            recent_qnr_status(self.test_user, 'comorb'),
+            results[TEST_USER_ID]['comorb'])
+        self.assertFalse(qnr_status_by_instrument([TEST_USER_ID], []))
+
+    def test_bulk_localized_in_process(self):
+        self.bless_with_basics()
+        self.mark_localized()
+        mock_qr(user_id=TEST_USER_ID, instrument_id='eproms_add')
+        self.test_user = db.session.merge(self.test_user)
+
+        a_s = AssessmentStatus(user=self.test_user)
+        qbd = QuestionnaireBank.most_current_qb(self.test_user)
+        results = bulk_overall_assessment_status([TEST_USER_ID])
+        self.assertEquals(results[TEST_USER_ID], (a_s.overall_status, qbd))
+        self.assertEquals(results[TEST_USER_ID][0], "In Progress")
+
+    def test_bulk_secondary_recur_due(self):
+        self.bless_with_basics(backdate=relativedelta(months=6))
+        self.mark_metastatic()
+        self.test_user = db.session.merge(self.test_user)
+
+        qbd = QuestionnaireBank.most_current_qb(self.test_user)
+        status, bulk_qbd = bulk_overall_assessment_status(
+            [TEST_USER_ID])[TEST_USER_ID]
+        self.assertEquals(status, "Due")
+        self.assertEquals(bulk_qbd, qbd)
+        self.assertEquals(
+            bulk_qbd.questionnaire_bank.name, 'metastatic_recurring4')
+
+    def test_bulk_without_consent(self):
+        self.mark_localized()
+        self.test_user = db.session.merge(self.test_user)
+        status, qbd = bulk_overall_assessment_status(
+            [TEST_USER_ID])[TEST_USER_ID]
+        self.assertEquals(status, 'Expired')
+        self.assertIsNone(qbd.questionnaire_bank)
+
+    def test_bulk_cache_refresh(self):
+        self.bless_with_basics()
+        self.mark_localized()
+        self.test_user = db.session.merge(self.test_user)
+
+        self.assertEquals(refresh_assessment_status_cache([TEST_USER_ID]), 1)
+        status, qbd = overall_assessment_status(TEST_USER_ID)
+        self.assertEquals(status, 'Due')
+        self.assertEquals(qbd.questionnaire_bank.name, 'localized')
+
+    def test_cached_lookup(self):
+        self.bless_with_basics()
+        self.mark_localized()
+        self.test_user = db.session.merge(self.test_user)
+        invalidate_assessment_status_cache(TEST_USER_ID)
+
+        # miss is computed and cached
+        statuses = cached_overall_assessment_status([TEST_USER_ID])
+        self.assertEquals(statuses[TEST_USER_ID][0], 'Due')
+        self.assertEquals(
+            statuses[TEST_USER_ID][1].questionnaire_bank.name, 'localized')
+        status, qbd = overall_assessment_status(TEST_USER_ID)
+        self.assertEquals(status, 'Due')
+
+        # hit is read from the cache
+        refresh_assessment_status_cache(statuses={
+            TEST_USER_ID: ('Expired', qbd)})
+        statuses = cached_overall_assessment_status([TEST_USER_ID])
+        self.assertEquals(statuses[TEST_USER_ID][0], 'Expired')
+        invalidate_assessment_status_cache(TEST_USER_ID)
+
     def test_batch_lookup(self):
         self.login()
         self.bless_with_basics()
@@ -467,6 +561,15 @@ class TestAssessmentStatus(TestQuestionnaireSetup):
             rv.json['status'][0]['consents'][0]['assessment_status'],
             'Expired')
 
+    def test_batch_lookup_unpermitted(self):
+        other_id = self.add_user('other@example.com').id
+        self.login()
+        self.bless_with_basics()
+        rv = self.client.get(
+            '/api/consent-assessment-status?user_id=1&user_id={}'.format(
+                other_id))
+        self.assert401(rv)
+
     def test_none_org(self):
         # check users w/ none of the above org
         self.test_user.organizations.append(Organization.query.get(0))
@@ -535,3 +638,19 @@ class TestTnthAssessmentStatus(TestQuestionnaireSetup):
             audit=Audit(user_id=TEST_USER_ID, subject_id=TEST_USER_ID))
         self.assertFalse(
             QuestionnaireBank.qbs_for_user(self.test_user, 'baseline'))
+
+    def test_bulk_intervention_qb(self):
+        self.promote_user(role_name=ROLE.PATIENT)
+        self.login()
+        self.add_required_clinical_data(backdate=relativedelta(days=31))
+        self.test_user = db.session.merge(self.test_user)
+
+        a_s = AssessmentStatus(user=self.test_user)
+        qbd = QuestionnaireBank.most_current_qb(self.test_user)
+        self.assertEquals(qbd.questionnaire_bank.name, 'symptom_tracker')
+
+        # users no longer found are left out, not fatal to the cohort
+        missing_id = TEST_USER_ID + 1000
+        results = bulk_overall_assessment_status([missing_id, TEST_USER_ID])
+        self.assertEquals(results[TEST_USER_ID], (a_s.overall_status, qbd))
+        self.assertNotIn(missing_id, results)
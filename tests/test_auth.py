@@ -5,7 +5,10 @@ from flask_webtest import SessionScope
 from werkzeug.exceptions import Unauthorized
 
 from portal.extensions import db
-from portal.models.auth import Client, Token, create_service_token
+from portal.models.auth import CachedToken, Client, Grant, Token
+from portal.models.auth import create_service_token
+from portal.models.auth import invalidate_cached_tokens, load_token
+from portal.models.auth import purge_expired
 from portal.models.auth import validate_origin
 from portal.models.intervention import INTERVENTION
 from portal.models.role import ROLE
@@ -190,6 +193,85 @@ class TestAuth(TestCase):
         data = rv.json
         self.assertAlmostEquals(30, data['expires_in'], delta=5)
 
+    def test_token_cache(self):
+        self.app.config['OAUTH_TOKEN_CACHE_TTL'] = 60
+        invalidate_cached_tokens(['cached-token'])  # from prior runs
+        with SessionScope(db):
+            client = Client(
+                client_id='test-id', client_secret='test-secret',
+                user_id=TEST_USER_ID)
+            token = Token(
+                access_token='cached-token', client=client,
+                user_id=TEST_USER_ID, token_type='bearer', _scopes='email',
+                expires=(datetime.datetime.utcnow() +
+                         datetime.timedelta(seconds=30)))
+            db.session.add(client)
+            db.session.add(token)
+            db.session.commit()
+
+        # First lookup hits the db, populating the cache
+        self.assertIsInstance(load_token(access_token='cached-token'), Token)
+        cached = load_token(access_token='cached-token')
+        self.assertIsInstance(cached, CachedToken)
+        self.assertEquals(cached.user.id, TEST_USER_ID)
+        self.assertEquals(cached.client_id, 'test-id')
+        self.assertEquals(cached.scopes, ['email'])
+        self.assertAlmostEquals(
+            (cached.expires - datetime.datetime.utcnow()).total_seconds(),
+            30, delta=5)
+
+        # Deleting the token invalidates the cache
+        with SessionScope(db):
+            db.session.delete(Token.query.filter_by(
+                access_token='cached-token').one())
+            db.session.commit()
+        self.assertIsNone(load_token(access_token='cached-token'))
+
+        # As does deleting the token's user
+        other = self.add_user('other@example.com')
+        other_id = other.id
+        with SessionScope(db):
+            db.session.add(Token(
+                access_token='cached-token', client_id='test-id',
+                user_id=other_id, token_type='bearer'))
+            db.session.commit()
+        load_token(access_token='cached-token')
+        self.assertIsInstance(
+            load_token(access_token='cached-token'), CachedToken)
+        User.query.get(other_id).delete_user(
+            acting_user=User.query.get(TEST_USER_ID))
+        self.assertIsNone(load_token(access_token='cached-token'))
+
+    def test_purge_expired(self):
+        now = datetime.datetime.utcnow()
+        hour, month = datetime.timedelta(hours=1), datetime.timedelta(days=31)
+        with SessionScope(db):
+            db.session.add(Client(
+                client_id='test-id', client_secret='test-secret',
+                user_id=TEST_USER_ID))
+            for i, expires in enumerate((now - hour, now - hour, now + hour)):
+                db.session.add(Grant(
+                    client_id='test-id', user_id=TEST_USER_ID,
+                    code='code{}'.format(i), expires=expires))
+            for i, (expires, refresh) in enumerate((
+                    (now - hour, None), (now - month, None),
+                    (now - hour, 'refresh'), (now - month, 'refresh2'),
+                    (now + hour, None))):
+                db.session.add(Token(
+                    client_id='test-id', user_id=TEST_USER_ID,
+                    access_token='token{}'.format(i), refresh_token=refresh,
+                    token_type='bearer', expires=expires))
+            db.session.commit()
+
+        # Expired tokens with a refresh token are kept for the retention
+        self.assertEquals(
+            purge_expired(batch_size=1), {'grants': 2, 'tokens': 3})
+        self.assertEquals(Grant.query.count(), 1)
+        self.assertEquals(
+            sorted(t.access_token for t in Token.query),
+            ['token2', 'token4'])
+        self.assertEquals(purge_expired(), {'grants': 0, 'tokens': 0})
+
     def test_token_status_wo_header(self):
         """Call for token_status w/o token should return 401"""
         rv = self.client.get("/oauth/token-status")
@@ -1,11 +1,16 @@
 """Unit test module for communication"""
-from datetime import timedelta
+from datetime import datetime, timedelta
+from flask_mail import Connection
 from flask_webtest import SessionScope
+import smtplib
 
 from portal.database import db
+from portal.extensions import mail
 from portal.models.audit import Audit
 from portal.models.assessment_status import overall_assessment_status
 from portal.models.communication import Communication, DynamicDictLookup
+from portal.models.communication import dispatch_communications
+from portal.models.communication import MESSAGE_PRIORITY, ready_communications
 from portal.models.communication import load_template_args
 from portal.models.communication_request import CommunicationRequest
 from portal.models.fhir import CC
@@ -16,6 +21,7 @@ from portal.models.role import ROLE
 from portal.system_uri import ICHOM, TRUENTH_CR_NAME
 from portal.tasks import update_patient_loop
 from portal.models.user import NO_EMAIL_PREFIX
+from portal.rate_limit import TokenBucket
 from tests import TEST_USER_ID, TEST_USERNAME
 from tests.test_assessment_status import TestQuestionnaireSetup, mock_qr
 from tests.test_assessment_status import symptom_tracker_instruments
@@ -46,6 +52,30 @@ def mock_communication_request(
     return db.session.merge(cr)
 
 
+class FakeSMTP(object):
+    """Stands in for smtplib.SMTP, recording the recipients of mail sent
+
+    :param accept: messages accepted before the server disconnects
+    :param quit_error: set to fail on quit, as when the server has
+        already dropped the connection
+
+    """
+    def __init__(self, accept=None, quit_error=False):
+        self.accept = accept
+        self.quit_error = quit_error
+        self.recipients = []
+
+    def sendmail(self, from_addr, to_addrs, msg, *args):
+        if self.accept is not None and len(self.recipients) >= self.accept:
+            raise smtplib.SMTPServerDisconnected(
+                "Connection unexpectedly closed")
+        self.recipients.append(to_addrs)
+
+    def quit(self):
+        if self.quit_error:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+
+
 class TestCommunication(TestQuestionnaireSetup):
     # by inheriting from TestQuestionnaireSetup, pick up the
     # same mocking done for interacting with QuestionnaireBanks et al
@@ -133,6 +163,19 @@ class TestCommunication(TestQuestionnaireSetup):
         expected = Communication.query.first()
         self.assertEquals(expected.user_id, TEST_USER_ID)
 
+    def test_account_message_priority(self):
+        cr = mock_communication_request('localized', '{"days": 14}')
+        self.cache_content(
+            cr.content_url, subject='Welcome',
+            body='Please confirm {verify_account_button}')
+
+        self.bless_with_basics(backdate=timedelta(days=14))
+        self.promote_user(role_name=ROLE.PATIENT)
+        self.mark_localized()
+        update_patient_loop(update_cache=False, queue_messages=True)
+        expected = Communication.query.first()
+        self.assertEquals(expected.priority, MESSAGE_PRIORITY['account'])
+
     def test_noworkdone_message(self):
         # At 14 days with no work started, should generate message
 
@@ -230,6 +273,184 @@ class TestCommunication(TestQuestionnaireSetup):
         self.assertEquals(comm.status, 'completed')
 
 
+    def test_dispatch_communications(self):
+        self.add_user('__system__')
+        self.bless_with_basics()
+        cr = mock_communication_request('localized', '{"days": 14}')
+        content_url = cr.content_url
+        no_email = self.add_user('no_email@example.com')
+        no_email.email = NO_EMAIL_PREFIX
+
+        # serve the message content from the content cache, rather than
+        # the remote server
+        self.cache_content(
+            content_url, subject='Reminder', body='Please visit',
+            footer='Thanks')
+
+        with SessionScope(db):
+            cr = db.session.merge(cr)
+            db.session.add(Communication(
+                user_id=TEST_USER_ID, communication_request=cr,
+                status='preparation'))
+            db.session.add(Communication(
+                user_id=no_email.id, communication_request=cr,
+                status='preparation'))
+            db.session.commit()
+        no_email_id = db.session.merge(no_email).id
+
+        with mail.record_messages() as outbox:
+            stats = dispatch_communications(batch_size=1)
+
+        self.assertEquals((stats['sent'], stats['failed']), (1, 1))
+        self.assertEquals(1, len(outbox))
+        self.assertEquals([TEST_USERNAME], outbox[0].recipients)
+        sent = Communication.query.filter_by(user_id=TEST_USER_ID).one()
+        self.assertEquals(sent.status, 'completed')
+        self.assertEquals(sent.message.subject, 'Reminder')
+        failed = Communication.query.filter_by(user_id=no_email_id).one()
+        self.assertEquals(failed.status, 'preparation')
+        self.assertIsNone(failed.message_id)
+        self.assertEquals(1, Audit.query.filter(
+            Audit.comment.like("EmailMessage 'Reminder' sent%")).count())
+
+    def use_smtp(self, host):
+        """Connect to `host`, a FakeSMTP, for mail sent in the test"""
+        state = self.app.extensions['mail']
+        self.addCleanup(setattr, state, 'suppress', state.suppress)
+        self.addCleanup(
+            setattr, Connection, 'configure_host',
+            Connection.__dict__['configure_host'])
+        state.suppress = False
+        Connection.configure_host = lambda connection: host
+
+    def test_dispatch_quit_error(self):
+        self.add_user('__system__')
+        self.bless_with_basics()
+        cr = mock_communication_request('localized', '{"days": 14}')
+        cr_id, content_url = cr.id, cr.content_url
+        other_id = self.add_user('other@example.com').id
+        self.cache_content(
+            content_url, subject='Reminder', body='Please visit')
+        with SessionScope(db):
+            for user_id in (TEST_USER_ID, other_id):
+                db.session.add(Communication(
+                    user_id=user_id, communication_request_id=cr_id,
+                    status='preparation'))
+            db.session.commit()
+
+        # messages the server accepted are sent, though quit fails
+        host = FakeSMTP(quit_error=True)
+        self.use_smtp(host)
+        stats = dispatch_communications(batch_size=1)
+        self.assertEquals((stats['sent'], stats['failed']), (2, 0))
+        self.assertEquals(
+            [[TEST_USERNAME], ['other@example.com']], host.recipients)
+        self.assertEquals(2, Communication.query.filter_by(
+            status='completed').count())
+
+    def test_dispatch_disconnect(self):
+        self.add_user('__system__')
+        self.bless_with_basics()
+        cr = mock_communication_request('localized', '{"days": 14}')
+        cr_id, content_url = cr.id, cr.content_url
+        user_ids = [TEST_USER_ID] + [
+            self.add_user('user{}@example.com'.format(i)).id
+            for i in range(2)]
+        self.cache_content(
+            content_url, subject='Reminder', body='Please visit')
+        with SessionScope(db):
+            for user_id in user_ids:
+                db.session.add(Communication(
+                    user_id=user_id, communication_request_id=cr_id,
+                    status='preparation'))
+            db.session.commit()
+
+        # the connection drops after the first message; the rest are
+        # left for the next run, without counting an attempt
+        self.use_smtp(FakeSMTP(accept=1))
+        stats = dispatch_communications()
+        self.assertEquals((stats['sent'], stats['failed']), (1, 0))
+        sent = Communication.query.filter_by(user_id=TEST_USER_ID).one()
+        self.assertEquals(sent.status, 'completed')
+        for user_id in user_ids[1:]:
+            unsent = Communication.query.filter_by(user_id=user_id).one()
+            self.assertEquals(
+                (unsent.status, unsent.attempts, unsent.message_id),
+                ('preparation', 0, None))
+            self.assertIsNone(unsent.last_error)
+        self.assertEquals(2, ready_communications().count())
+
+    def test_dispatch_priority_and_retry(self):
+        self.add_user('__system__')
+        self.bless_with_basics()
+        cr = mock_communication_request('localized', '{"days": 14}')
+        cr_id, content_url = cr.id, cr.content_url
+        other_id = self.add_user('other@example.com').id
+        no_email = self.add_user('no_email@example.com')
+        no_email.email = NO_EMAIL_PREFIX
+        no_email_id = no_email.id
+
+        self.cache_content(
+            content_url, subject='Reminder', body='Please visit')
+        self.app.config['MAIL_MAX_ATTEMPTS'] = 2
+        self.app.config['MAIL_RETRY_DELAY'] = 60
+        self.app.config['MAIL_RECIPIENT_RATE_LIMIT'] = 1.0 / 600
+        self.app.config['MAIL_RECIPIENT_BURST'] = 1
+        limits = dict((email, TokenBucket(
+            'mail-recipient:{}'.format(email), rate=1.0 / 600, capacity=1))
+            for email in (TEST_USERNAME, 'other@example.com'))
+        for bucket in limits.values():
+            bucket.reset()
+
+        with SessionScope(db):
+            for user_id, priority in (
+                    (TEST_USER_ID, MESSAGE_PRIORITY['reminder']),
+                    (other_id, MESSAGE_PRIORITY['account']),
+                    (no_email_id, MESSAGE_PRIORITY['reminder'])):
+                db.session.add(Communication(
+                    user_id=user_id, communication_request_id=cr_id,
+                    status='preparation', priority=priority))
+            db.session.commit()
+
+        # messages deferred on the recipient's limit aren't generated
+        generated = []
+        generate_message = Communication.generate_message
+        self.addCleanup(
+            setattr, Communication, 'generate_message', generate_message)
+
+        def record_generation(communication):
+            generated.append(communication.user_id)
+            return generate_message(communication)
+        Communication.generate_message = record_generation
+
+        # account messages go first; test user is over their limit
+        self.assertEquals(0, limits[TEST_USERNAME].take())
+        with mail.record_messages() as outbox:
+            stats = dispatch_communications()
+        self.assertEquals(
+            (1, 1, 1), (stats['sent'], stats['failed'], stats['deferred']))
+        self.assertEquals(['other@example.com'], outbox[0].recipients)
+        deferred = Communication.query.filter_by(user_id=TEST_USER_ID).one()
+        self.assertEquals(
+            (deferred.status, deferred.attempts), ('preparation', 0))
+        self.assertTrue(deferred.next_attempt_at > datetime.utcnow())
+        self.assertNotIn(TEST_USER_ID, generated)
+        failed = Communication.query.filter_by(user_id=no_email_id).one()
+        self.assertEquals((failed.status, failed.attempts), ('preparation', 1))
+        self.assertIn('valid email', failed.last_error)
+
+        # nothing is due, till the retry delay has passed
+        self.assertEquals(0, dispatch_communications()['failed'])
+        failed.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        stats = dispatch_communications()
+        self.assertEquals(1, stats['aborted'])
+        failed = Communication.query.filter_by(user_id=no_email_id).one()
+        self.assertEquals((failed.status, failed.attempts), ('aborted', 2))
+        self.assertEquals(
+            0, ready_communications().filter_by(user_id=no_email_id).count())
+
+
 class TestCommunicationTnth(TestQuestionnaireSetup):
     # by inheriting from TestQuestionnaireSetup, pick up the
     # same mocking done for interacting with QuestionnaireBanks et al
@@ -5,11 +5,13 @@ import json
 
 from portal.extensions import db
 from portal.models.auth import AuthProvider
+from portal.models.fhir import Coding
 from portal.models.organization import Organization, OrgTree
 from portal.models.organization import OrganizationIdentifier
 from portal.models.identifier import Identifier
 from portal.models.role import ROLE
-from portal.models.user import User
+from portal.models.user import User, patients_as_fhir
+from portal.system_uri import TRUENTH_ID
 
 
 class TestDemographics(TestCase):
@@ -347,3 +349,52 @@ class TestDemographics(TestCase):
                 self.fail(
                     'unexpected telecom system: {}'.format(item['system']))
 
+
+    def test_demographics_bundle(self):
+        self.shallow_org_tree()
+        org = Organization.query.filter(Organization.id > 0).first()
+        race = Coding(
+            system='http://hl7.org/fhir/v3/Race', code='1096-7',
+            display='Cheyenne')
+        ap = AuthProvider(provider='facebook', provider_id='fb-123',
+                          user_id=TEST_USER_ID)
+        second = self.add_user(username='second@example.com')
+        with SessionScope(db):
+            db.session.add(ap)
+            user = User.query.get(TEST_USER_ID)
+            user.organizations.append(org)
+            user.races.append(race)
+            db.session.commit()
+        second_id = db.session.merge(second).id
+
+        # prime the implicit identifiers, as the bulk path defers to
+        # `User.identifiers` when any are missing
+        for user_id in (TEST_USER_ID, second_id):
+            User.query.get(user_id).identifiers
+        db.session.commit()
+
+        def sorted_ids(fhir):
+            fhir['identifier'] = sorted(
+                fhir['identifier'], key=lambda i: (i['system'], i['value']))
+            return fhir
+
+        bulk = patients_as_fhir((TEST_USER_ID, second_id, 666))
+        self.assertEquals(set(bulk.keys()), set((TEST_USER_ID, second_id)))
+        for user_id in (TEST_USER_ID, second_id):
+            self.assertEquals(
+                sorted_ids(bulk[user_id]),
+                sorted_ids(User.query.get(user_id).as_fhir()))
+        self.assertEquals(3, len(bulk[TEST_USER_ID]['identifier']))
+        self.assertEquals(1, len(bulk[TEST_USER_ID]['careProvider']))
+
+        self.promote_user(role_name=ROLE.ADMIN)
+        self.login()
+        rv = self.client.get(
+            '/api/demographics/bundle?patient_id={}&patient_id={}'
+            '&patient_id=666'.format(second_id, TEST_USER_ID))
+        self.assert200(rv)
+        self.assertEquals(rv.json['total'], 2)
+        self.assertEquals(
+            [str(second_id), str(TEST_USER_ID)],
+            [[i['value'] for i in p['identifier']
+              if i['system'] == TRUENTH_ID][0] for p in rv.json['entry']])
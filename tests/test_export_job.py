@@ -0,0 +1,137 @@
+"""Unit test module for export jobs"""
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+from flask_swagger import swagger
+from StringIO import StringIO
+
+from portal.extensions import db
+from portal.models.export_job import ExportJob, purge_expired_exports
+from portal.models.role import ROLE
+from tests import TestCase, TEST_USER_ID
+
+
+class TestExportJob(TestCase):
+    """Export Job tests"""
+
+    def upload_assessment(self):
+        swagger_spec = swagger(self.app)
+        data = swagger_spec['definitions']['QuestionnaireResponse']['example']
+        rv = self.client.post(
+            '/api/patient/{}/assessment'.format(TEST_USER_ID),
+            content_type='application/json',
+            data=json.dumps(data))
+        self.assert200(rv)
+
+    def add_job(self, export_type, export_format=None):
+        job = ExportJob.from_request(
+            user=db.session.merge(self.test_user), export_type=export_type,
+            export_format=export_format)
+        db.session.add(job)
+        db.session.commit()
+        return db.session.merge(job)
+
+    def test_assessment_export(self):
+        self.login()
+        self.bless_with_basics()
+        self.promote_user(role_name=ROLE.STAFF)
+        self.promote_user(role_name=ROLE.PATIENT)
+        self.upload_assessment()
+        self.test_user = db.session.merge(self.test_user)
+        expected = self.client.get('/api/patient/assessment?format=csv').data
+
+        job = self.add_job('assessment')
+        self.assertEquals(job.status, 'queued')
+        job.run()
+        job = db.session.merge(job)
+        self.assertEquals(job.status, 'complete')
+        self.assertEquals(job.progress, len(expected.splitlines()))
+
+        rv = self.client.get('/api/export/job/{}'.format(job.id))
+        self.assert200(rv)
+        self.assertEquals(rv.json['status'], 'complete')
+        self.assertTrue(rv.json['download_url'])
+
+        rv = self.client.get('/api/export/job/{}/download'.format(job.id))
+        self.assert200(rv)
+        self.assertEquals(
+            gzip.GzipFile(fileobj=StringIO(rv.data)).read(), expected)
+        os.remove(job.file_path())
+
+    def test_reporting_export(self):
+        self.promote_user(role_name=ROLE.ADMIN)
+        self.login()
+        job = self.add_job('reporting')
+        self.assertEquals(job.format, 'json')
+        job.run()
+        job = db.session.merge(job)
+        with gzip.open(job.file_path()) as f:
+            stats = json.loads(f.read())
+        self.assertEquals(stats['roles']['admin'], 1)
+        os.remove(job.file_path())
+
+    def test_request_export(self):
+        self.promote_user(role_name=ROLE.STAFF)
+        self.login()
+        rv = self.client.post('/api/export/assessment?format=ndjson')
+        self.assertEquals(rv.status_code, 202)
+        self.assertEquals(rv.json['status'], 'queued')
+        self.assertEquals(rv.json['format'], 'ndjson')
+        self.assertTrue(rv.json['status_url'])
+
+        # staff can't export reporting stats, nor unsupported formats
+        rv = self.client.post('/api/export/reporting')
+        self.assert401(rv)
+        rv = self.client.post('/api/export/assessment?format=xml')
+        self.assert400(rv)
+
+    def test_incomplete_download(self):
+        self.login()
+        job = self.add_job('assessment')
+        rv = self.client.get('/api/export/job/{}/download'.format(job.id))
+        self.assert400(rv)
+
+        job_id = job.id
+        other = self.add_user('other')
+        job = db.session.merge(job)
+        job.user_id = other.id
+        db.session.commit()
+        rv = self.client.get('/api/export/job/{}'.format(job_id))
+        self.assert401(rv)
+        rv = self.client.get('/api/export/job/999')
+        self.assert404(rv)
+
+    def test_expired_export(self):
+        self.promote_user(role_name=ROLE.ADMIN)
+        self.login()
+        job = self.add_job('reporting')
+        job.run()
+        job = db.session.merge(job)
+        job_id, path = job.id, job.file_path()
+        self.assertTrue(os.path.exists(path))
+
+        # past retention, downloads are gone
+        job.completed_at = datetime.utcnow() - timedelta(
+            seconds=self.app.config['EXPORT_JOB_RETENTION'] + 60)
+        db.session.commit()
+        rv = self.client.get('/api/export/job/{}'.format(job_id))
+        self.assertTrue(rv.json['expires_at'])
+        self.assertNotIn('download_url', rv.json)
+        rv = self.client.get('/api/export/job/{}/download'.format(job_id))
+        self.assertEquals(rv.status_code, 410)
+
+        # unfinished and recent jobs are kept
+        queued_id = self.add_job('reporting').id
+        recent = self.add_job('reporting')
+        recent.run()
+        recent = db.session.merge(recent)
+        recent_id, recent_path = recent.id, recent.file_path()
+
+        self.assertEquals(
+            purge_expired_exports(), {'jobs': 1, 'files': 1})
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(ExportJob.query.get(job_id))
+        self.assertTrue(ExportJob.query.get(queued_id))
+        self.assertTrue(ExportJob.query.get(recent_id))
+        os.remove(recent_path)
@@ -11,12 +11,13 @@ from portal.models.audit import Audit
 from portal.models.fhir import CC
 from portal.models.group import Group
 from portal.models.identifier import Identifier
-from portal.models.intervention import INTERVENTION, UserIntervention
+from portal.models.intervention import INTERVENTION, Intervention
+from portal.models.intervention import UserIntervention, access_matrix
 from portal.models.intervention_strategies import AccessStrategy
 from portal.models.message import EmailMessage
 from portal.models.organization import Organization
 from portal.models.role import ROLE
-from portal.models.user import add_role
+from portal.models.user import add_role, User
 from portal.system_uri import DECISION_SUPPORT_GROUP, SNOMED
 
 
@@ -148,6 +149,118 @@ class TestIntervention(TestCase):
         self.assertTrue(cp.display_for_user(user).access)
         self.assertTrue(cp.quick_access_check(user))
 
+    def test_compiled_strategy_cache(self):
+        org1 = Organization(name='org1')
+        identifier = Identifier(value='pick me', system=DECISION_SUPPORT_GROUP)
+        org1.identifiers.append(identifier)
+        cp = INTERVENTION.CARE_PLAN
+        cp.public_access = False
+        cp_id = cp.id
+        with SessionScope(db):
+            db.session.add(org1)
+            db.session.commit()
+
+        d = {
+            'function': 'limit_by_clinic_w_id',
+            'kwargs': [{'name': 'identifier_value',
+                        'value': 'pick me'}]
+        }
+        strat = AccessStrategy(
+            name="member of org with identifier",
+            intervention_id=cp_id,
+            function_details=json.dumps(d))
+        with SessionScope(db):
+            db.session.add(strat)
+            db.session.commit()
+        strat = db.session.merge(strat)
+
+        # Repeated use returns the same compiled function
+        func = strat.compiled()
+        self.assertIs(func, strat.compiled())
+
+        # Adding an org with the identifier invalidates, so the new
+        # org is included in the recompiled strategy
+        org2 = Organization(name='org2')
+        org2.identifiers.append(db.session.merge(identifier))
+        with SessionScope(db):
+            db.session.add(org2)
+            db.session.commit()
+        org2, strat = map(db.session.merge, (org2, strat))
+        recompiled = strat.compiled()
+        self.assertIsNot(func, recompiled)
+
+        user = db.session.merge(self.test_user)
+        user.organizations.append(org2)
+        with SessionScope(db):
+            db.session.commit()
+        user, cp = map(db.session.merge, (self.test_user, cp))
+        self.assertTrue(cp.quick_access_check(user))
+
+        # User's org change doesn't invalidate compiled strategies
+        self.assertIs(recompiled, db.session.merge(strat).compiled())
+
+    def test_access_matrix(self):
+        org1, org2 = Organization(name='org1'), Organization(name='org2')
+        identifier = Identifier(value='pick me', system=DECISION_SUPPORT_GROUP)
+        org1.identifiers.append(identifier)
+        user_ids = [TEST_USER_ID] + [
+            self.add_user('user{}'.format(i)).id for i in range(1, 4)]
+        with SessionScope(db):
+            map(db.session.add, (org1, org2))
+            db.session.commit()
+        org1, org2 = map(db.session.merge, (org1, org2))
+        users = [User.query.get(user_id) for user_id in user_ids]
+        users[0].organizations.append(org1)
+        users[1].organizations.append(org2)
+        add_role(users[2], ROLE.WRITE_ONLY)
+
+        cp = INTERVENTION.CARE_PLAN
+        sr = INTERVENTION.SEXUAL_RECOVERY
+        sm = INTERVENTION.SELF_MANAGEMENT
+        p3p = INTERVENTION.DECISION_SUPPORT_P3P
+        for intervention in (cp, sr, sm, p3p):
+            intervention.public_access = False
+        cp_id, sr_id, sm_id, p3p_id = (cp.id, sr.id, sm.id, p3p.id)
+        strategies = (
+            (cp, {'function': 'limit_by_clinic_w_id',
+                  'kwargs': [{'name': 'identifier_value',
+                              'value': 'pick me'}]}),
+            (sr, {'function': 'combine_strategies',
+                  'kwargs': [
+                      {'name': 'strategy_1',
+                       'value': 'allow_if_not_in_intervention'},
+                      {'name': 'strategy_1_kwargs',
+                       'value': [{'name': 'intervention_name',
+                                  'value': cp.name}]},
+                      {'name': 'strategy_2', 'value': 'not_in_role_list'},
+                      {'name': 'strategy_2_kwargs',
+                       'value': [{'name': 'role_list',
+                                  'value': [ROLE.WRITE_ONLY]}]}]}),
+            (sm, {'function': 'in_role_list',
+                  'kwargs': [{'name': 'role_list',
+                              'value': [ROLE.WRITE_ONLY]}]}),
+            (p3p, {'function': 'tx_begun',
+                   'kwargs': [{'name': 'boolean_value', 'value': 'false'}]}))
+        for intervention, d in strategies:
+            db.session.add(AccessStrategy(
+                name=d['function'], intervention_id=intervention.id,
+                function_details=json.dumps(d)))
+        db.session.add(UserIntervention(
+            user_id=user_ids[3], intervention_id=cp.id, access='granted'))
+        with SessionScope(db):
+            db.session.commit()
+        self.add_procedure(code='26294005', display='Radical prostatectomy')
+
+        matrix = access_matrix(user_ids)
+        for intervention in Intervention.query:
+            expected = set(u.id for u in User.query.filter(
+                User.id.in_(user_ids)) if intervention.quick_access_check(u))
+            self.assertEqual(matrix[intervention.id], expected)
+        self.assertEqual(matrix[cp_id], {user_ids[0], user_ids[3]})
+        self.assertEqual(matrix[sr_id], {user_ids[1]})
+        self.assertEqual(matrix[sm_id], {user_ids[2]})
+        self.assertEqual(matrix[p3p_id], set(user_ids[1:]))
+
     def test_diag_stategy(self):
         """Test strategy for diagnosis"""
         # Add access strategies to the care plan intervention
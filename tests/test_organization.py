@@ -1,4 +1,5 @@
 """Unit test module for organization model"""
+from flask import g
 from flask_webtest import SessionScope
 import json
 import os
@@ -8,9 +9,13 @@ from portal.system_uri import PRACTICE_REGION, SHORTCUT_ALIAS
 from portal.models.fhir import Coding
 from portal.models.identifier import Identifier
 from portal.models.organization import Organization, OrgTree
+from portal.models.organization import ORG_TREE_VERSION_KEY
+from portal.models.organization import OrganizationClosure
 from portal.models.organization import OrganizationIdentifier
 from portal.models.role import ROLE
-from tests import TestCase
+from portal.models.user import User
+from portal.redis_client import redis_client
+from tests import TestCase, TEST_USER_ID
 
 
 class TestOrganization(TestCase):
@@ -362,6 +367,88 @@ class TestOrganization(TestCase):
         for i in (102, 1002, 10031, 10032):
             self.assertTrue(i in nodes)
 
+    def test_org_intervals(self):
+        self.deepen_org_tree()
+        ot = OrgTree()
+        self.assertEquals(
+            ot.preorder, [101, 1001, 102, 1002, 10031, 10032])
+        node = ot.find(1002)
+        self.assertEquals((node.left, node.right), (3, 5))
+        self.assertTrue(ot.at_or_below_ids(102, [10032]))
+        self.assertTrue(ot.at_or_below_ids(1002, [1002]))
+        self.assertTrue(ot.at_or_below_ids(101, [10031, 1001]))
+        self.assertFalse(ot.at_or_below_ids(101, [10031, 102]))
+        self.assertFalse(ot.at_or_below_ids(10031, [1002]))
+        self.assertEquals(ot.all_leaves_below_id(102), [10031, 10032])
+
+    def test_shared_version(self):
+        self.shallow_org_tree()
+        OrgTree()
+        root = OrgTree.root
+
+        # mock an org change handled by another process
+        redis_client().incr(ORG_TREE_VERSION_KEY)
+        OrgTree()
+        self.assertTrue(OrgTree.root is root)  # only checked per request
+
+        g.pop('org_tree_version_checked')
+        OrgTree()
+        self.assertFalse(OrgTree.root is root)
+        self.assertEquals(
+            OrgTree.version, redis_client().get(ORG_TREE_VERSION_KEY))
+
+    def test_closure_table(self):
+        self.app.config['ORG_CLOSURE_TABLE'] = True
+        try:
+            self.deepen_org_tree()
+            closure = OrganizationClosure.query
+            self.assertEquals(closure.count(), 12)
+            self.assertEquals(
+                set(c.ancestor_id for c in closure.filter_by(
+                    descendant_id=10031)),
+                set((10031, 1002, 102)))
+            self.assertEquals(
+                closure.filter_by(
+                    ancestor_id=102, descendant_id=10032).one().depth, 2)
+
+            # written apart from the session's pending changes
+            self.test_user = db.session.merge(self.test_user)
+            first_name = self.test_user.first_name
+            self.test_user.first_name = 'uncommitted'
+            OrgTree.invalidate_cache()
+            db.session.rollback()
+            self.assertEquals(
+                User.query.get(TEST_USER_ID).first_name, first_name)
+            self.assertEquals(closure.count(), 12)
+        finally:
+            self.app.config['ORG_CLOSURE_TABLE'] = False
+
+    def test_visible_patients(self):
+        self.deepen_org_tree()
+        patient = self.add_user('patient')
+        self.promote_user(patient, role_name=ROLE.PATIENT)
+        patient = db.session.merge(patient)
+        patient.organizations.append(Organization.query.get(10031))
+        self.consent_with_org(org_id=102, user_id=patient.id)
+        self.promote_user(role_name=ROLE.STAFF)
+        self.test_user = db.session.merge(self.test_user)
+        self.test_user.organizations.append(Organization.query.get(102))
+        with SessionScope(db):
+            db.session.commit()
+        patient, self.test_user = map(
+            db.session.merge, (patient, self.test_user))
+
+        self.assertEquals(
+            OrgTree().visible_patients(self.test_user), [patient.id])
+
+        self.app.config['ORG_CLOSURE_TABLE'] = True
+        try:
+            OrgTree.invalidate_cache()
+            self.assertEquals(
+                OrgTree().visible_patients(self.test_user), [patient.id])
+        finally:
+            self.app.config['ORG_CLOSURE_TABLE'] = False
+
     def test_visible_patients_on_none(self):
         # Add none of the above to users orgs
         self.test_user.organizations.append(Organization.query.get(0))
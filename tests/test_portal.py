@@ -89,9 +89,60 @@ class TestPortal(TestCase):
         self.app.config['PATIENT_LIST_ADDL_FIELDS'] = [
             'reports',]
         rv = self.client.get('/patients/')
+        self.assert200(rv)
+        rv = self.client.get('/patients/list')
 
         ui = db.session.merge(ui)
-        self.assertIn(ui.staff_html, rv.data)
+        row = rv.json['rows'][0]
+        self.assertEquals(row['userid'], TEST_USER_ID)
+        self.assertEquals(row['staff_html'], ui.staff_html)
+        self.assertEquals(row['reports'], [])
+
+    def test_patient_list(self):
+        """Staff patient list pages, sorts and filters in SQL"""
+        self.shallow_org_tree()
+        self.promote_user(role_name=ROLE.STAFF)
+        staff = db.session.merge(self.test_user)
+        staff.organizations.append(Organization.query.get(101))
+        patient_ids = []
+        for last_name in ('Bravo', 'alpha', 'Charlie', 'Delta'):
+            patient = self.add_user(
+                username='{}@example.com'.format(last_name.lower()),
+                last_name=last_name)
+            self.promote_user(patient, role_name=ROLE.PATIENT)
+            patient = db.session.merge(patient)
+            patient.organizations.append(Organization.query.get(1001))
+            patient_ids.append(patient.id)
+            if last_name != 'Delta':
+                self.consent_with_org(org_id=1001, user_id=patient.id)
+        db.session.commit()
+
+        self.login()
+        rv = self.client.get('/patients/list?sort=lastname&limit=2')
+        self.assert200(rv)
+        self.assertEquals(rv.json['total'], 3)
+        self.assertEquals(
+            ['alpha', 'Bravo'], [p['lastname'] for p in rv.json['rows']])
+        self.assertEquals(['1001'], rv.json['rows'][0]['organization'])
+        self.assertEquals(1, len(rv.json['rows'][0]['consentdate']))
+
+        rv = self.client.get(
+            '/patients/list?sort=lastname&limit=2&after={}'.format(
+                rv.json['next']))
+        self.assertEquals(
+            ['Charlie'], [p['lastname'] for p in rv.json['rows']])
+        self.assertNotIn('next', rv.json)
+
+        rv = self.client.get('/patients/list?order=desc&search=RAV')
+        self.assertEquals(rv.json['total'], 1)
+        self.assertEquals(patient_ids[0], rv.json['rows'][0]['userid'])
+
+        # organizations outside the staff user's are ignored
+        rv = self.client.get('/patients/list?org_list=102')
+        self.assertEquals(rv.json['total'], 0)
+
+        rv = self.client.get('/patients/list?sort=password')
+        self.assert400(rv)
 
     def test_public_access(self):
         """Interventions w/o public access should be hidden"""
@@ -131,9 +182,85 @@ class TestPortal(TestCase):
         self.promote_user(role_name=ROLE.ADMIN)
         self.login()
         rv = self.client.get('/admin')
+        self.assert200(rv)
+
+        # The page lists users from the list API, which should at least
+        # see an entry per user in system
+        rv = self.client.get('/admin/list?limit=100')
+        self.assertEquals(len(rv.json['rows']), User.query.count())
+        self.assertTrue(all(
+            '/profile' in row['profile_url'] for row in rv.json['rows']))
+
+    def test_admin_list_api(self):
+        """Admin user list API pages users with their roles"""
+        self.shallow_org_tree()
+        u1 = self.add_user(username='u1@foo.bar', last_name='Zed')
+        u2 = self.add_user(username='u2@bar.foo', last_name='Able')
+        self.promote_user(u1, role_name=ROLE.ADMIN)
+        self.promote_user(u1, role_name=ROLE.STAFF)
+        self.promote_user(u2, role_name=ROLE.APPLICATION_DEVELOPER)
+        u2 = db.session.merge(u2)
+        u2.organizations.append(Organization.query.get(1001))
+        u2_id = u2.id
+        db.session.commit()
+
+        self.promote_user(role_name=ROLE.ADMIN)
+        self.login()
+        rv = self.client.get('/admin/list?limit=2&sort=lastname&order=desc')
+        self.assert200(rv)
+        self.assertEquals(rv.json['total'], User.query.count())
+        self.assertEquals(2, len(rv.json['rows']))
+        self.assertEquals('Zed', rv.json['rows'][0]['lastname'])
+        self.assertEquals(
+            [ROLE.ADMIN, ROLE.STAFF], rv.json['rows'][0]['roles'])
+
+        # filter by org includes users of decendent orgs
+        rv = self.client.get('/admin/list?org_list=101')
+        self.assertEquals(rv.json['total'], 1)
+        self.assertEquals(u2_id, rv.json['rows'][0]['userid'])
+        self.assertEquals(['1001'], rv.json['rows'][0]['organization'])
+
+        rv = self.client.get('/admin/list?search=bar.FOO')
+        self.assertEquals(rv.json['total'], 1)
+
+        # pages follow the cursor from the previous page
+        rv = self.client.get('/admin/list?limit=2&sort=lastname&order=desc')
+        after = rv.json['next']
+        rv = self.client.get(
+            '/admin/list?limit=2&sort=lastname&order=desc&after={}'.format(
+                after))
+        self.assertEquals(['Able'], [u['lastname'] for u in rv.json['rows']])
+        self.assertNotIn('next', rv.json)
+
+        rv = self.client.get('/admin/list?limit=2&after=bogus')
+        self.assert400(rv)
+
+    def test_staff_list_api(self):
+        """Staff admin sees staff of their orgs, less fellow admins"""
+        self.shallow_org_tree()
+        staff = self.add_user(username='staff@example.com')
+        staff_admin = self.add_user(username='staff_admin@example.com')
+        self.promote_user(staff, role_name=ROLE.STAFF)
+        self.promote_user(staff_admin, role_name=ROLE.STAFF)
+        self.promote_user(staff_admin, role_name=ROLE.STAFF_ADMIN)
+        self.promote_user(role_name=ROLE.STAFF_ADMIN)
+        user = db.session.merge(self.test_user)
+        user.organizations.append(Organization.query.get(101))
+        staff = db.session.merge(staff)
+        staff.organizations.append(Organization.query.get(1001))
+        staff_admin = db.session.merge(staff_admin)
+        staff_admin.organizations.append(Organization.query.get(101))
+        staff_id = staff.id
+        db.session.commit()
 
-        # Should at least see an entry per user in system
-        self.assertTrue(rv.data.count('/profile') >= User.query.count())
+        self.login()
+        rv = self.client.get('/staff')
+        self.assert200(rv)
+        rv = self.client.get('/staff/list')
+        self.assert200(rv)
+        self.assertEquals(rv.json['total'], 1)
+        self.assertEquals(staff_id, rv.json['rows'][0]['userid'])
+        self.assertEquals([ROLE.STAFF], rv.json['rows'][0]['roles'])
 
     def test_invite(self):
         """Test email invite form"""
@@ -1,16 +1,20 @@
 """Unit test module for questionnaire_bank"""
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from flask import g
 from flask_webtest import SessionScope
 
 from portal.extensions import db
 from portal.models.intervention import Intervention
 from portal.models.organization import Organization
+from portal.models.qb_timeline import GLOBAL
+from portal.models.qb_timeline import invalidate_qb_timelines, qb_timeline
 from portal.models.questionnaire import Questionnaire
 from portal.models.questionnaire_bank import QuestionnaireBank, visit_name
 from portal.models.questionnaire_bank import QuestionnaireBankQuestionnaire
+from portal.models.questionnaire_bank import intervention_trigger_dates
 from portal.models.recur import Recur
-from tests import TestCase
+from tests import TestCase, TEST_USER_ID
 
 
 class TestQuestionnaireBank(TestCase):
@@ -228,6 +232,34 @@ class TestQuestionnaireBank(TestCase):
         results = list(qb.questionnaires)
         self.assertEquals(2, len(results))
 
+    def test_intervention_trigger_dates(self):
+        intv = Intervention(name='TEST', description='Test Intervention')
+        with SessionScope(db):
+            db.session.add(intv)
+            db.session.commit()
+        intv = db.session.merge(intv)
+        bank = QuestionnaireBank(
+            name='CRV', intervention_id=intv.id, start='{"days": 7}',
+            expired='{"days": 90}')
+        other_id = self.add_user('other@example.com').id
+        self.login()
+        self.add_required_clinical_data(backdate=relativedelta(days=31))
+
+        # biopsy date, until treatment starts
+        self.test_user = db.session.merge(self.test_user)
+        dates = intervention_trigger_dates([TEST_USER_ID, other_id])
+        self.assertEquals(
+            dates, {TEST_USER_ID: bank.trigger_date(self.test_user)})
+
+        self.add_procedure(
+            code='26294005', display='Radical prostatectomy')
+        self.test_user = db.session.merge(self.test_user)
+        dates = intervention_trigger_dates([TEST_USER_ID])
+        self.assertEquals(
+            dates[TEST_USER_ID], self.test_user.procedures[0].start_time)
+        self.assertEquals(
+            dates[TEST_USER_ID], bank.trigger_date(self.test_user))
+
     def test_questionnaire_gets(self):
         crv = Organization(name='CRV')
         epic26 = Questionnaire(name='epic26')
@@ -302,6 +334,86 @@ class TestQuestionnaireBank(TestCase):
         self.assertEquals("CRV Recurring, 18 Month", visit_name(qbd_i2))
 
 
+    def test_timeline(self):
+        crv = setup_qbs()
+        self.bless_with_basics(backdate=relativedelta(months=3))
+        self.test_user.organizations.append(crv)
+        self.test_user = db.session.merge(self.test_user)
+
+        timeline = qb_timeline(self.test_user)
+        self.assertEquals(3, len(timeline.windows))
+        self.assertEquals(
+            ['baseline', 'recurring', 'recurring'],
+            [w.classification for w in timeline.windows])
+        self.assertTrue(timeline is qb_timeline(self.test_user))
+
+        # timeline matches the calculation as of a given date
+        qbd = QuestionnaireBank.most_current_qb(self.test_user)
+        as_of_qbd = QuestionnaireBank.most_current_qb(
+            self.test_user, as_of_date=datetime.utcnow())
+        self.assertEquals(qbd, as_of_qbd)
+        self.assertEquals("CRV Recurring, 3 Month", visit_name(qbd))
+
+    def test_timeline_invalidation(self):
+        crv = setup_qbs()
+        self.test_user.organizations.append(crv)
+        self.test_user = db.session.merge(self.test_user)
+
+        # Without consent, no trigger date
+        timeline = qb_timeline(self.test_user)
+        self.assertIsNone(timeline.windows[0].trigger_date)
+        self.assertIsNone(
+            QuestionnaireBank.most_current_qb(self.test_user).relative_start)
+
+        self.bless_with_basics(backdate=relativedelta(months=6))
+        self.test_user = db.session.merge(self.test_user)
+        self.assertFalse(timeline is qb_timeline(self.test_user))
+        qbd = QuestionnaireBank.most_current_qb(self.test_user)
+        self.assertEquals("CRV Recurring, 6 Month", visit_name(qbd))
+
+    def test_timeline_cache(self):
+        crv = setup_qbs()
+        self.bless_with_basics(backdate=relativedelta(months=3))
+        self.test_user.organizations.append(crv)
+        self.test_user = db.session.merge(self.test_user)
+
+        self.app.config['QB_TIMELINE_CACHE'] = True
+        try:
+            invalidate_qb_timelines()  # ignore any from previous runs
+            timeline = qb_timeline(self.test_user)
+
+            # with the request memo gone, expect the dogpile cached copy
+            g.qb_timelines.clear()
+            cached = qb_timeline(self.test_user)
+            self.assertFalse(cached is timeline)
+            self.assertEquals(cached.windows, timeline.windows)
+            self.assertEquals(
+                cached.most_current_qb(), timeline.most_current_qb())
+
+            # a new data version requires a fresh timeline
+            invalidate_qb_timelines([self.test_user.id])
+            fresh = qb_timeline(self.test_user)
+            self.assertTrue(fresh.as_of_date > cached.as_of_date)
+            self.assertEquals(fresh.windows, timeline.windows)
+        finally:
+            self.app.config['QB_TIMELINE_CACHE'] = False
+
+    def test_timeline_changes(self):
+        # only changes to timeline data are noted for invalidation
+        with SessionScope(db):
+            db.session.add(Questionnaire(name='epic26'))
+            db.session.flush()
+            self.assertFalse(db.session.info.get('qb_timeline_changes'))
+
+            db.session.add(Recur(
+                start='{"days": 1}', cycle_length='{"days": 5}'))
+            db.session.flush()
+            self.assertEquals(
+                db.session.info['qb_timeline_changes'], set([GLOBAL]))
+            db.session.commit()
+            self.assertNotIn('qb_timeline_changes', db.session.info)
+
+
 def setup_qbs():
     crv = Organization(name='CRV')
     epic26 = Questionnaire(name='epic26')
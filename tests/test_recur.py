@@ -1,7 +1,8 @@
 """Module to test Recur model"""
 from datetime import datetime, timedelta
 
-from portal.models.recur import Recur
+from portal.date_tools import RelativeDelta
+from portal.models.recur import Recur, _multiples_match
 from tests import TestCase
 
 
@@ -40,3 +41,73 @@ class TestRecur(TestCase):
         # should get back 30 back, plus 2 to start, plus 10*2
         self.assertAlmostEqual(result, thirty_back + timedelta(days=22))
         self.assertEquals(ic, 2)
+
+    def test_many_intervals(self):
+        # years into a monthly recurrence, starting at the end of a month
+        trigger = datetime(2000, 1, 31)
+        recur = Recur(start='{"months": 1}', cycle_length='{"months": 1}')
+        result, ic = recur.active_interval_start(
+            trigger_date=trigger, as_of_date=datetime(2010, 3, 15))
+        self.assertEquals(result, datetime(2010, 2, 28))
+        self.assertEquals(ic, 120)
+
+        # each cycle is added to the last, so once clipped to the 28th
+        # of February, iterations stay on the 28th
+        result, ic = recur.active_interval_start(
+            trigger_date=trigger, as_of_date=datetime(2010, 3, 28))
+        self.assertEquals(result, datetime(2010, 2, 28))
+        self.assertEquals(ic, 120)
+
+        result, ic = recur.active_interval_start(
+            trigger_date=trigger, as_of_date=datetime(2010, 3, 29))
+        self.assertEquals(result, datetime(2010, 3, 28))
+        self.assertEquals(ic, 121)
+
+    def test_intervals_match_stepping(self):
+        # the estimate agrees with adding one cycle at a time
+        for trigger, start, cycle_length in (
+                (datetime(2001, 8, 31, 12), '{"months": 1}', '{"months": 1}'),
+                (datetime(2001, 8, 31, 12), '{"days": 1}', '{"months": 6}'),
+                (datetime(2001, 8, 31, 12), '{"months": 3}',
+                 '{"months": 3, "days": -14}'),
+                (datetime(2001, 8, 31, 12), '{"days": 2}', '{"weeks": 5}'),
+                (datetime(2001, 8, 31, 12), '{"years": 1}', '{"years": 1}'),
+                (datetime(2001, 1, 30), '{"months": 0}', '{"years": 1}'),
+                (datetime(2001, 1, 30), '{"months": 0}', '{"months": 2}'),
+                (datetime(2000, 12, 31), '{"months": 0}', '{"months": 3}'),
+                (datetime(2000, 2, 29), '{"months": 0}', '{"years": 1}')):
+            recur = Recur(start=start, cycle_length=cycle_length)
+            cycle = RelativeDelta(cycle_length)
+            expected = trigger + RelativeDelta(start)
+            iteration = 0
+            as_of_date = expected
+            while as_of_date < datetime(2012, 1, 1):
+                while expected + cycle < as_of_date:
+                    expected += cycle
+                    iteration += 1
+                self.assertEquals(
+                    recur.active_interval_start(trigger, as_of_date),
+                    (expected, iteration))
+                as_of_date += timedelta(days=9)
+
+    def test_multiples_match(self):
+        # months the additions land in decide where days are clipped
+        for cycle_length, date, expected in (
+                ('{"years": 1}', datetime(2001, 1, 30), True),
+                ('{"months": 2}', datetime(2001, 1, 30), True),
+                ('{"months": 1}', datetime(2001, 1, 30), False),
+                ('{"months": 1}', datetime(2001, 2, 28), True),
+                ('{"months": 3}', datetime(2001, 1, 31), False),
+                ('{"months": 6}', datetime(2001, 1, 31), True),
+                ('{"years": 1}', datetime(2000, 2, 29), False),
+                ('{"months": 1, "days": 1}', datetime(2001, 1, 2), False)):
+            self.assertEquals(_multiples_match(
+                RelativeDelta(cycle_length), date), expected)
+
+    def test_memoized_deltas(self):
+        recur = Recur(start='{"days": 2}', cycle_length='{"days": 10}')
+        self.assertIs(recur.cycle_length_delta, recur.cycle_length_delta)
+        self.assertIsNone(recur.termination_delta)
+
+        recur.cycle_length = '{"days": 5}'
+        self.assertEquals(recur.cycle_length_delta.days, 5)
@@ -1,14 +1,24 @@
 """Unit test module for stat reporting"""
+from collections import defaultdict
 from datetime import datetime
 from flask_webtest import SessionScope
 
-from portal.dogpile import dogpile_cache
 from portal.extensions import db
+from portal.models.audit import Audit
 from portal.models.encounter import Encounter
+from portal.models.fhir import CC
+from portal.models.intervention import INTERVENTION, Intervention
+from portal.models.intervention import UserIntervention
 from portal.models.organization import Organization
-from portal.models.reporting import get_reporting_stats
+from portal.models.reporting import calculate_reporting_stats
+from portal.models.reporting import BUILT_KEY, current_reporting_stats
+from portal.models.reporting import intervention_description, PENDING_KEY
+from portal.models.reporting import read_stats_store, rebuild_stats_store
 from portal.models.role import ROLE
-from tests import TestCase
+from portal.models.user import add_role
+from portal.models.user_document import UserDocument
+from portal.redis_client import redis_client
+from tests import TestCase, TEST_USER_ID
 
 
 class TestReporting(TestCase):
@@ -46,9 +56,9 @@ class TestReporting(TestCase):
                 db.session.add(enc)
             db.session.commit()
 
-        # invalidate cache before testing
-        dogpile_cache.invalidate(get_reporting_stats)
-        stats = get_reporting_stats()
+        # drop any store left from previous tests, to build afresh
+        redis_client().delete(BUILT_KEY)
+        stats = current_reporting_stats()
 
         self.assertEqual(stats['organizations']['testorg'], 2)
         self.assertEqual(stats['organizations']['Unspecified'], 2)
@@ -57,9 +67,9 @@ class TestReporting(TestCase):
         self.assertEqual(stats['roles']['staff'], 1)
         self.assertEqual(stats['roles']['partner'], 1)
 
-        self.assertEqual(len(stats['encounters']['all']), 5)
+        self.assertEqual(stats['encounters']['all']['all'], 5)
 
-        # test adding a new encounter, to confirm still using cached stats
+        # a new encounter is counted once committed, without a rebuild
         with SessionScope(db):
             enc = Encounter(
                 status='finished',
@@ -69,7 +79,127 @@ class TestReporting(TestCase):
             db.session.add(enc)
             db.session.commit()
 
-        stats2 = get_reporting_stats()
+        stats2 = current_reporting_stats()
+        self.assertEqual(stats2['encounters']['all']['all'], 6)
+        self.assertEqual(stats2['encounters']['all']['day'], 6)
 
-        # shold not have changed, if still using cached values
-        self.assertEqual(len(stats2['encounters']['all']), 5)
+    def test_patient_stats(self):
+        # test user: biopsy and no treatment started procedure
+        self.promote_user(role_name=ROLE.PATIENT)
+        self.add_procedure(
+            code='424313000', display='Started active surveillance')
+        user2, user3, tester = [
+            self.add_user(name) for name in ('test2', 'test3', 'tester')]
+        for user in (user2, user3, tester):
+            self.promote_user(user=user, role_name=ROLE.PATIENT)
+        self.promote_user(user=tester, role_name=ROLE.TEST)
+        self.test_user, user2, user3, tester = map(
+            db.session.merge, (self.test_user, user2, user3, tester))
+
+        # user2: biopsy only, user3: metastatic, w/o biopsy.  Each login
+        # also adds a password_authenticated encounter
+        for user in (self.test_user, user2, tester):
+            self.login(user.id)  # observations require an encounter
+            user = db.session.merge(user)
+            user.save_constrained_observation(
+                codeable_concept=CC.BIOPSY, value_quantity=CC.TRUE_VALUE,
+                audit=Audit(user_id=TEST_USER_ID, subject_id=user.id))
+        self.login(user3.id)
+        user3 = db.session.merge(user3)
+        user3.save_constrained_observation(
+            codeable_concept=CC.PCaLocalized, value_quantity=CC.FALSE_VALUE,
+            audit=Audit(user_id=TEST_USER_ID, subject_id=user3.id))
+
+        sr = INTERVENTION.SEXUAL_RECOVERY
+        sr.public_access = False
+        with SessionScope(db):
+            db.session.add(UserIntervention(
+                user_id=user3.id, intervention_id=sr.id, access='granted'))
+            db.session.commit()
+        self.test_user, user2, user3, sr = map(
+            db.session.merge, (self.test_user, user2, user3, sr))
+
+        stats = calculate_reporting_stats()
+        self.assertEqual(stats['roles']['patient'], 3)
+        self.assertEqual(stats['patients']['pre-dx'], 1)
+        self.assertEqual(stats['patients']['dx-nt'], 1)
+        self.assertEqual(stats['patients']['dx-t'], 0)
+        self.assertEqual(stats['patients']['meta'], 1)
+        self.assertEqual(stats['interventions'][sr.description], 1)
+        self.assertEqual(stats['encounters'][sr.description]['all'], 1)
+        self.assertEqual(stats['registrations']['all'], 3)
+
+        # bulk access counts match individual access checks
+        expected = defaultdict(int)
+        for user in (self.test_user, user2, user3):
+            for intervention in Intervention.query:
+                if intervention.quick_access_check(user):
+                    expected[intervention_description(intervention)] += 1
+        self.assertEqual(dict(stats['intervention_access']), dict(expected))
+        self.assertEqual(stats['intervention_access'][sr.description], 1)
+
+    def test_stats_store(self):
+        user1 = self.add_user('test1')
+        self.promote_user(user=user1, role_name=ROLE.PATIENT)
+        self.promote_user(role_name=ROLE.STAFF)
+        self.login()
+        rebuild_stats_store()
+
+        stats = read_stats_store()
+        self.assertEqual(stats['roles']['patient'], 1)
+        self.assertEqual(stats['roles']['staff'], 1)
+        self.assertEqual(stats['registrations']['all'], 2)
+        self.assertEqual(stats['registrations']['day'], 2)
+        self.assertEqual(stats['encounters']['all']['month'], 1)
+
+        # Changes via the usual write paths are reflected in the store
+        user2 = self.add_user('test2')
+        user2_id = user2.id
+        sr = INTERVENTION.SEXUAL_RECOVERY
+        label = sr.description
+        with SessionScope(db):
+            add_role(user2, ROLE.PATIENT)
+            db.session.add(UserIntervention(
+                user_id=user2.id, intervention_id=sr.id))
+            # only the first report per user and intervention counts
+            for i in range(2):
+                db.session.add(UserDocument(
+                    user_id=user2_id, intervention_id=sr.id,
+                    document_type='TestReport', filename='report.pdf',
+                    filetype='pdf', uuid='{}'.format(i),
+                    uploaded_at=datetime.utcnow()))
+            db.session.commit()
+        self.login(user2_id)
+        user1 = db.session.merge(user1)
+        with SessionScope(db):
+            user1.roles = []
+            db.session.commit()
+
+        # commits only queue their changes, applied on the next read
+        self.assertTrue(redis_client().llen(PENDING_KEY))
+        stats = read_stats_store()
+        self.assertFalse(redis_client().exists(PENDING_KEY))
+        self.assertEqual(stats['roles']['patient'], 1)
+        self.assertEqual(stats['registrations']['year'], 3)
+        self.assertEqual(stats['encounters']['all']['all'], 2)
+        self.assertEqual(stats['encounters'][label]['day'], 1)
+        self.assertEqual(stats['interventions'][label], 1)
+        self.assertEqual(stats['intervention_reports'][label], 1)
+
+        # and match a full calculation
+        full = calculate_reporting_stats()
+        self.assertEqual(dict(stats['roles']), dict(full['roles']))
+        self.assertEqual(
+            dict(stats['interventions']), dict(full['interventions']))
+        self.assertEqual(
+            dict(stats['intervention_reports']),
+            dict(full['intervention_reports']))
+        self.assertEqual(
+            stats['registrations']['all'], full['registrations']['all'])
+
+    def test_reporting_dashboard(self):
+        self.promote_user(role_name=ROLE.ADMIN)
+        self.login()
+        rebuild_stats_store()
+        resp = self.client.get('/reporting')
+        self.assert200(resp)
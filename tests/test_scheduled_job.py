@@ -3,9 +3,9 @@ import json
 from portal.extensions import db
 from portal.models.role import ROLE
 from portal.models.scheduled_job import ScheduledJob
-from portal.tasks import test
-from tests import TestCase
-
+from portal.models.scheduled_job import start_progress
+from portal.tasks import patient_chunks, process_patient_chunk, test
+from tests import TestCase, TEST_USER_ID
 
 
 class TestScheduledJob(TestCase):
@@ -81,3 +81,44 @@ class TestScheduledJob(TestCase):
 
         resp = self.client.delete('/api/scheduled_job/999')
         self.assert404(resp)
+
+    def test_patient_chunks(self):
+        self.promote_user(role_name=ROLE.PATIENT)
+        patient_ids = [TEST_USER_ID]
+        for i in range(2):
+            user = self.add_user('patient{}'.format(i))
+            patient_ids.append(user.id)
+            self.promote_user(user=user, role_name=ROLE.PATIENT)
+        self.add_user('not_a_patient')
+
+        chunks = patient_chunks(2)
+        self.assertEquals([len(c) for c in chunks], [2, 1])
+        self.assertEquals(sum(chunks, []), sorted(patient_ids))
+
+    def test_chunk_progress(self):
+        self.promote_user(role_name=ROLE.PATIENT)
+        job = ScheduledJob(name="testjob", task="cache_assessment_status",
+                           schedule="0 * * * *")
+        db.session.add(job)
+        db.session.commit()
+        job_id = job.id
+
+        start_progress(job_id, 2)
+        result = process_patient_chunk(
+            patient_ids=[TEST_USER_ID], chunk=0, job_id=job_id,
+            update_cache=True, queue_messages=False)
+        self.assertEquals(result['patients'], 1)
+        self.assertIsNone(result['error'])
+
+        # a failing chunk is recorded, not raised
+        result = process_patient_chunk(
+            patient_ids=['bogus'], chunk=1, job_id=job_id,
+            update_cache=True, queue_messages=False)
+        self.assertTrue(result['error'])
+
+        progress = ScheduledJob.query.get(job_id).progress
+        self.assertEquals(progress['total_chunks'], 2)
+        self.assertEquals(progress['completed_chunks'], 1)
+        self.assertEquals(progress['failed_chunks'], 1)
+        self.assertEquals(progress['chunks']['0']['patients'], 1)
+        self.assertIn('error', progress['chunks']['1'])
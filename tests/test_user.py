@@ -9,6 +9,7 @@ from datetime import datetime
 from tests import TestCase, TEST_USER_ID
 
 from portal.extensions import db
+from portal.models.auth import AuthProvider
 from portal.models.audit import Audit
 from portal.models.encounter import Encounter
 from portal.models.fhir import Coding, UserEthnicity, UserIndigenous
@@ -18,13 +19,16 @@ from portal.models.organization import Organization, OrganizationLocale
 from portal.models.performer import Performer
 from portal.models.reference import Reference
 from portal.models.relationship import Relationship, RELATIONSHIP
-from portal.models.role import STATIC_ROLES, ROLE
+from portal.models.role import Role, STATIC_ROLES, ROLE
 from portal.models.user import User, UserEthnicityExtension, user_extension_map
-from portal.models.user import UserRelationship, UserTimezone
-from portal.models.user import permanently_delete_user
+from portal.models.user import UserRelationship, UserRoles, UserTimezone
+from portal.models.user import add_role, get_user, permanently_delete_user
+from portal.models.user import role_names_by_user
 from portal.models.user import UserIndigenousStatusExtension
 from portal.models.user_consent import UserConsent, STAFF_EDITABLE_MASK
 from portal.system_uri import TRUENTH_EXTENSTION_NHHD_291036
+from portal.system_uri import TRUENTH_ID, TRUENTH_IDENTITY_SYSTEM
+from portal.system_uri import TRUENTH_USERNAME
 from portal.system_uri import TRUENTH_VALUESET_NHHD_291036
 
 class TestUser(TestCase):
@@ -176,6 +180,70 @@ class TestUser(TestCase):
         self.assertIn('1', found)
         self.assertIn('9', found)
 
+    def test_request_users(self):
+        with self.app.test_request_context():
+            user = get_user(TEST_USER_ID)
+            self.assertIs(user, get_user(TEST_USER_ID))
+            self.assertIsNone(get_user(TEST_USER_ID + 1000))
+            self.assertFalse(user.has_role(ROLE.STAFF))
+
+            # Roles added within the request are seen on next access
+            add_role(user, ROLE.STAFF)
+            db.session.commit()
+            self.assertTrue(get_user(TEST_USER_ID).has_role(ROLE.STAFF))
+
+            # As are changes written directly, once flushed
+            other = self.add_user('other@example.com')
+            other_id = other.id
+            other = get_user(other_id)
+            self.assertFalse(other.has_role(ROLE.PATIENT))
+            db.session.add(UserRoles(
+                user_id=other_id, role_id=Role.query.filter_by(
+                    name=ROLE.PATIENT).one().id))
+            db.session.flush()
+            self.assertTrue(get_user(other_id).has_role(ROLE.PATIENT))
+
+    def test_role_names(self):
+        user = db.session.merge(self.test_user)
+        self.assertEqual(user.role_names, frozenset())
+        staff = Role.query.filter_by(name=ROLE.STAFF).one()
+        user.roles.append(staff)
+        self.assertEqual(user.role_names, {ROLE.STAFF})
+        self.assertTrue(user.has_role(ROLE.STAFF))
+        user.roles.remove(staff)
+        self.assertFalse(user.has_role(ROLE.STAFF))
+
+        # Changes outside the collection are seen once expired
+        add_role(user, ROLE.PATIENT)
+        db.session.commit()
+        self.assertEqual(user.role_names, {ROLE.PATIENT})
+
+        other = self.add_user('other@example.com')
+        other_id = other.id
+        self.assertEqual(
+            role_names_by_user((TEST_USER_ID, other_id)),
+            {TEST_USER_ID: {ROLE.PATIENT}, other_id: frozenset()})
+
+    def test_implicit_identifiers(self):
+        with SessionScope(db):
+            db.session.add(AuthProvider(
+                provider='facebook', provider_id='fb-123',
+                user_id=TEST_USER_ID))
+            db.session.commit()
+        user = db.session.merge(self.test_user)
+        implicit = user.implicit_identifiers()
+        self.assertEqual(
+            [(i.system, i.value) for i in implicit],
+            [(TRUENTH_ID, str(TEST_USER_ID)),
+             (TRUENTH_USERNAME, user.username),
+             (TRUENTH_IDENTITY_SYSTEM + '/facebook', 'fb-123')])
+
+        # in place of the relationship, given providers are used
+        self.assertEqual(len(user.implicit_identifiers([])), 2)
+
+        # and all are added to the user's identifiers on request
+        self.assertTrue(all(i in user.identifiers for i in implicit))
+
     def test_delete_user(self):
         actor = self.add_user('actor')
         user, actor = map(db.session.merge,(self.test_user, actor))
@@ -611,6 +679,12 @@ class TestUser(TestCase):
         kwargs = {'permission': 'view', 'other_id': member_of.id}
         self.assertTrue(user.check_role(**kwargs))
 
+        self.assertEquals(
+            user.permitted_user_ids('view', (user.id, u2.id, member_of.id)),
+            set((user.id, member_of.id)))
+        # ids not found are simply excluded
+        self.assertEquals(user.permitted_user_ids('edit', (999, )), set())
+
     def test_deep_tree_check_role(self):
         self.deepen_org_tree()
 
@@ -709,6 +783,17 @@ class TestUser(TestCase):
                 self.assertTrue(
                     staff_leaf.check_role(perm, other_id=patient))
 
+        # bulk evaluation matches
+        patients = (patient_w_id, patient_x_id, patient_y_id, patient_z_id)
+        for perm in ('view', 'edit'):
+            self.assertEquals(
+                staff_top.permitted_user_ids(perm, patients), set(patients))
+            self.assertEquals(
+                staff_mid.permitted_user_ids(perm, patients), set(patients))
+            self.assertEquals(
+                staff_leaf.permitted_user_ids(perm, patients),
+                set((patient_y_id, patient_z_id)))
+
         # Now remove the staff editable flag from the consents, which should
         # preserve view but remove edit permission
         for uc in (uc_w, uc_x, uc_y, uc_z):
@@ -750,6 +835,13 @@ class TestUser(TestCase):
             self.assertRaises(
                 Unauthorized, staff_leaf.check_role, 'edit', patient)
 
+        self.assertEquals(
+            staff_mid.permitted_user_ids('view', patients), set(patients))
+        self.assertEquals(staff_mid.permitted_user_ids('edit', patients), set())
+        self.assertEquals(
+            staff_leaf.permitted_user_ids('view', patients),
+            set((patient_y_id, patient_z_id)))
+
     def test_deep_tree_staff_check_role(self):
         """Can staff-admin edit correct staff members"""
         self.deepen_org_tree()
@@ -826,6 +918,14 @@ class TestUser(TestCase):
             self.assertTrue(
                 staff_admin_leaf.check_role(perm, other_id=staff_z_id))
 
+        staff = (staff_x_id, staff_y_id, staff_z_id)
+        self.assertEquals(
+            staff_admin_mid.permitted_user_ids('edit', staff),
+            set((staff_x_id, staff_z_id)))
+        self.assertEquals(
+            staff_admin_leaf.permitted_user_ids('view', staff),
+            set((staff_z_id, )))
+
     def test_all_relationships(self):
         # obtain list of all relationships
         rv = self.client.get('/api/relationships')